@@ -0,0 +1,86 @@
+# coding: utf-8
+
+from __future__ import print_function, division
+
+"""
+Publishes confirmed messages through `_AMQPProtocol` against stub broker
+and reports throughput for various sizes of unconfirmed window.
+"""
+
+import sys
+import time
+import argparse
+
+from pika import frame, spec
+
+from twoost import amqp
+
+
+class StubConfirmingChannel(object):
+
+    """Acks published messages with `multiple=True` every `ack_lag` messages."""
+
+    is_open = True
+
+    def __init__(self, protocol, ack_lag):
+        self.protocol = protocol
+        self.ack_lag = ack_lag
+        self.published = 0
+        self.acked = 0
+        self.pc = amqp._PublishChannel(self, confirm=True)
+
+    def basic_publish(self, exchange, routing_key, body, properties=None):
+        self.published += 1
+        if self.published - self.acked >= self.ack_lag:
+            self.ackAll()
+
+    def ackAll(self):
+        if self.acked < self.published:
+            self.acked = self.published
+            self.protocol._onPublishConfirm(
+                self.pc, frame.Method(1, spec.Basic.Ack(self.acked, multiple=True)))
+
+
+def build_protocol(ack_lag):
+    p = amqp._AMQPProtocol(parameters={})
+    p._ready_for_publish = True
+    ch = StubConfirmingChannel(p, ack_lag)
+    p._safewrite_channels = [ch.pc]
+    p._write_channels = [amqp._PublishChannel(ch, confirm=False)]
+    return p
+
+
+def run(count, ack_lag):
+
+    p = build_protocol(ack_lag)
+    confirmed = [0]
+
+    def on_confirm(_):
+        confirmed[0] += 1
+
+    t0 = time.time()
+    for i in xrange(count):
+        p.publishMessage('', 'rk', "message", confirm=True).addCallback(on_confirm)
+    p._safewrite_channels[0].channel.ackAll()
+    dt = time.time() - t0
+
+    assert confirmed[0] == count, "lost confirms"
+    return dt
+
+
+def main(args):
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--count', type=int, default=100000)
+    parser.add_argument('--lags', type=int, nargs='+', default=[1, 10, 100, 1000, 10000])
+    opts = parser.parse_args(args)
+
+    print("publish {0} confirmed messages".format(opts.count))
+    for lag in opts.lags:
+        dt = run(opts.count, lag)
+        print("ack every {0:>6} msgs: {1:8.3f} sec, {2:10.0f} msg/sec".format(
+            lag, dt, opts.count / dt))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,114 @@
+# coding: utf-8
+
+from __future__ import print_function, division
+
+"""
+Runs `AMQPService` against in-process `fakeamqp.FakeBroker` and reports
+publish throughput, confirm latency and consume throughput.
+No RabbitMQ is needed, numbers show overhead of twoost & pika only.
+"""
+
+import sys
+import time
+import argparse
+
+from twisted.internet import defer, task
+
+from twoost import amqp, fakeamqp, timed
+
+
+QUEUE = 'bench_loop'
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+@defer.inlineCallbacks
+def bench_publish(client, count, confirm):
+    t0 = time.time()
+    yield defer.gatherResults([
+        client.publishMessage('', QUEUE, "message", confirm=confirm)
+        for _ in xrange(count)
+    ])
+    defer.returnValue(time.time() - t0)
+
+
+@defer.inlineCallbacks
+def bench_confirm_latency(client, count):
+    latencies = []
+    for _ in xrange(count):
+        t0 = time.time()
+        yield client.publishMessage('', QUEUE, "message", confirm=True)
+        latencies.append(time.time() - t0)
+    defer.returnValue(latencies)
+
+
+@defer.inlineCallbacks
+def bench_consume(client, count, parallel):
+
+    done = defer.Deferred()
+    received = [0]
+
+    def on_message(_):
+        received[0] += 1
+        if received[0] == count:
+            done.callback(None)
+
+    t0 = time.time()
+    qc = client.setupQueueConsuming(
+        QUEUE, on_message, deserialize=False, parallel=parallel)
+    yield done
+    dt = time.time() - t0
+    yield qc.stopService()
+    defer.returnValue(dt)
+
+
+@defer.inlineCallbacks
+def run(reactor, opts):
+
+    broker = fakeamqp.FakeBroker()
+    endpoint = fakeamqp.FakeBrokerEndpoint(broker)
+    params = {'schema': {'queue': {QUEUE: {}}}}
+    client = amqp.AMQPService(endpoint, amqp.AMQPFactory(**params), **params)
+    client.startService()
+    yield timed.sleep(0.2)
+
+    for confirm in (False, True):
+        dt = yield bench_publish(client, opts.count, confirm)
+        print("publish {0:>6} msgs, confirm={1!s:5}: {2:8.3f} sec, {3:10.0f} msg/sec".format(
+            opts.count, confirm, dt, opts.count / dt))
+
+    latencies = yield bench_confirm_latency(client, opts.latency_count)
+    print("confirm latency (ms): p50 {0:.3f}, p99 {1:.3f}, max {2:.3f}".format(
+        percentile(latencies, 0.5) * 1000,
+        percentile(latencies, 0.99) * 1000,
+        max(latencies) * 1000))
+
+    queued = len(broker.getQueue(QUEUE).messages)
+    for parallel in opts.parallel:
+        n = min(queued, opts.count)
+        dt = yield bench_consume(client, n, parallel)
+        queued -= n
+        print("consume {0:>6} msgs, parallel={1:>3}: {2:8.3f} sec, {3:10.0f} msg/sec".format(
+            n, parallel, dt, n / dt))
+        if not queued:
+            break
+
+    yield client.stopService()
+
+
+def main(args):
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--count', type=int, default=10000)
+    parser.add_argument('--latency-count', type=int, default=1000)
+    parser.add_argument('--parallel', type=int, nargs='+', default=[1, 10])
+    opts = parser.parse_args(args)
+
+    task.react(run, [opts])
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
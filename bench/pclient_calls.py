@@ -0,0 +1,73 @@
+# coding: utf-8
+
+from __future__ import print_function, division
+
+"""
+Measures overhead of `PersistentClientService` and
+`PooledPersistentClientService` proxied calls
+(like memcache `get`) against connected in-process protocols.
+"""
+
+import sys
+import time
+import argparse
+
+from twisted.internet import defer, protocol
+
+from twoost import pclient
+
+
+class _GetProtocol(protocol.Protocol):
+
+    def get(self, key):
+        return defer.succeed((0, key))
+
+
+def make_client(**params):
+    s = pclient.PersistentClientService(None, None, **params)
+    s.protocolProxiedMethods = ['get']
+    s.clientConnected(_GetProtocol())
+    return s
+
+
+def make_pool(**params):
+    s = pclient.PooledPersistentClientService(None, None, **params)
+    s.protocolProxiedMethods = ['get']
+    for c in s:
+        c.clientConnected(_GetProtocol())
+    return s
+
+
+def bench(fn, count):
+    t0 = time.time()
+    for i in xrange(count):
+        fn("key")
+    return time.time() - t0
+
+
+def main(args):
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--count', type=int, default=200000)
+    parser.add_argument('--pool-size', type=int, default=4)
+    opts = parser.parse_args(args)
+
+    for kind, make in [
+            ('single', make_client),
+            ('pool', lambda **kw: make_pool(pool_size=opts.pool_size, **kw)),
+    ]:
+        for callretry_delay in (0, 15):
+            s = make(callretry_delay=callretry_delay)
+            for name, fn in [
+                    ('protocolCall', lambda k: s.protocolCall('get', k)),
+                    ('proxy method', s.get),
+            ]:
+                dt = bench(fn, opts.count)
+                print(
+                    "{0:<6} {1:<13} callretry_delay={2:<3}: "
+                    "{3:8.3f} sec, {4:10.0f} calls/sec".format(
+                        kind, name, callretry_delay, dt, opts.count / dt))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -8,7 +8,12 @@ Simple Twisted-style abstraction around AMQP pika library.
 
 import json
 import uuid
+import zlib
+import hashlib
+import operator
 import functools
+import itertools
+import collections
 
 try:
     import msgpack
@@ -21,18 +26,29 @@ if not msgpack:
     except ImportError:
         pass
 
+try:
+    import lz4.frame as lz4
+except ImportError:
+    lz4 = None
+
+try:
+    import zstandard as zstd
+except ImportError:
+    zstd = None
+
 import zope.interface
 
-from twisted.internet import defer, reactor
+from twisted.internet import defer, reactor, task
 from twisted.internet.error import ConnectionDone
-from twisted.python import failure, components, reflect
+from twisted.python import components, reflect
 from twisted.application import service
 
 from pika.adapters.twisted_connection import TwistedProtocolConnection
+from pika import spec as _spec
 from pika.spec import BasicProperties as _BasicProperties
 from pika.connection import ConnectionParameters as _ConnectionParameters
 from pika.credentials import PlainCredentials as _PlainCredentials
-from pika.exceptions import MethodNotImplemented, ChannelClosed
+from pika.exceptions import MethodNotImplemented, ChannelClosed, ConnectionClosed
 
 from twoost import timed, pclient
 
@@ -44,8 +60,14 @@ logger = logging.getLogger(__name__)
 __all__ = [
     'AMQPMessage',
     'AMQPService',
+    'AMQPServiceGroup',
+    'ConsumersScheduler',
+    'DIRECT_REPLY_TO',
     'IAMQPSchema',
-    'IAMQPSchemaBuilder'
+    'IAMQPSchemaBuilder',
+    'MessageDedupCache',
+    'MsgpackSerializer',
+    'SerializersRegistry',
 ]
 
 
@@ -102,17 +124,54 @@ class IAMQPSchemaBuilder(zope.interface.Interface):
 
 # ---
 
+_DELIVER_FIELDS = (
+    'consumer_tag',
+    'delivery_tag',
+    'redelivered',
+    'exchange',
+    'routing_key',
+)
+
+_PROPERTIES_FIELDS = (
+    'content_type',
+    'content_encoding',
+    'headers',
+    'delivery_mode',
+    'priority',
+    'correlation_id',
+    'reply_to',
+    'expiration',
+    'message_id',
+    'timestamp',
+    'type',
+    'user_id',
+    'app_id',
+    'cluster_id',
+)
+
+_NOT_DECODED = object()
+
+
 class AMQPMessage(object):
 
+    """Incoming message. Body is kept as is, `data` is decoded on first access."""
+
+    __slots__ = ('body', 'deliver', 'properties', '_data')
+
     def __init__(self, body, deliver, properties):
         self.body = body
         self.deliver = deliver
         self.properties = properties
+        self._data = _NOT_DECODED
 
     @property
     def data(self):
-        self.data = deserialize(self.body, self.content_type)
-        return self.data
+        data = self._data
+        if data is _NOT_DECODED:
+            p = self.properties
+            data = self._data = deserialize(
+                self.body, p.content_type, content_encoding=p.content_encoding)
+        return data
 
     def __getattr__(self, name):
         try:
@@ -128,11 +187,19 @@ class AMQPMessage(object):
     def __dir__(self):
         r = list(set(self.properties.__dict__.keys()
                      + self.deliver.__dict__.keys()
-                     + self.__dict__.keys()))
+                     + ['body', 'deliver', 'properties', 'data']))
         r.sort()
         return r
 
 
+# plain properties instead of `__getattr__` lookup chain
+for _f in _DELIVER_FIELDS:
+    setattr(AMQPMessage, _f, property(operator.attrgetter('deliver.' + _f)))
+for _f in _PROPERTIES_FIELDS:
+    setattr(AMQPMessage, _f, property(operator.attrgetter('properties.' + _f)))
+del _f
+
+
 class _NopeSerializer(object):
 
     @staticmethod
@@ -144,13 +211,76 @@ class _NopeSerializer(object):
         return s
 
 
-MESSAGE_SERIALIZERS = {
+class MsgpackSerializer(object):
+
+    """Msgpack codec with explicit `use_bin_type` (keeps bytes/unicode apart)."""
+
+    def __init__(self, use_bin_type=True):
+        assert msgpack, "msgpack is not installed"
+        self.use_bin_type = use_bin_type
+        if msgpack.__name__ == 'umsgpack':
+            # umsgpack always keeps bytes/unicode apart
+            self.dumps = msgpack.packb
+            self.loads = msgpack.unpackb
+        elif not use_bin_type:
+            self.dumps = msgpack.packb
+            self.loads = msgpack.unpackb
+        elif msgpack.version >= (0, 5, 2):
+            self.dumps = functools.partial(msgpack.packb, use_bin_type=True)
+            self.loads = functools.partial(msgpack.unpackb, raw=False)
+        else:
+            self.dumps = functools.partial(msgpack.packb, use_bin_type=True)
+            self.loads = functools.partial(msgpack.unpackb, encoding='utf-8')
+
+
+class SerializersRegistry(object):
+
+    """Maps content types to codecs (objects with `loads` & `dumps`).
+
+    Lookups are cached by raw content type, so resolving codec for
+    already seen content type is a single dict access.
+
+    Fast codecs (e.g. ujson) are plugged in explicitly, like
+    `MESSAGE_SERIALIZERS.register('application/json', ujson)`.
+    """
+
+    def __init__(self, serializers=None):
+        self._serializers = {}
+        self._cache = {}
+        self.update(serializers or {})
+
+    def register(self, content_type, serializer):
+        assert hasattr(serializer, 'loads') and hasattr(serializer, 'dumps')
+        self._serializers[content_type.lower() if content_type else None] = serializer
+        self._cache.clear()
+
+    def update(self, serializers):
+        for content_type, serializer in dict(serializers).items():
+            self.register(content_type, serializer)
+
+    def lookup(self, content_type):
+        try:
+            return self._cache[content_type]
+        except KeyError:
+            pass
+        s = self._serializers[content_type.lower() if content_type else None]
+        self._cache[content_type] = s
+        return s
+
+    __getitem__ = lookup
+    __setitem__ = register
+
+    def __contains__(self, content_type):
+        return (content_type.lower() if content_type else None) in self._serializers
+
+
+MESSAGE_SERIALIZERS = SerializersRegistry({
     None: _NopeSerializer,
     'plain/text': _NopeSerializer,
     'application/octet-stream': _NopeSerializer,
     'json': json,
     'application/json': json,
-}
+})
 
 
 if msgpack:
@@ -161,36 +291,401 @@ if msgpack:
     })
 
 
-def deserialize(data, content_type):
-    logger.debug("deserialize data %r, content_type %r", data, content_type)
-    if not content_type:
+class _Codec(object):
+
+    def __init__(self, dumps, loads):
+        self.dumps = dumps
+        self.loads = loads
+
+
+def _gzipCompress(data):
+    c = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return c.compress(data) + c.flush()
+
+
+_zlibCodec = _Codec(zlib.compress, zlib.decompress)
+_gzipCodec = _Codec(_gzipCompress, lambda data: zlib.decompress(data, 16 + zlib.MAX_WBITS))
+
+
+# content_encoding => codec, unknown encodings (e.g. 'utf-8') are passed as is
+MESSAGE_ENCODINGS = SerializersRegistry({
+    'deflate': _zlibCodec,
+    'zlib': _zlibCodec,
+    'gzip': _gzipCodec,
+    'x-gzip': _gzipCodec,
+})
+
+if lz4:
+    MESSAGE_ENCODINGS['lz4'] = _Codec(lz4.compress, lz4.decompress)
+
+if zstd:
+    MESSAGE_ENCODINGS['zstd'] = _Codec(
+        zstd.ZstdCompressor().compress,
+        zstd.ZstdDecompressor().decompress)
+
+
+def encode(data, content_encoding):
+    if not content_encoding:
         return data
-    s = MESSAGE_SERIALIZERS[content_type.lower()]
-    return s.loads(data)
+    return MESSAGE_ENCODINGS.lookup(content_encoding).dumps(data)
+
+
+def decode(data, content_encoding):
+    if not content_encoding:
+        return data
+    try:
+        c = MESSAGE_ENCODINGS.lookup(content_encoding)
+    except KeyError:
+        return data
+    return c.loads(data)
 
 
-def serialize(data, content_type):
-    logger.debug("serialize data %r, content_type %r", data, content_type)
+def deserialize(data, content_type, serializer=None, content_encoding=None):
+    if content_encoding:
+        data = decode(data, content_encoding)
     if not content_type:
         return data
-    s = MESSAGE_SERIALIZERS[content_type.lower()]
-    return s.dumps(data)
+    s = serializer or MESSAGE_SERIALIZERS.lookup(content_type)
+    return s.loads(data)
+
+
+def serialize(data, content_type, serializer=None, content_encoding=None):
+    if content_type:
+        s = serializer or MESSAGE_SERIALIZERS.lookup(content_type)
+        data = s.dumps(data)
+    if content_encoding:
+        data = encode(data, content_encoding)
+    return data
 
 
 # ---
 
+# pseudo-queue for rabbitmq 'direct reply-to' (rpc replies without reply queue)
+DIRECT_REPLY_TO = 'amq.rabbitmq.reply-to'
+
+# number of failed attempts to process message (strategy `retry_dlx`)
+RETRY_ATTEMPTS_HEADER = 'x-twoost-attempts'
+
+
+def _hashKey(key):
+    # stable hash of routing key (crc32 of unicode fails on non-ascii)
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    return zlib.crc32(key or '')
+
+
+def retryQueueName(queue, delay):
+    return "%s.retry-%dms" % (queue, int(delay * 1000))
+
+
+def declareRetryQueue(builder, queue, delay, durable=True):
+    """Declare queue, which dead-letters messages back to `queue` after `delay` seconds."""
+    return builder.declareQueue(
+        queue=retryQueueName(queue, delay),
+        durable=durable,
+        message_ttl=int(delay * 1000),
+        dead_letter_exchange='',
+        dead_letter_exchange_rk=queue,
+    )
+
+
 class _PikaQueueUnconsumed(Exception):
-    pass
+
+    def __init__(self, drain_timeout=None):
+        Exception.__init__(self, drain_timeout)
+        self.drain_timeout = drain_timeout
+
+
+def _closePikaQueue(queue, reason):
+    # pika drops pending (prefetched) messages on close, but we have to nack them
+    pending = queue.pending
+    queue.close(reason)
+    queue.pending = pending
+
+
+def _waitDeferreds(ds, timeout, clock=None):
+    """Fires with True when all `ds` are fired or with False after `timeout`.
+
+    Unlike `timed.timeoutDeferred` doesn't cancel anything.
+    """
+    ds = list(ds)
+    if not ds:
+        return defer.succeed(True)
+
+    clock = clock or reactor
+    d = defer.Deferred()
+    timer = clock.callLater(timeout, d.callback, False)
+
+    def done(_):
+        if not d.called:
+            timer.cancel()
+            d.callback(True)
+
+    defer.DeferredList(ds).addCallback(done)
+    return d
 
 
 class _NotReadyForPublish(Exception):
     pass
 
 
+class _PublishNacked(Exception):
+    pass
+
+
+class _PublishChannel(object):
+
+    """Publish channel of the pool, tracks its own confirms."""
+
+    def __init__(self, channel, confirm):
+        self.channel = channel
+        self.confirm = confirm
+        self.delivery_tag_counter = 0
+        self.published = {}
+        # delivery tags grow monotonically, so `tags` is sorted
+        self.tags = collections.deque()
+
+    def __len__(self):
+        return len(self.published)
+
+    @property
+    def is_open(self):
+        return self.channel.is_open
+
+    def register(self):
+        self.delivery_tag_counter += 1
+        delivery_tag = self.delivery_tag_counter
+        d = defer.Deferred()
+        self.published[delivery_tag] = d
+        self.tags.append(delivery_tag)
+        return delivery_tag, d
+
+    def unregister(self, delivery_tag):
+        # message wasn't sent - give its tag back (the last one only)
+        assert delivery_tag == self.delivery_tag_counter
+        self.delivery_tag_counter -= 1
+        if self.tags and self.tags[-1] == delivery_tag:
+            self.tags.pop()
+        return self.published.pop(delivery_tag)
+
+    def settle(self, a):
+
+        delivery_tag = a.method.delivery_tag
+        method_name = type(a.method).__name__
+        ack = method_name == 'Ack'
+        tags = self.tags
+        pm = self.published
+
+        if a.method.multiple:
+            logger.debug("multiple confirm - method %r, delivery_tag %d",
+                         method_name, delivery_tag)
+            ds = []
+            # multiple confirm settles only prefix of the deque
+            while tags and tags[0] <= delivery_tag:
+                d = pm.pop(tags.popleft(), None)
+                if d is not None:
+                    ds.append(d)
+        else:
+            logger.debug("single confirm - method %r, delivery_tag %d",
+                         method_name, delivery_tag)
+            d = pm.pop(delivery_tag, None)
+            ds = [d] if d is not None else []
+            # drop tags already settled by out-of-order single confirms
+            while tags and tags[0] not in pm:
+                tags.popleft()
+
+        if ack:
+            for d in ds:
+                d.callback(None)
+        else:
+            for d in ds:
+                d.errback(_PublishNacked(delivery_tag))
+
+    def failAll(self, reason):
+        m2f = [self.published[t] for t in self.tags if t in self.published]
+        self.published.clear()
+        self.tags.clear()
+        for d in m2f:
+            d.errback(reason)
+
+
 class _SchemaBuilderProxy(components.proxyForInterface(IAMQPSchemaBuilder)):
     pass
 
 
+def _freezeArgs(x):
+    if isinstance(x, dict):
+        return tuple(sorted((k, _freezeArgs(v)) for k, v in x.items()))
+    if isinstance(x, (list, tuple)):
+        return tuple(map(_freezeArgs, x))
+    return x
+
+
+@zope.interface.implementer(IAMQPSchemaBuilder)
+class _SchemaRecorder(object):
+
+    """Records declarations of schema without talking to the broker.
+
+    Calls are grouped into phases (exchanges, queues, bindings), so
+    declarations of one phase may be sent to the broker concurrently.
+    Builder methods return nothing useful - schema can't depend on results
+    (e.g. names of server-named queues).
+    """
+
+    def __init__(self):
+        self.calls = []
+
+    def _record(self, phase, method, kwargs):
+        self.calls.append((phase, method, kwargs))
+        return defer.succeed(None)
+
+    def declareExchange(
+            self, exchange, exchange_type='direct', passive=False,
+            durable=False, auto_delete=False, internal=False, arguments=None):
+        return self._record(0, 'declareExchange', dict(
+            exchange=exchange, exchange_type=exchange_type, passive=passive,
+            durable=durable, auto_delete=auto_delete, internal=internal,
+            arguments=arguments))
+
+    def declareQueue(
+            self, queue, passive=False, durable=False,
+            message_ttl=None, dead_letter_exchange=None, dead_letter_exchange_rk=None,
+            exclusive=False, auto_delete=False, arguments=None):
+        return self._record(1, 'declareQueue', dict(
+            queue=queue, passive=passive, durable=durable,
+            message_ttl=message_ttl, dead_letter_exchange=dead_letter_exchange,
+            dead_letter_exchange_rk=dead_letter_exchange_rk,
+            exclusive=exclusive, auto_delete=auto_delete, arguments=arguments))
+
+    def bindQueue(self, exchange, queue, routing_key='', arguments=None):
+        return self._record(2, 'bindQueue', dict(
+            exchange=exchange, queue=queue,
+            routing_key=routing_key, arguments=arguments))
+
+    def bindExchange(self, source, destination, routing_key='', arguments=None):
+        return self._record(2, 'bindExchange', dict(
+            source=source, destination=destination,
+            routing_key=routing_key, arguments=arguments))
+
+    def phases(self):
+        ps = collections.OrderedDict()
+        for phase, method, kwargs in sorted(self.calls, key=operator.itemgetter(0)):
+            ps.setdefault(phase, []).append((method, kwargs))
+        return list(ps.values())
+
+    def fingerprint(self):
+        return hashlib.sha1(repr(_freezeArgs(self.calls))).hexdigest()
+
+
+class _ConsumerAutotuner(object):
+
+    """AIMD tuning of consumer parallelism & channel prefetch.
+
+    Halves both when callback latency grows above `latency_factor` times
+    the best seen one, otherwise adds a slot when prefetched messages
+    wait for callbacks or extends prefetch when callbacks wait for messages.
+    """
+
+    clock = reactor
+
+    def __init__(
+            self, channel, queue, parallel=1, prefetch_count=None,
+            parallel_min=1, parallel_max=64,
+            prefetch_min=1, prefetch_max=1000,
+            interval=1.0, latency_factor=2.0,
+    ):
+
+        assert 1 <= parallel_min <= parallel_max
+        assert 1 <= prefetch_min <= prefetch_max
+
+        self.channel = channel
+        self.queue = queue
+        self.parallel_min = parallel_min
+        self.parallel_max = parallel_max
+        self.prefetch_min = prefetch_min
+        self.prefetch_max = prefetch_max
+        self.interval = interval
+        self.latency_factor = latency_factor
+
+        self.parallel = self._clamp(parallel, parallel_min, parallel_max)
+        self.prefetch_count = self._clamp(
+            max(prefetch_count or 0, self.parallel), prefetch_min, prefetch_max)
+        self.semaphore = timed.ResizableSemaphore(self.parallel)
+
+        self.base_latency = None
+        self._completed = 0
+        self._latency_sum = 0.0
+        self._timer = None
+
+    @staticmethod
+    def _clamp(x, lo, hi):
+        return max(lo, min(hi, x))
+
+    def setupQos(self):
+        # one consumer per channel - channel-wide qos may be changed on the fly
+        return self.channel.basic_qos(prefetch_count=self.prefetch_count, all_channels=True)
+
+    def start(self):
+        self._timer = task.LoopingCall(self.tune)
+        self._timer.clock = self.clock
+        self._timer.start(self.interval, now=False)
+
+    def stop(self):
+        if self._timer is not None and self._timer.running:
+            self._timer.stop()
+        self._timer = None
+
+    def record(self, latency):
+        self._completed += 1
+        self._latency_sum += latency
+
+    def tune(self):
+
+        completed = self._completed
+        latency_sum = self._latency_sum
+        self._completed = 0
+        self._latency_sum = 0.0
+
+        if not completed:
+            return
+
+        latency = latency_sum / completed
+        if self.base_latency is None or latency < self.base_latency:
+            self.base_latency = latency
+        else:
+            # forget old best latency slowly
+            self.base_latency *= 1.01
+
+        parallel = self.parallel
+        prefetch = self.prefetch_count
+        pending = len(self.queue.pending)
+
+        if latency > self.base_latency * self.latency_factor:
+            parallel = parallel // 2
+            prefetch = prefetch // 2
+        elif pending and parallel < self.parallel_max:
+            parallel += 1
+        elif pending > parallel:
+            # can't run more callbacks - don't hoard messages
+            prefetch -= parallel
+        elif not pending:
+            prefetch += parallel
+
+        parallel = self._clamp(parallel, self.parallel_min, self.parallel_max)
+        prefetch = self._clamp(max(prefetch, parallel), self.prefetch_min, self.prefetch_max)
+
+        if parallel != self.parallel:
+            logger.debug("autotune: parallel %d -> %d", self.parallel, parallel)
+            self.parallel = parallel
+            self.semaphore.resize(parallel)
+
+        if prefetch != self.prefetch_count:
+            logger.debug("autotune: prefetch %d -> %d", self.prefetch_count, prefetch)
+            self.prefetch_count = prefetch
+            d = defer.maybeDeferred(self.setupQos)
+            d.addErrback(lambda f: logger.error("fail to update qos: %s", f.value))
+
+
 class _AMQPProtocol(TwistedProtocolConnection, pclient.PersistentClientProtocol):
 
     ON_ERROR_STRATEGIES = (
@@ -199,6 +694,7 @@ class _AMQPProtocol(TwistedProtocolConnection, pclient.PersistentClientProtocol)
         'reject',           # reject all messages (with delay `requeue_delay`)
         'requeue_hold',     # hold only *redelivered* messages until reconnect
         'do_nothing',       # do nothing - hold *all* messages until reconnect
+        'retry_dlx',        # ack & republish to retry queue (ttl `requeue_delay`)
     )
 
     # strategy_name => (reque/reject on first error, requeue/reject on second error)
@@ -210,8 +706,19 @@ class _AMQPProtocol(TwistedProtocolConnection, pclient.PersistentClientProtocol)
         'do_nothing': (None, None),
     }
 
+    PUBLISH_CHANNEL_SELECTORS = (
+        'round_robin',
+        'rk_hash',      # same routing key - same channel (keeps order)
+    )
+
     __consumer_tag_cnt = 0
 
+    # list of marshaled frames, used to coalesce writes of batched publishes
+    _frames_buffer = None
+
+    # max time to wait for 'Basic.ConsumeOk' frame
+    consume_ok_timeout = 30
+
     def __init__(
             self,
             parameters,
@@ -220,6 +727,15 @@ class _AMQPProtocol(TwistedProtocolConnection, pclient.PersistentClientProtocol)
             prefetch_count=None,
             requeue_delay=None,
             requeue_max_count=None,
+            max_unconfirmed=None,
+            requeue_tick=None,
+            retry_max_attempts=None,
+            publish_channels=None,
+            publish_channel_selector=None,
+            schema_channels=None,
+            schema_cache=False,
+            compression=None,
+            compression_threshold=None,
             **kwargs
     ):
 
@@ -233,63 +749,158 @@ class _AMQPProtocol(TwistedProtocolConnection, pclient.PersistentClientProtocol)
         self.prefetch_count = prefetch_count
 
         assert not on_error or on_error in self.ON_ERROR_STRATEGIES
-        self.on_error = on_error or 'requeue'
+        self.on_error = on_error or 'requeue_once'
         self.requeue_max_count = requeue_max_count if requeue_max_count is not None else 50000
         self.requeue_delay = requeue_delay if requeue_delay is not None else 120
+        self.max_unconfirmed = max_unconfirmed
+        self.retry_max_attempts = retry_max_attempts if retry_max_attempts is not None else 10
+        self.publish_channels = publish_channels or 1
+        assert (not publish_channel_selector or
+                publish_channel_selector in self.PUBLISH_CHANNEL_SELECTORS)
+        self.publish_channel_selector = publish_channel_selector or 'round_robin'
+        # concurrent declaration is opt-in: recorded schema gets no results
+        self.schema_channels = schema_channels or 0
+        self.schema_cache = schema_cache
+        assert not compression or compression in MESSAGE_ENCODINGS, compression
+        self.compression = compression
+        self.compression_threshold = (
+            compression_threshold if compression_threshold is not None else 1024)
 
         # -- state
-        self._published_messages = {}
+        self._write_channels = []
+        self._safewrite_channels = []
+        self._publish_rr_counter = 0
+        self._publish_waiters = collections.deque()
+        self._publish_blocked = False
         self._consumer_state = {}
+        # state of cancelled consumers until their in-flight messages are settled
+        self._draining_consumers = {}
+        # consumer_tag -> {delivery_tag: channel}
         self._delayed_requeue_tasks = {}
+        # consumer_tag -> number of failed messages held until reconnect
+        self._held_messages = {}
+        # one timer for all delayed rejects, grouped by `requeue_tick` seconds
+        self._delayed_rejects = timed.BucketScheduler(
+            tick=(requeue_tick or 1.0),
+            clock=self.clock,
+            run_calls=self._runDelayedRejects,
+        )
         self._ready_for_publish = False
 
     def connectionMade(self):
         logger.debug("amqp connection was made")
         TwistedProtocolConnection.connectionMade(self)
+        if hasattr(self, 'add_on_connection_blocked_callback'):
+            # pika >= 0.10
+            self.add_on_connection_blocked_callback(self._onConnectionBlocked)
+            self.add_on_connection_unblocked_callback(self._onConnectionUnblocked)
         self.ready.addCallback(lambda _: self.handshakingMade())
         self.ready.addErrback(self.handshakingFailed)
 
     def handshakingFailed(self, f):
         logger.error("handshaking with %r failed - disconnect due to %s", self.virtual_host, f)
         self.transport.loseConnection()
-        self.protocolFailed(failure)
+        self.protocolFailed(f)
+
+    @property
+    def _write_channel(self):
+        # first channel of the pool is used for schema declaration too
+        return self._write_channels[0].channel if self._write_channels else None
 
     @defer.inlineCallbacks
-    def _open_write_channel(self):
-        self._write_channel = yield self.channel()
-        self._write_channel.add_on_close_callback(self._on_write_channel_closed)
-        logger.debug("open channel (write) %r " % self._write_channel)
+    def _open_publish_channel(self, pool, index, confirm):
+        ch = yield self.channel()
+        pc = _PublishChannel(ch, confirm)
+        if confirm:
+            yield ch.confirm_delivery(callback=functools.partial(self._onPublishConfirm, pc))
+        ch.add_on_close_callback(
+            functools.partial(self._on_publish_channel_closed, pool, index, pc))
+        logger.debug("open channel (%s) %r", "safe write" if confirm else "write", ch)
+        if index < len(pool):
+            pool[index] = pc
+        else:
+            pool.append(pc)
 
     @defer.inlineCallbacks
-    def _open_safewrite_channel(self):
+    def _open_publish_channels(self):
+        for i in range(self.publish_channels):
+            yield self._open_publish_channel(self._write_channels, i, confirm=False)
         try:
-            self._safewrite_channel = yield self.channel()
-            self._publish_delivery_tag_counter = 0
-            yield self._safewrite_channel.confirm_delivery(callback=self._onPublishConfirm)
+            for i in range(self.publish_channels):
+                yield self._open_publish_channel(self._safewrite_channels, i, confirm=True)
         except MethodNotImplemented:
             logger.warning("server doesn't support 'confirm delivery'")
-            self._safewrite_channel = None
-        else:
-            self._safewrite_channel.add_on_close_callback(self._on_safewrite_channel_closed)
-            logger.debug("open channel (safe write) %r" % self._safewrite_channel)
+            del self._safewrite_channels[:]
 
     @defer.inlineCallbacks
     def handshakingMade(self):
         logger.info("handshaking with %r was made", self.virtual_host)
 
-        yield self._open_write_channel()
-        yield self._open_safewrite_channel()
+        yield self._open_publish_channels()
 
         if self.schema:
             logger.debug("declare schema...")
-            yield defer.maybeDeferred(
-                IAMQPSchema(self.schema).declareSchema,
-                _SchemaBuilderProxy(self))
+            yield self._declareSchema()
             logger.debug("amqp schema has been declared")
 
         self._ready_for_publish = True
         self.protocolReady()
 
+    def _brokerNode(self):
+        sp = self.server_properties or {}
+        return (
+            str(self.transport.getPeer()),
+            self.virtual_host,
+            sp.get('cluster_name'),
+            sp.get('version'),
+        )
+
+    @defer.inlineCallbacks
+    def _declareSchema(self):
+
+        schema = loadSchema(self.schema)
+        if not self.schema_channels and not self.schema_cache:
+            # sequential, builder returns results of broker calls
+            yield defer.maybeDeferred(schema.declareSchema, _SchemaBuilderProxy(self))
+            return
+
+        recorder = _SchemaRecorder()
+        yield defer.maybeDeferred(schema.declareSchema, recorder)
+        if not recorder.calls:
+            return
+
+        fingerprint = recorder.fingerprint()
+        node = self._brokerNode()
+        declared = getattr(self.factory, '_declared_schemas', None)
+        if self.schema_cache and declared is not None and declared.get(node) == fingerprint:
+            logger.info("schema %s was already declared on %r - skip", fingerprint, node)
+            return
+
+        yield self._runSchemaPhases(recorder.phases())
+        if declared is not None:
+            declared[node] = fingerprint
+
+    @defer.inlineCallbacks
+    def _runSchemaPhases(self, phases):
+
+        # pika waits for reply before next sync call on the same channel,
+        # so concurrency of declarations is number of channels
+        n = min(self.schema_channels or 1, max(map(len, phases)))
+        channels = yield defer.gatherResults([self.channel() for _ in range(n)])
+        logger.debug("declare schema in %d phases via %d channels", len(phases), n)
+
+        try:
+            for calls in phases:
+                yield defer.gatherResults([
+                    getattr(self, method)(channel=channels[i % n], **kwargs)
+                    for i, (method, kwargs) in enumerate(calls)
+                ], consumeErrors=True).addErrback(
+                    lambda f: f.value.subFailure if f.check(defer.FirstError) else f)
+        finally:
+            for ch in channels:
+                if ch.is_open:
+                    ch.close()
+
     def _on_consuming_channel_closed(self, ct, channel, reply_code, reply_text):
         logger.error(
             "server closed channel, ct %r, reply_code %s, reply_text %s!",
@@ -304,41 +915,97 @@ class _AMQPProtocol(TwistedProtocolConnection, pclient.PersistentClientProtocol)
             no_ack=s['no_ack'],
             consumer_tag=ct,
             parallel=s['parallel'],
+            requeue_delay=s['requeue_delay'],
+            on_error=s['on_error'],
+            batch_size=s['batch_size'],
+            batch_timeout=s['batch_timeout'],
+            autotune=s['autotune'],
+            prefetch_count=s['prefetch_count'],
+            prefetch_global=s['prefetch_global'],
+            priority=s.get('priority'),
             **s.get('kwargs', {})
         )
 
-    def _on_write_channel_closed(self, channel, reply_code, reply_text):
+    @defer.inlineCallbacks
+    def _on_publish_channel_closed(self, pool, index, pc, channel, reply_code, reply_text):
         logger.error(
-            "server closed write channel, reply_code %s, reply_text %s!",
-            reply_code, reply_text)
-        # just print warn & reopen channel
-        return self._open_write_channel()
+            "server closed publish channel #%d, reply_code %s, reply_text %s!",
+            index, reply_code, reply_text)
+        if index >= len(pool) or pool[index] is not pc:
+            return
+        # delivery tags are per-channel - drop all before reopening
+        pc.failAll(ChannelClosed(reply_code, reply_text))
+        if self.is_closed:
+            return
+        yield self._open_publish_channel(pool, index, pc.confirm)
+        self._releasePublishWaiters()
 
-    @defer.inlineCallbacks
-    def _on_safewrite_channel_closed(self, channel, reply_code, reply_text):
-        yield self._open_safewrite_channel()
-        self._fail_published_messages(ChannelClosed(reply_code, reply_text))
+    def _selectPublishChannel(self, confirm, routing_key):
 
-    def _onPublishConfirm(self, a):
+        pool = self._safewrite_channels if confirm else self._write_channels
+        n = len(pool)
+        if not n:
+            if confirm:
+                raise MethodNotImplemented("server doesn't support 'puslish confirm'")
+            raise _NotReadyForPublish("no open channels")
 
-        delivery_tag = a.method.delivery_tag
-        method_name = type(a.method).__name__
-        ack = method_name == 'Ack'
-        deferred_method = (defer.Deferred.callback if ack else defer.Deferred.errback)
-
-        if a.method.multiple:
-            logger.debug("multiple confirm - method %r, delivery_tag %d ...",
-                         method_name, delivery_tag)
-            for k in list(self._published_messages):
-                if k <= delivery_tag:
-                    logger.debug("confirm - method %r, delivery_tag %d", method_name, k)
-                    d = self._published_messages.pop(k)
-                    deferred_method(d, None)
+        if self.publish_channel_selector == 'rk_hash':
+            i = _hashKey(routing_key) % n
         else:
-            logger.debug("single confirm - method %r, delivery_tag %d",
-                         method_name, delivery_tag)
-            d = self._published_messages.pop(delivery_tag)
-            deferred_method(d, None)
+            self._publish_rr_counter += 1
+            i = self._publish_rr_counter % n
+
+        # skip channels being reopened
+        for k in range(n):
+            pc = pool[(i + k) % n]
+            if pc.is_open:
+                return pc
+        raise _NotReadyForPublish("all publish channels are closed")
+
+    def _unconfirmedCount(self):
+        return sum(len(pc) for pc in self._safewrite_channels)
+
+    def _onPublishConfirm(self, pc, a):
+        pc.settle(a)
+        if self._publish_waiters:
+            self._releasePublishWaiters()
+
+    # --- publisher flow control
+
+    def _onConnectionBlocked(self, method_frame):
+        logger.warning("connection blocked by broker: %r", method_frame)
+        self._publish_blocked = True
+
+    def _onConnectionUnblocked(self, method_frame):
+        logger.info("connection unblocked by broker")
+        self._publish_blocked = False
+        self._releasePublishWaiters()
+
+    def _publishMustWait(self, confirm, count=1):
+        return self._publish_blocked or (
+            confirm and
+            self.max_unconfirmed and
+            self._unconfirmedCount() + count > self.max_unconfirmed)
+
+    def _waitForPublishWindow(self, confirm, count=1):
+        d = defer.Deferred()
+        self._publish_waiters.append((confirm, count, d))
+        logger.debug("wait for publish window, %d publishers waiting",
+                     len(self._publish_waiters))
+        return d
+
+    def _releasePublishWaiters(self):
+        # waiter callbacks publish synchronously, so window shrinks during loop
+        waiters = self._publish_waiters
+        while waiters and not self._publishMustWait(*waiters[0][:2]):
+            _, _, d = waiters.popleft()
+            d.callback(None)
+
+    def _fail_publish_waiters(self, reason):
+        waiters = list(self._publish_waiters)
+        self._publish_waiters.clear()
+        for _, _, d in waiters:
+            d.errback(reason)
 
     def connectionLost(self, reason):
 
@@ -347,6 +1014,7 @@ class _AMQPProtocol(TwistedProtocolConnection, pclient.PersistentClientProtocol)
 
         cstates = list(self._consumer_state.items())
         self._consumer_state.clear()
+        self._draining_consumers.clear()
 
         for ct, cstate in cstates:
             queue_obj = cstate['queue_obj']
@@ -359,55 +1027,217 @@ class _AMQPProtocol(TwistedProtocolConnection, pclient.PersistentClientProtocol)
                 queue_obj.close(reason)
 
         self._fail_published_messages(reason)
+        self._fail_publish_waiters(reason)
+        self._delayed_requeue_tasks.clear()
+        self._held_messages.clear()
+        self._delayed_rejects.cancelAll()
         TwistedProtocolConnection.connectionLost(self, reason)
 
     def _fail_published_messages(self, reason):
-        m2f = list(self._published_messages.itervalues())
-        self._published_messages.clear()
-        for d in m2f:
-            d.errback(reason)
+        for pc in self._safewrite_channels:
+            pc.failAll(reason)
+
+    def _send_frame(self, frame_value):
+        if self._frames_buffer is None:
+            return TwistedProtocolConnection._send_frame(self, frame_value)
+        if self.is_closed:
+            raise ConnectionClosed
+        marshaled_frame = frame_value.marshal()
+        self.bytes_sent += len(marshaled_frame)
+        self.frames_sent += 1
+        self._frames_buffer.append(marshaled_frame)
+
+    def _flushFrames(self):
+        frames = self._frames_buffer
+        self._frames_buffer = None
+        if frames:
+            self.transport.writeSequence(frames)
+
+    def _buildProperties(self, content_type, message_ttl, properties):
+        p = _BasicProperties(**(properties or {}))
+        if content_type:
+            p.content_type = content_type
+        if message_ttl is not None:
+            p.expiration = str(int(message_ttl))
+        return p
+
+    def _compressionFor(self, properties, content_encoding):
+        # body with explicit 'content_encoding' property is already encoded
+        if properties and properties.get('content_encoding'):
+            return None
+        return content_encoding or self.compression
 
     def publishMessage(
             self, exchange, routing_key, body,
             message_ttl=None,
-            content_type=None, properties=None, confirm=True):
+            content_type=None, properties=None, confirm=True,
+            serializer=None, content_encoding=None):
 
         if not self._ready_for_publish:
             raise _NotReadyForPublish("not ready for publish - channel in wrong state")
 
-        data = serialize(body, content_type)
-        logger.debug("publish message, msg %r, exhange %r, rk %r, props %r",
-                     data, exchange, routing_key, properties)
+        if self._publish_waiters or self._publishMustWait(confirm):
+            return self._waitForPublishWindow(confirm).addCallback(
+                lambda _: self._publishMessage(
+                    exchange, routing_key, body,
+                    message_ttl, content_type, properties, confirm, serializer,
+                    content_encoding))
 
-        p = _BasicProperties(**(properties or {}))
-        if content_type:
-            p.content_type = content_type
-        if message_ttl is not None:
-            p.expiration = str(int(message_ttl))
+        return self._publishMessage(
+            exchange, routing_key, body,
+            message_ttl, content_type, properties, confirm, serializer,
+            content_encoding)
+
+    def _publishMessage(
+            self, exchange, routing_key, body,
+            message_ttl, content_type, properties, confirm, serializer,
+            content_encoding=None):
+
+        if not self._ready_for_publish:
+            raise _NotReadyForPublish("not ready for publish - channel in wrong state")
+
+        data = serialize(body, content_type, serializer)
+        p = self._buildProperties(content_type, message_ttl, properties)
+
+        # small messages are sent as is - compression doesn't pay off
+        encoding = self._compressionFor(properties, content_encoding)
+        if encoding and len(data) >= self.compression_threshold:
+            data = encode(data, encoding)
+            p.content_encoding = encoding
 
-        if confirm and self._safewrite_channel is not None:
-            self._publish_delivery_tag_counter += 1
-            delivery_tag = self._publish_delivery_tag_counter
-            d = defer.Deferred()
-            self._published_messages[delivery_tag] = d
-            logger.debug("safe-publish, exc %r, rk %r: %r", exchange, routing_key, data)
-            self._safewrite_channel.basic_publish(exchange, routing_key, data, properties=p)
-            logger.debug("delivery tag is %r", delivery_tag)
+        pc = self._selectPublishChannel(confirm, routing_key)
+
+        if confirm:
+            delivery_tag, d = pc.register()
+            logger.debug("safe-publish, exc %r, rk %r, dt %r", exchange, routing_key, delivery_tag)
+            pc.channel.basic_publish(exchange, routing_key, data, properties=p)
             return d
-        elif confirm:
-            raise MethodNotImplemented("server doesn't support 'puslish confirm'")
         else:
-            self._write_channel.basic_publish(exchange, routing_key, data, properties=p)
+            logger.debug("publish, exc %r, rk %r", exchange, routing_key)
+            pc.channel.basic_publish(exchange, routing_key, data, properties=p)
             return defer.succeed(None)
 
-    @defer.inlineCallbacks  # noqa
-    def _queueCounsumingLoop(self, consumer_tag, queue, callback, no_ack, parallel=0):
+    def publishMessages(
+            self, exchange, messages,
+            message_ttl=None,
+            content_type=None, properties=None, confirm=True,
+            serializer=None, content_encoding=None):
+        """Publish list of `(routing_key, body)` pairs with one transport write.
+
+        Returns deferred list of `(success, result)` pairs (one per message).
+        Whole batch fails when connection is lost before all confirms arrive.
+        Batch waits for free slots of `max_unconfirmed` window for all its
+        messages, batch bigger than the window is published by chunks.
+        """
+
+        if not self._ready_for_publish:
+            raise _NotReadyForPublish("not ready for publish - channel in wrong state")
+
+        window = self.max_unconfirmed if confirm else 0
+        if window and len(messages) > window:
+            # chunks wait for the window one after another (waiters are fifo)
+            ds = [
+                defer.maybeDeferred(
+                    self.publishMessages, exchange, messages[i:i + window],
+                    message_ttl=message_ttl, content_type=content_type,
+                    properties=properties, confirm=confirm,
+                    serializer=serializer, content_encoding=content_encoding)
+                for i in range(0, len(messages), window)
+            ]
+            return defer.gatherResults(ds, consumeErrors=True).addCallbacks(
+                lambda rs: list(itertools.chain.from_iterable(rs)),
+                lambda f: f.value.subFailure if f.check(defer.FirstError) else f)
+
+        count = len(messages)
+        if self._publish_waiters or self._publishMustWait(confirm, count):
+            return self._waitForPublishWindow(confirm, count).addCallback(
+                lambda _: self._publishMessages(
+                    exchange, messages,
+                    message_ttl, content_type, properties, confirm, serializer,
+                    content_encoding))
+
+        return self._publishMessages(
+            exchange, messages,
+            message_ttl, content_type, properties, confirm, serializer,
+            content_encoding)
+
+    def _publishMessages(
+            self, exchange, messages,
+            message_ttl, content_type, properties, confirm, serializer,
+            content_encoding=None):
+
+        if not self._ready_for_publish:
+            raise _NotReadyForPublish("not ready for publish - channel in wrong state")
+
+        if confirm and not self._safewrite_channels:
+            raise MethodNotImplemented("server doesn't support 'puslish confirm'")
+
+        # serialize everything before first write - batch is published atomically
+        if content_type and serializer is None:
+            serializer = MESSAGE_SERIALIZERS.lookup(content_type)
+        rks_and_data = [(rk, serialize(body, content_type, serializer)) for rk, body in messages]
+        logger.debug("publish %d messages, exchange %r, props %r",
+                     len(rks_and_data), exchange, properties)
 
-        if parallel >= 0:
+        p = self._buildProperties(content_type, message_ttl, properties)
+        ds = []
+
+        encoding = self._compressionFor(properties, content_encoding)
+        if encoding:
+            p_enc = self._buildProperties(content_type, message_ttl, properties)
+            p_enc.content_encoding = encoding
+            threshold = self.compression_threshold
+
+        self._frames_buffer = []
+        registered = []
+        try:
+            for routing_key, data in rks_and_data:
+                pc = self._selectPublishChannel(confirm, routing_key)
+                if confirm:
+                    tag, d = pc.register()
+                    registered.append((pc, tag))
+                    ds.append(d)
+                if encoding and len(data) >= threshold:
+                    pc.channel.basic_publish(
+                        exchange, routing_key, encode(data, encoding), properties=p_enc)
+                else:
+                    pc.channel.basic_publish(exchange, routing_key, data, properties=p)
+        except Exception as e:
+            # nothing of the batch is sent - drop frames & confirms of earlier messages
+            self._frames_buffer = None
+            for pc, tag in reversed(registered):
+                d = pc.unregister(tag)
+                d.errback(e)
+                d.addErrback(lambda _: None)  # error is raised to the caller
+            raise
+        self._flushFrames()
+
+        if not confirm:
+            return defer.succeed([(True, None)] * len(rks_and_data))
+
+        def check_connection_lost(results):
+            for success, result in results:
+                if not success and result.check(ConnectionDone):
+                    return result
+            return results
+
+        return defer.DeferredList(ds, consumeErrors=True).addCallback(check_connection_lost)
+
+    @defer.inlineCallbacks  # noqa
+    def _queueCounsumingLoop(
+            self, consumer_tag, queue, callback, no_ack, parallel=0,
+            batch_size=None, batch_timeout=None, autotuner=None):
+
+        if autotuner:
+            semaphore = autotuner.semaphore
+            autotuner.start()
+        elif parallel >= 0:
             semaphore = defer.DeferredSemaphore(tokens=(parallel or 1))
         else:
             semaphore = None
         connection_done = False
+        drain_timeout = None
+        inflight = set()
 
         while 1:
 
@@ -418,8 +1248,9 @@ class _AMQPProtocol(TwistedProtocolConnection, pclient.PersistentClientProtocol)
 
             try:
                 msg = yield queue.get()
-            except _PikaQueueUnconsumed:
+            except _PikaQueueUnconsumed as e:
                 logger.debug("stop consuming loop - queue unconsumed, ct %s", consumer_tag)
+                drain_timeout = e.drain_timeout
                 break
             except ConnectionDone as e:
                 connection_done = True
@@ -433,7 +1264,19 @@ class _AMQPProtocol(TwistedProtocolConnection, pclient.PersistentClientProtocol)
                 logger.debug("found terminator %r in pika queue %s", msg, consumer_tag)
                 break
 
-            d = self._processIncomingMessage(msg, queue, callback, no_ack)
+            if batch_size:
+                msgs = yield self._collectMessagesBatch(queue, msg, batch_size, batch_timeout)
+                started = self.clock.seconds()
+                d = self._processIncomingMessagesBatch(msgs, queue, callback, no_ack)
+            else:
+                started = self.clock.seconds()
+                d = self._processIncomingMessage(msg, queue, callback, no_ack)
+
+            if autotuner:
+                def record_latency(x, started=started):
+                    autotuner.record(self.clock.seconds() - started)
+                    return x
+                d.addBoth(record_latency)
 
             if semaphore:
                 def after(x):
@@ -441,9 +1284,24 @@ class _AMQPProtocol(TwistedProtocolConnection, pclient.PersistentClientProtocol)
                     return x
                 d.addBoth(after)
 
+            def settled(x, d=d):
+                inflight.discard(d)
+                return x
+
+            inflight.add(d)
+            d.addBoth(settled)
+
+        if autotuner:
+            autotuner.stop()
+
+        if inflight and drain_timeout:
+            logger.debug("wait for %d in-flight msgs, ct %s", len(inflight), consumer_tag)
+            yield _waitDeferreds(inflight, drain_timeout, self.clock)
+
         self._cleanupConsumingQueue(
             consumer_tag, queue,
             do_reject=(not connection_done and not no_ack),
+            drained=bool(drain_timeout and not inflight),
         )
 
         if not queue.closed:
@@ -452,27 +1310,39 @@ class _AMQPProtocol(TwistedProtocolConnection, pclient.PersistentClientProtocol)
 
         logger.debug("queue consuming loop stopped, consumer_tag %r", consumer_tag)
 
-    def _cleanupConsumingQueue(self, consumer_tag, queue, do_reject=True):
+    def _cleanupConsumingQueue(self, consumer_tag, queue, do_reject=True, drained=False):
 
         logger.debug("clear consuming state for queue %r", queue)
-        queue_pending = queue.pending[:]
+        queue_pending = [m for m in queue.pending if m]
         del queue.pending[:]
 
-        if do_reject:
-            for ch, deliver, _, _ in queue_pending:
-                dt = deliver.delivery_tag
-                logger.debug("nack message, delivery tag %r", dt)
-                ch.basic_reject(delivery_tag=dt)
-
         rej_tasks = self._delayed_requeue_tasks.pop(consumer_tag, {})
-        for dt, (t, ch) in rej_tasks.items():
-            if do_reject:
-                t.cancel()
+        for dt in rej_tasks:
+            self._delayed_rejects.cancel((consumer_tag, dt))
+
+        to_reject = [(m[0], m[1].delivery_tag) for m in queue_pending]
+        to_reject.extend((ch, dt) for dt, ch in rej_tasks.items())
+
+        # after drain only prefetched messages are unsettled, unless some
+        # failed ones are held or wait for delayed reject
+        held = self._held_messages.pop(consumer_tag, 0)
+        multiple = drained and not rej_tasks and not held
+
+        if not do_reject:
+            logger.debug("skip nacking of %d messages", len(to_reject))
+        elif multiple and to_reject:
+            # consumer has own channel, so all its unsettled messages are nacked at once
+            ch, dt = max(to_reject, key=operator.itemgetter(1))
+            logger.debug("nack %d messages, delivery tag %r", len(to_reject), dt)
+            if ch.is_open:
+                ch.basic_nack(delivery_tag=dt, multiple=True, requeue=True)
+        else:
+            for ch, dt in to_reject:
+                if not ch.is_open:
+                    logger.debug("channel is closed - skip nack, delivery tag %r", dt)
+                    continue
                 logger.debug("nack message, delivery tag %r", dt)
                 ch.basic_reject(delivery_tag=dt)
-            else:
-                t.cancel()
-                logger.debug("cancel nacking task, delivery tag %r", dt)
 
         logger.debug("consuming state for queue %r was cleared", queue)
 
@@ -481,15 +1351,9 @@ class _AMQPProtocol(TwistedProtocolConnection, pclient.PersistentClientProtocol)
         ch, deliver, props, body = msg
         delivery_tag = deliver.delivery_tag
         amqp_msg = AMQPMessage(deliver=deliver, properties=props, body=body)
-        logger.debug(
-            "incoming message, body %r, queue %r, delivery_tag %r",
-            body, queue, delivery_tag)
+        logger.debug("incoming message, queue %r, delivery_tag %r", queue, delivery_tag)
 
         d = defer.maybeDeferred(callback, amqp_msg)
-        logger.debug(
-            "incoming message, body %r, queue %r,"
-            "delivery_tag %r - callback invoked...",
-            body, queue, delivery_tag)
 
         def err(e):
             logger.error("fail to process msg %r - error %s", msg, e)
@@ -498,7 +1362,8 @@ class _AMQPProtocol(TwistedProtocolConnection, pclient.PersistentClientProtocol)
             if e.check(ConnectionDone):
                 logger.debug("no active connection - we can't nack message")
             else:
-                self._handleFailedIncomingMessage(ch, amqp_msg)
+                # 'retry_dlx' returns deferred (message is settled after republish)
+                return self._handleFailedIncomingMessage(ch, amqp_msg)
 
         def ack(x):
             if not no_ack:
@@ -508,18 +1373,113 @@ class _AMQPProtocol(TwistedProtocolConnection, pclient.PersistentClientProtocol)
         d.addCallbacks(ack, err)
         return d
 
+    @defer.inlineCallbacks
+    def _collectMessagesBatch(self, queue, msg, batch_size, batch_timeout):
+
+        msgs = [msg]
+        deadline = self.clock.seconds() + (batch_timeout or 0)
+
+        while len(msgs) < batch_size:
+
+            if queue.pending:
+                msg = queue.pending.pop(0)
+            else:
+                timeout = deadline - self.clock.seconds()
+                if timeout <= 0:
+                    break
+                try:
+                    msg = yield timed.timeoutDeferred(queue.get(), timeout)
+                except Exception:
+                    # timeout or closed queue - consuming loop handles the latter
+                    break
+
+            if not msg:
+                # keep terminator for consuming loop
+                queue.pending.insert(0, msg)
+                break
+
+            msgs.append(msg)
+
+        defer.returnValue(msgs)
+
+    def _processIncomingMessagesBatch(self, msgs, queue, callback, no_ack):
+
+        ch = msgs[0][0]
+        amqp_msgs = [
+            AMQPMessage(deliver=deliver, properties=props, body=body)
+            for _, deliver, props, body in msgs
+        ]
+        delivery_tags = [m.delivery_tag for m in amqp_msgs]
+        consumer_tag = amqp_msgs[0].consumer_tag
+        logger.debug("incoming batch of %d messages, queue %r, delivery_tags %r..%r",
+                     len(msgs), queue, delivery_tags[0], delivery_tags[-1])
+
+        cstate = self._consumerState(consumer_tag)
+        unsettled = cstate.get('unsettled') if cstate else None
+        if unsettled is not None and not no_ack:
+            for dt in delivery_tags:
+                unsettled[dt] = True
+
+        d = defer.maybeDeferred(callback, amqp_msgs)
+
+        def err(e):
+            logger.error("fail to process batch of %d msgs - error %s", len(msgs), e)
+            if no_ack:
+                return None
+            if e.check(ConnectionDone):
+                logger.debug("no active connection - we can't nack messages")
+            else:
+                ds = [self._handleFailedIncomingMessage(ch, m) for m in amqp_msgs]
+                ds = [x for x in ds if x is not None]
+                if ds:
+                    return defer.gatherResults(ds)
+
+        def ack(x):
+            if not no_ack:
+                self._ackMessagesBatch(ch, unsettled, delivery_tags)
+
+        d.addCallbacks(ack, err)
+        return d
+
+    def _ackMessagesBatch(self, ch, unsettled, delivery_tags):
+        # one consumer per channel & batch is a run of consecutive deliveries,
+        # so `multiple` ack is safe when there are no older unsettled messages
+        if unsettled is not None and next(iter(unsettled), None) == delivery_tags[0]:
+            logger.debug("send multiple ack, delivery tag %r", delivery_tags[-1])
+            ch.basic_ack(delivery_tags[-1], multiple=True)
+        else:
+            logger.debug("send acks, delivery tags %r..%r", delivery_tags[0], delivery_tags[-1])
+            for dt in delivery_tags:
+                ch.basic_ack(dt)
+        if unsettled is not None:
+            for dt in delivery_tags:
+                unsettled.pop(dt, None)
+
+    def _settleFailedMessage(self, cstate, delivery_tag):
+        unsettled = cstate.get('unsettled') if cstate else None
+        if unsettled is not None:
+            unsettled.pop(delivery_tag, None)
+
+    def _consumerState(self, consumer_tag):
+        return (self._consumer_state.get(consumer_tag)
+                or self._draining_consumers.get(consumer_tag))
+
     def _handleFailedIncomingMessage(self, ch, msg):
 
         delivery_tag = msg.delivery_tag
         consumer_tag = msg.consumer_tag
         redelivered = msg.redelivered
 
-        cstate = self._consumer_state[consumer_tag]
+        cstate = self._consumerState(consumer_tag)
         if not cstate:
             logger.debug("no consumer state for ct %r - skip msg failure", consumer_tag)
+            self._holdFailedMessage(consumer_tag)
             return
 
         on_error_strategy = cstate.get('on_error') or self.on_error
+        if on_error_strategy == 'retry_dlx':
+            return self._retryFailedMessage(ch, cstate, msg)
+
         on_error_requeue = self._on_error_strategy_alg[on_error_strategy][int(redelivered)]
 
         rej_tasks_count = len(self._delayed_requeue_tasks.get(consumer_tag, ()))
@@ -527,41 +1487,118 @@ class _AMQPProtocol(TwistedProtocolConnection, pclient.PersistentClientProtocol)
 
         if on_error_requeue is None:
             logger.debug("eat message failure, dtag %r, msg %r", delivery_tag, msg)
+            self._holdFailedMessage(consumer_tag)
             return
 
         elif not on_error_requeue and too_many_rejs:
             logger.error("reject message without delay: %r", msg)
             ch.basic_reject(delivery_tag, requeue=False)
+            self._settleFailedMessage(cstate, delivery_tag)
 
         elif on_error_requeue and too_many_rejs:
             logger.error("requeue message without delay: %r", msg)
             ch.basic_reject(delivery_tag, requeue=True)
+            self._settleFailedMessage(cstate, delivery_tag)
 
         else:
             msg_requeue_delay = cstate.get('requeue_delay') or self.requeue_delay
             
             logger.debug("schedule reject/requeue for dt %r", delivery_tag)
-            cstate = self._consumer_state.get(consumer_tag)
 
             if msg_requeue_delay:
-                def reject_message():
-                    logger.debug("reject/requeue message, dt %r", delivery_tag)
-                    ch.basic_reject(delivery_tag, requeue=on_error_requeue)
-                    m = self._delayed_requeue_tasks.get(consumer_tag)
-                    if m is not None:
-                        m.pop(delivery_tag, None)
-                    if m is not None and not m:
-                        del self._delayed_requeue_tasks[consumer_tag]
-
                 fmrt = self._delayed_requeue_tasks.setdefault(consumer_tag, {})
                 assert delivery_tag not in fmrt
-                t = self.clock.callLater(msg_requeue_delay, reject_message)
-                fmrt[delivery_tag] = t, ch
-                logger.debug("fmrt task is %r, dt %r", t, delivery_tag)
+                fmrt[delivery_tag] = ch
+                self._delayed_rejects.schedule(
+                    msg_requeue_delay, (consumer_tag, delivery_tag),
+                    self._rejectDelayedMessage,
+                    ch, cstate, consumer_tag, delivery_tag, on_error_requeue)
 
             else:
                 logger.debug("reject message, dt %r", delivery_tag)
                 ch.basic_reject(delivery_tag, requeue=on_error_requeue)
+                self._settleFailedMessage(cstate, delivery_tag)
+
+    def _holdFailedMessage(self, consumer_tag):
+        # message stays unsettled until reconnect
+        self._held_messages[consumer_tag] = self._held_messages.get(consumer_tag, 0) + 1
+
+    def _retryDelay(self, requeue_delay):
+        return requeue_delay if requeue_delay is not None else self.requeue_delay
+
+    def _retryFailedMessage(self, ch, cstate, msg):
+
+        delivery_tag = msg.delivery_tag
+        props = dict(
+            (f, getattr(msg.properties, f)) for f in _PROPERTIES_FIELDS
+            if getattr(msg.properties, f) is not None)
+        # ttl of retry queue is used instead
+        props.pop('expiration', None)
+
+        headers = dict(props.get('headers') or {})
+        attempts = int(headers.get(RETRY_ATTEMPTS_HEADER) or 0) + 1
+
+        if attempts > self.retry_max_attempts:
+            logger.error("message failed %d times - reject it: %r", attempts - 1, msg)
+            ch.basic_reject(delivery_tag, requeue=False)
+            self._settleFailedMessage(cstate, delivery_tag)
+            return
+
+        headers[RETRY_ATTEMPTS_HEADER] = attempts
+        props['headers'] = headers
+        retry_queue = retryQueueName(
+            cstate['queue'], self._retryDelay(cstate.get('requeue_delay')))
+        logger.debug("retry message, dt %r, attempt %d, via %r", delivery_tag, attempts, retry_queue)
+
+        d = defer.maybeDeferred(
+            self.publishMessage, '', retry_queue, msg.body,
+            content_type=props.pop('content_type', None), properties=props,
+            serializer=_NopeSerializer)
+
+        def published(_):
+            if ch.is_open:
+                ch.basic_ack(delivery_tag)
+            self._settleFailedMessage(cstate, delivery_tag)
+
+        def failed(f):
+            logger.error("fail to republish msg to %r - requeue it: %s", retry_queue, f.value)
+            if ch.is_open:
+                ch.basic_reject(delivery_tag, requeue=True)
+            self._settleFailedMessage(cstate, delivery_tag)
+
+        d.addCallbacks(published, failed)
+        return d
+
+    def _rejectDelayedMessage(self, ch, cstate, consumer_tag, delivery_tag, requeue):
+        logger.debug("reject/requeue message, dt %r", delivery_tag)
+        m = self._delayed_requeue_tasks.get(consumer_tag)
+        if m is not None:
+            m.pop(delivery_tag, None)
+            if not m:
+                del self._delayed_requeue_tasks[consumer_tag]
+        ch.basic_reject(delivery_tag, requeue=requeue)
+        self._settleFailedMessage(cstate, delivery_tag)
+
+    def _runDelayedRejects(self, calls):
+        logger.debug("send %d delayed rejects", len(calls))
+        # all rejects of one tick are written at once
+        self._frames_buffer = []
+        try:
+            for fn, args in calls:
+                try:
+                    fn(*args)
+                except Exception:
+                    logger.exception("fail to reject message")
+        finally:
+            self._flushFrames()
+
+    def delayedRejectsStats(self):
+        """Count of delayed rejects (failed messages waiting for reject/requeue)."""
+        return {
+            'pending': len(self._delayed_rejects),
+            'consumers': dict(
+                (ct, len(dts)) for ct, dts in self._delayed_requeue_tasks.items()),
+        }
 
     def _generateConsumerTag(self):
         type(self).__consumer_tag_cnt += 1
@@ -572,22 +1609,73 @@ class _AMQPProtocol(TwistedProtocolConnection, pclient.PersistentClientProtocol)
             self, queue='', callback=None, no_ack=False,
             requeue_delay=None, on_error=None,
             consumer_tag=None, parallel=0,
+            batch_size=None, batch_timeout=None,
+            autotune=None,
+            prefetch_count=None, prefetch_global=False,
+            priority=None,
             **kwargs):
 
         assert callback
         logger.info("consume queue '%s/%s'", self.virtual_host, queue)
         consumer_tag = consumer_tag or self._generateConsumerTag()
 
+        if prefetch_count is None:
+            prefetch_count = self.prefetch_count
+
+        if (on_error or self.on_error) == 'retry_dlx':
+            yield declareRetryQueue(self, queue, self._retryDelay(requeue_delay))
+
         ch = yield self.channel()
-        if self.prefetch_count is not None:
-            logger.debug("set qos prefetch_count to %d", self.prefetch_count)
-            yield ch.basic_qos(prefetch_count=self.prefetch_count, all_channels=0)
+
+        if autotune:
+            autotuner = _ConsumerAutotuner(
+                ch, None,
+                parallel=(parallel or 1),
+                prefetch_count=prefetch_count,
+                **(autotune if isinstance(autotune, dict) else {}))
+            logger.debug("set initial qos prefetch_count to %d", autotuner.prefetch_count)
+            yield autotuner.setupQos()
+        else:
+            autotuner = None
+            if prefetch_count is not None:
+                logger.debug(
+                    "set qos prefetch_count to %d (global %r)",
+                    prefetch_count, prefetch_global)
+                yield ch.basic_qos(
+                    prefetch_count=prefetch_count,
+                    all_channels=bool(prefetch_global))
+
+        # pika doesn't wait 'ConsumeOk' frame itself
+        consume_ok = defer.Deferred()
+        ch.callbacks.add(
+            ch.channel_number, _spec.Basic.ConsumeOk, consume_ok.callback,
+            True, None, {'consumer_tag': consumer_tag})
+
+        def consume_failed(channel, reply_code, reply_text):
+            if not consume_ok.called:
+                consume_ok.errback(ChannelClosed(reply_code, reply_text))
+
+        ch.add_on_close_callback(consume_failed)
+
+        consume_kwargs = dict(kwargs)
+        if priority is not None:
+            # broker prefers consumers with higher priority
+            consume_kwargs['arguments'] = dict(kwargs.get('arguments') or {})
+            consume_kwargs['arguments']['x-priority'] = int(priority)
 
         queue_obj, ct = yield ch.basic_consume(
             queue=queue, no_ack=no_ack, consumer_tag=consumer_tag,
-            **kwargs)
+            **consume_kwargs)
         assert ct == consumer_tag
 
+        try:
+            yield timed.timeoutDeferred(consume_ok, self.consume_ok_timeout)
+        except Exception:
+            logger.error("no 'ConsumeOk' for ct %r - close channel", ct)
+            if ch.is_open:
+                ch.close()
+            raise
+
         ch.add_on_close_callback(functools.partial(self._on_consuming_channel_closed, ct))
         logger.debug("open channel (read) %r for ct %r", ch, ct)
 
@@ -602,18 +1690,26 @@ class _AMQPProtocol(TwistedProtocolConnection, pclient.PersistentClientProtocol)
             queue=queue,
             requeue_delay=requeue_delay,
             on_error=on_error,
+            batch_size=batch_size,
+            batch_timeout=batch_timeout,
+            autotune=autotune,
+            autotuner=autotuner,
+            prefetch_count=prefetch_count,
+            prefetch_global=prefetch_global,
+            priority=priority,
+            # delivered, but not acked/rejected messages (for `multiple` acks)
+            unsettled=(collections.OrderedDict() if batch_size else None),
         )
 
-        # pika don't wait 'ConsumeOk' message
-        # HACK-1: run consuming-loop a bit later to avoid races
-        self.clock.callLater(
-            0.05, self._queueCounsumingLoop,
+        if autotuner:
+            autotuner.queue = queue_obj
+
+        self._consumer_state[ct]['loop'] = self._queueCounsumingLoop(
             ct, queue_obj, callback, no_ack=no_ack, parallel=parallel,
+            batch_size=batch_size, batch_timeout=batch_timeout,
+            autotuner=autotuner,
         )
 
-        # HACK-2: simulate waiting of 'ConsumeOk'
-        yield timed.sleep(0.1)
-
         logger.debug("consumer tag is %r", consumer_tag)
         defer.returnValue(ct)
 
@@ -625,7 +1721,17 @@ class _AMQPProtocol(TwistedProtocolConnection, pclient.PersistentClientProtocol)
             bind_arguments=None, queue_arguments=None,
             requeue_delay=None,
             on_error=None,
+            batch_size=None,
+            batch_timeout=None,
+            autotune=None,
+            prefetch_count=None,
+            prefetch_global=False,
+            priority=None,
     ):
+        if (on_error or self.on_error) == 'retry_dlx':
+            # durable retry queue would outlive exclusive queue (new one on each reconnect)
+            raise ValueError("on_error 'retry_dlx' is not supported for exchange consuming")
+
         consumer_tag = consumer_tag or self._generateConsumerTag()
 
         logger.debug("declare exclusive queue")
@@ -655,18 +1761,40 @@ class _AMQPProtocol(TwistedProtocolConnection, pclient.PersistentClientProtocol)
             no_ack=no_ack,
             requeue_delay=requeue_delay,
             on_error=on_error,
+            batch_size=batch_size,
+            batch_timeout=batch_timeout,
+            autotune=autotune,
+            prefetch_count=prefetch_count,
+            prefetch_global=prefetch_global,
+            priority=priority,
         )
 
         defer.returnValue(ct)
 
     @defer.inlineCallbacks
-    def cancelConsuming(self, consumer_tag):
+    def cancelConsuming(self, consumer_tag, drain_timeout=None):
+        """Stops consuming.
+
+        With `drain_timeout` waits (no more than `drain_timeout` seconds)
+        for in-flight messages, then nacks prefetched ones at once.
+        """
 
         logger.debug("cancel consuming, consumer_tag %s", consumer_tag)
 
         cstate = self._consumer_state.pop(consumer_tag, {})
         ch = cstate.get('channel')
 
+        loop = cstate.get('loop')
+        if loop is not None:
+            # failures of in-flight messages are still handled by consumer settings
+            self._draining_consumers[consumer_tag] = cstate
+
+            def drained(x):
+                if self._draining_consumers.get(consumer_tag) is cstate:
+                    del self._draining_consumers[consumer_tag]
+                return x
+            loop.addBoth(drained)
+
         if ch:
             logger.debug("send basic.cancel method, ct %r", consumer_tag)
             c = yield ch.basic_cancel(consumer_tag=consumer_tag)
@@ -682,18 +1810,56 @@ class _AMQPProtocol(TwistedProtocolConnection, pclient.PersistentClientProtocol)
                 queue_obj.put(None)
             else:
                 logger.debug("close pika queue %r", queue_obj)
-                queue_obj.close(_PikaQueueUnconsumed())
+                _closePikaQueue(queue_obj, _PikaQueueUnconsumed(drain_timeout))
         else:
             logger.debug("no queue_obj for ct %r", consumer_tag)
 
+        if drain_timeout and loop is not None:
+            logger.debug("wait consuming loop to drain, ct %r", consumer_tag)
+            try:
+                yield loop
+            except Exception:
+                logger.exception("consuming loop failed, ct %r", consumer_tag)
+
         defer.returnValue(c)
 
+    # direct reply-to
+
+    @defer.inlineCallbacks
+    def openReplyChannel(self, callback):
+        """Opens channel consuming `DIRECT_REPLY_TO` pseudo-queue.
+
+        Requests with `reply_to=DIRECT_REPLY_TO` must be published via
+        returned channel, `callback` is called for each reply (`AMQPMessage`).
+        """
+        ch = yield self.channel()
+        queue_obj, ct = yield ch.basic_consume(queue=DIRECT_REPLY_TO, no_ack=True)
+        logger.debug("consume direct replies, ct %r, channel %r", ct, ch)
+        self._repliesLoop(queue_obj, callback)
+        defer.returnValue(ch)
+
+    @defer.inlineCallbacks
+    def _repliesLoop(self, queue_obj, callback):
+        while 1:
+            try:
+                msg = yield queue_obj.get()
+            except Exception as e:
+                logger.debug("stop replies loop - %r", e)
+                break
+            if not msg:
+                break
+            _, deliver, props, body = msg
+            try:
+                callback(AMQPMessage(deliver=deliver, properties=props, body=body))
+            except Exception:
+                logger.exception("reply callback failed")
+
     # declare schema
 
     def declareQueue(
             self, queue, passive=False, durable=False,
             message_ttl=None, dead_letter_exchange=None, dead_letter_exchange_rk=None,
-            exclusive=False, auto_delete=False, arguments=None):
+            exclusive=False, auto_delete=False, arguments=None, channel=None):
 
         logger.info(
             "declare queue '%s/%s' (passive=%d, "
@@ -711,14 +1877,15 @@ class _AMQPProtocol(TwistedProtocolConnection, pclient.PersistentClientProtocol)
             if dead_letter_exchange_rk:
                 arguments['x-dead-letter-routing-key'] = dead_letter_exchange_rk
 
-        return self._write_channel.queue_declare(
+        return (channel or self._write_channel).queue_declare(
             queue=queue, passive=passive, durable=durable, exclusive=exclusive,
             auto_delete=auto_delete, arguments=arguments,
         )
 
     def declareExchange(
             self, exchange, exchange_type='direct', passive=False,
-            durable=False, auto_delete=False, internal=False, arguments=None):
+            durable=False, auto_delete=False, internal=False, arguments=None,
+            channel=None):
 
         logger.info(
             "declare exchange '%s/%s': type=%r, passive=%d, "
@@ -726,28 +1893,32 @@ class _AMQPProtocol(TwistedProtocolConnection, pclient.PersistentClientProtocol)
             self.virtual_host,
             exchange, exchange_type, passive, durable, auto_delete, internal)
 
-        return self._write_channel.exchange_declare(
+        return (channel or self._write_channel).exchange_declare(
             exchange=exchange, passive=passive,
             durable=durable, exchange_type=exchange_type,
             auto_delete=auto_delete, arguments=arguments, internal=internal)
 
-    def bindQueue(self, exchange, queue, routing_key='', arguments=None):
+    def bindQueue(self, exchange, queue, routing_key='', arguments=None, channel=None):
         logger.info(
             "bind exchange '%s/%s' to queue %r, routing key %r",
             self.virtual_host, exchange, queue, routing_key)
 
-        return self._write_channel.queue_bind(
+        return (channel or self._write_channel).queue_bind(
             queue=queue, exchange=exchange,
             routing_key=routing_key, arguments=arguments)
 
-    def bindExchange(self, source, destination, routing_key='', arguments=None):
+    def bindExchange(self, source, destination, routing_key='', arguments=None, channel=None):
         logger.info(
             "bind exchange '%s/%s' to exchange %r, routing key %r",
-            destination, source, routing_key)
-        return self._write_channel.exchange_bind(
-            self.virtual_host,
+            self.virtual_host, source, destination, routing_key)
+
+        # pika 0.9 doesn't wrap `exchange_bind` into deferred
+        d = defer.Deferred()
+        r = (channel or self._write_channel).exchange_bind(
+            callback=d.callback,
             destination=destination, source=source,
             routing_key=routing_key, arguments=arguments)
+        return r if isinstance(r, defer.Deferred) else d
 
     def logPrefix(self):
         return 'amqp'
@@ -768,6 +1939,15 @@ class AMQPFactory(pclient.PersistentClientFactory):
             prefetch_count=None,
             requeue_delay=120,
             on_error=None,
+            max_unconfirmed=None,
+            requeue_tick=None,
+            retry_max_attempts=None,
+            publish_channels=None,
+            publish_channel_selector=None,
+            schema_channels=None,
+            schema_cache=False,
+            compression=None,
+            compression_threshold=None,
             **kwargs
     ):
         # defaults for _AMQPProtocol
@@ -775,6 +1955,18 @@ class AMQPFactory(pclient.PersistentClientFactory):
         self.prefetch_count = prefetch_count
         self.on_error = on_error
         self.requeue_delay = requeue_delay
+        self.max_unconfirmed = max_unconfirmed
+        self.requeue_tick = requeue_tick
+        self.retry_max_attempts = retry_max_attempts
+        self.publish_channels = publish_channels
+        self.publish_channel_selector = publish_channel_selector
+        self.schema_channels = schema_channels
+        self.schema_cache = schema_cache
+        self.compression = compression
+        self.compression_threshold = compression_threshold
+
+        # broker node => fingerprint of declared schema, survives reconnects
+        self._declared_schemas = {}
 
         self._protocol_parameters = {
             'virtual_host': vhost,
@@ -805,6 +1997,15 @@ class AMQPFactory(pclient.PersistentClientFactory):
             prefetch_count=self.prefetch_count,
             requeue_delay=self.requeue_delay,
             on_error=self.on_error,
+            max_unconfirmed=self.max_unconfirmed,
+            requeue_tick=self.requeue_tick,
+            retry_max_attempts=self.retry_max_attempts,
+            publish_channels=self.publish_channels,
+            publish_channel_selector=self.publish_channel_selector,
+            schema_channels=self.schema_channels,
+            schema_cache=self.schema_cache,
+            compression=self.compression,
+            compression_threshold=self.compression_threshold,
         )
         p.factory = self
         self._protocol_instance = p
@@ -826,7 +2027,7 @@ class schemaFromDict(object):
     """Loads AMQP schema from python dict."""
 
     def __init__(self, config):
-        ks = set(config.keys()) - set(['exchange', 'queue', 'bind'])
+        ks = set(config.keys()) - set(['exchange', 'queue', 'bind', 'bind_exchange'])
         if ks:
             raise ValueError("Invalid schema dict: unexpected keys %r", ks)
         self.config = config
@@ -844,8 +2045,11 @@ class schemaFromDict(object):
             yield builder.declareExchange(exchange=exchange, **props)
 
         for queue, props in self.config.get('queue', {}).items():
-            props = props or {}
+            props = dict(props or {})
+            retry_delay = props.pop('retry_delay', None)
             yield builder.declareQueue(queue=queue, **props)
+            if retry_delay is not None:
+                yield declareRetryQueue(builder, queue, retry_delay)
 
         for bind in self.config.get('bind', ()):
             if isinstance(bind, (tuple, list)):
@@ -873,6 +2077,191 @@ def loadSchema(schema):
 
 # --- integration with app-framework
 
+class MessageDedupCache(object):
+
+    """Keys of processed messages - bounded LRU set with TTL.
+
+    When `memcache` client (e.g. `MemCacheService` client) is given keys are
+    also stored there, so other processes skip already processed messages.
+    Cache may be shared by several consumers.
+    """
+
+    clock = reactor
+
+    def __init__(self, max_size=10000, ttl=3600, memcache=None, key_prefix='twoost-dedup:'):
+        assert max_size > 0
+        self.max_size = max_size
+        self.ttl = ttl
+        self.memcache = memcache
+        self.key_prefix = key_prefix
+        self.hits = 0
+        # key => expiration time, oldest first
+        self._keys = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._keys)
+
+    def _localContains(self, key):
+        expires_at = self._keys.pop(key, None)
+        if expires_at is None:
+            return False
+        if expires_at <= self.clock.seconds():
+            return False
+        # move to the end - recently used
+        self._keys[key] = expires_at
+        return True
+
+    def contains(self, key):
+        """Returns bool or deferred bool (local miss, memcache lookup)."""
+
+        if self._localContains(key):
+            self.hits += 1
+            return True
+        if self.memcache is None:
+            return False
+
+        def got(result):
+            _, value = result
+            if value is None:
+                return False
+            self.hits += 1
+            self._addLocal(key)
+            return True
+
+        def failed(f):
+            logger.error("dedup cache: memcache lookup failed: %s", f.value)
+            return False
+
+        return self.memcache.get(self.key_prefix + key).addCallbacks(got, failed)
+
+    def _addLocal(self, key):
+        keys = self._keys
+        keys.pop(key, None)
+        keys[key] = self.clock.seconds() + self.ttl
+        while len(keys) > self.max_size:
+            keys.popitem(last=False)
+
+    def add(self, key):
+        self._addLocal(key)
+        if self.memcache is not None:
+            self.memcache.set(self.key_prefix + key, "1", expireTime=int(self.ttl)).addErrback(
+                lambda f: logger.error("dedup cache: memcache store failed: %s", f.value))
+
+
+class _SchedulerShare(object):
+
+    __slots__ = ('weight', 'min_share', 'active', 'waiters', 'last_served', 'registered')
+
+    def __init__(self):
+        self.active = 0
+        self.waiters = collections.deque()
+        self.last_served = 0
+
+
+class ConsumersScheduler(object):
+
+    """Shared limit of concurrent callbacks for several consumers.
+
+    Free slot goes to waiting consumer with the least `active / weight`.
+    Each consumer has `min_share` reserved slots, so flood on one queue
+    can't take all slots from others.
+    """
+
+    def __init__(self, limit):
+        assert limit > 0
+        self.limit = limit
+        self.active = 0
+        self._shares = {}
+        self._served = 0
+
+    def register(self, consumer, weight=1, min_share=0):
+        assert weight > 0 and min_share >= 0
+        s = self._shares.get(consumer) or _SchedulerShare()
+        s.weight = weight
+        s.min_share = min_share
+        s.registered = True
+        self._shares[consumer] = s
+        assert sum(x.min_share for x in self._shares.values() if x.registered) <= self.limit, \
+            "sum of min shares exceeds limit"
+
+    def unregister(self, consumer):
+        s = self._shares.get(consumer)
+        if s is None:
+            return
+        s.registered = False
+        waiters = list(s.waiters)
+        s.waiters.clear()
+        for d in waiters:
+            d.errback(defer.CancelledError())
+        if not s.active:
+            del self._shares[consumer]
+        self._dispatch()
+
+    def acquire(self, consumer):
+        s = self._shares[consumer]
+
+        def cancel(d):
+            if d in s.waiters:
+                s.waiters.remove(d)
+                d.errback(defer.CancelledError())
+
+        d = defer.Deferred(cancel)
+        s.waiters.append(d)
+        self._dispatch()
+        return d
+
+    def release(self, consumer):
+        s = self._shares[consumer]
+        s.active -= 1
+        self.active -= 1
+        if not s.registered and not s.active:
+            del self._shares[consumer]
+        self._dispatch()
+
+    def run(self, consumer, f, *args, **kwargs):
+
+        def release(x):
+            self.release(consumer)
+            return x
+
+        return self.acquire(consumer).addCallback(
+            lambda _: defer.maybeDeferred(f, *args, **kwargs).addBoth(release))
+
+    def _dispatch(self):
+
+        while self.active < self.limit:
+
+            shares = [s for s in self._shares.values() if s.registered]
+            reserved = sum(max(0, s.min_share - s.active) for s in shares)
+            best = best_key = None
+
+            for s in shares:
+                if not s.waiters:
+                    continue
+                own_reserved = max(0, s.min_share - s.active)
+                if not own_reserved and self.active + reserved >= self.limit:
+                    continue
+                key = (not own_reserved, s.active / s.weight, s.last_served)
+                if best is None or key < best_key:
+                    best, best_key = s, key
+
+            if best is None:
+                return
+
+            best.active += 1
+            self.active += 1
+            self._served += 1
+            best.last_served = self._served
+            best.waiters.popleft().callback(None)
+
+    def stats(self):
+        return {
+            'limit': self.limit,
+            'active': self.active,
+            'waiting': sum(len(s.waiters) for s in self._shares.values()),
+        }
+
+
 class _BaseConsumer(service.Service):
 
     cancel_consuming_timeout = 10
@@ -888,14 +2277,42 @@ class _BaseConsumer(service.Service):
             deserialize=True,
             requeue_delay=None,
             on_error=None,
+            serializers=None,
+            batch_size=None,
+            batch_timeout=None,
+            autotune=None,
+            prefetch_count=None,
+            prefetch_global=False,
+            dedup=None,
+            dedup_key=None,
+            priority=None,
+            scheduler=None,
+            weight=1,
+            min_share=0,
+            drain_timeout=None,
     ):
 
         self.callback = callback
         self.deserialize = deserialize
+        self.serializers = serializers or MESSAGE_SERIALIZERS
         self.parallel = parallel
         self.no_ack = no_ack
         self.requeue_delay = requeue_delay
         self.on_error = on_error
+        self.batch_size = batch_size
+        self.batch_timeout = batch_timeout
+        self.autotune = autotune
+        self.prefetch_count = prefetch_count
+        self.prefetch_global = prefetch_global
+        self.dedup = dedup
+        self.dedup_key = dedup_key or operator.attrgetter('message_id')
+        # key of message being processed (not in `dedup` yet) => waiting duplicates
+        self._dedup_inflight = {}
+        self.priority = priority
+        self.scheduler = scheduler
+        self.weight = weight
+        self.min_share = min_share
+        self.drain_timeout = drain_timeout
         self._active_callbacks = {}
         self._active_callbacks_cnt = 0
         self._consume_deferred = None
@@ -930,6 +2347,8 @@ class _BaseConsumer(service.Service):
             return
         logger.debug("start service %s", self)
         service.Service.startService(self)
+        if self.scheduler is not None:
+            self.scheduler.register(self, self.weight, self.min_share)
         p = self.parent.amqp_service.getProtocol()
         if p:
             self.clientProtocolReady(p)
@@ -949,23 +2368,30 @@ class _BaseConsumer(service.Service):
             except Exception:
                 logger.exception("upps")
 
-            logger.debug("too quick consume-unconsume - sleep for 0.5 sec")
-            yield timed.sleep(0.5)
-
         logger.debug("stop service %s", self)
         p1 = self._protocol_instance
         p2 = self.parent.amqp_service.getProtocol()
+        drain_timeout = self.drain_timeout
+        started = reactor.seconds()
 
         if p1 is p2 and self.consumer_tag:
             logger.debug("protocol didn't change - cancel consuming")
-            d = p1.cancelConsuming(self.consumer_tag)
-            timed.timeoutDeferred(d, self.cancel_consuming_timeout)
+            d = p1.cancelConsuming(self.consumer_tag, drain_timeout=drain_timeout)
+            timed.timeoutDeferred(d, self.cancel_consuming_timeout + (drain_timeout or 0))
             try:
                 yield d
             except Exception:
                 logger.exception("Can't cancel consuming")
 
+        if drain_timeout and self._active_callbacks:
+            left = drain_timeout - (reactor.seconds() - started)
+            if left > 0:
+                logger.debug("wait for %d active callbacks", len(self._active_callbacks))
+                yield _waitDeferreds(self._active_callbacks.values(), left)
+
         yield self._cancelActiveCallbacks()
+        if self.scheduler is not None:
+            self.scheduler.unregister(self)
         yield defer.maybeDeferred(service.Service.stopService, self)
 
     def clientProtocolReady(self, protocol):
@@ -993,8 +2419,15 @@ class _BaseConsumer(service.Service):
         self.consumer_tag = None
         self._consume_deferred = None
 
-    def onMessage(self, msg):
-        logger.debug("receive message %r", msg)
+    def _decodeMessage(self, msg):
+        if self.deserialize:
+            ct = msg.content_type
+            body = decode(msg.body, msg.content_encoding)
+            return self.serializers.lookup(ct).loads(body) if ct else body
+        else:
+            return msg
+
+    def _runCallback(self, data):
 
         self._active_callbacks_cnt += 1
         cid = self._active_callbacks_cnt
@@ -1003,10 +2436,132 @@ class _BaseConsumer(service.Service):
             self._active_callbacks.pop(cid, None)
             return x
 
-        data = deserialize(msg.body, msg.content_type) if self.deserialize else msg
-        d = self._active_callbacks[cid] = defer.maybeDeferred(self.callback, data)
+        if self.scheduler is not None:
+            d = self.scheduler.run(self, self.callback, data)
+        else:
+            d = defer.maybeDeferred(self.callback, data)
+        self._active_callbacks[cid] = d
         return d.addBoth(remove_ac)
 
+    def onMessage(self, msg):
+        if self.dedup is None:
+            return self._runCallback(self._decodeMessage(msg))
+
+        key = self.dedup_key(msg)
+        if key is None:
+            return self._runCallback(self._decodeMessage(msg))
+
+        if key in self._dedup_inflight:
+            logger.debug("message %r is in progress - wait for it", key)
+            return self._waitInflight(key, self.onMessage, msg)
+
+        self._dedup_inflight[key] = []
+        seen = self.dedup.contains(key)
+        if isinstance(seen, defer.Deferred):
+            d = seen.addCallback(self._onMessageChecked, msg, key)
+        else:
+            d = self._onMessageChecked(seen, msg, key)
+        return d.addCallbacks(
+            self._inflightSucceeded, self._inflightFailed,
+            callbackArgs=([key],), errbackArgs=([key],))
+
+    def _onMessageChecked(self, seen, msg, key):
+        if seen:
+            logger.debug("skip already processed message %r", key)
+            return defer.succeed(None)
+        d = self._runCallback(self._decodeMessage(msg))
+        return d.addCallback(self._markProcessed, [key])
+
+    def _markProcessed(self, result, keys):
+        for key in keys:
+            if key is not None:
+                self.dedup.add(key)
+        return result
+
+    def _waitInflight(self, key, process, msg):
+        # duplicate is settled after the original one: skipped
+        # when the original succeeds, processed when it fails
+        d = defer.Deferred()
+        self._dedup_inflight[key].append((d, process, msg))
+        return d
+
+    def _inflightSucceeded(self, result, keys):
+        for key in keys:
+            for d, _, _ in self._dedup_inflight.pop(key, ()):
+                d.callback(None)
+        return result
+
+    def _inflightFailed(self, f, keys):
+        for key in keys:
+            for d, process, msg in self._dedup_inflight.pop(key, ()):
+                process(msg).chainDeferred(d)
+        return f
+
+    def _onMessageAsBatch(self, msg):
+        return self.onMessagesBatch([msg])
+
+    def onMessagesBatch(self, msgs):
+        if self.dedup is None:
+            return self._runCallback([self._decodeMessage(m) for m in msgs])
+
+        # skip duplicates within batch, wait for messages being processed
+        batch_keys = set()
+        fresh_msgs, keys, waiting = [], [], []
+        for m in msgs:
+            k = self.dedup_key(m)
+            if k is not None:
+                if k in batch_keys:
+                    continue
+                if k in self._dedup_inflight:
+                    waiting.append(self._waitInflight(k, self._onMessageAsBatch, m))
+                    continue
+                batch_keys.add(k)
+            fresh_msgs.append(m)
+            keys.append(k)
+        if len(fresh_msgs) < len(msgs):
+            logger.debug("skip %d duplicated messages in batch", len(msgs) - len(fresh_msgs))
+
+        for k in batch_keys:
+            self._dedup_inflight[k] = []
+        d = defer.gatherResults([
+            defer.maybeDeferred(self.dedup.contains, k) if k is not None else defer.succeed(False)
+            for k in keys
+        ]).addCallback(self._onBatchChecked, fresh_msgs, keys)
+        d.addCallbacks(
+            self._inflightSucceeded, self._inflightFailed,
+            callbackArgs=(batch_keys,), errbackArgs=(batch_keys,))
+        if not waiting:
+            return d
+
+        # whole batch is settled when its duplicates are settled too
+        return defer.gatherResults([d] + waiting, consumeErrors=True).addCallbacks(
+            operator.itemgetter(0),
+            lambda f: f.value.subFailure if f.check(defer.FirstError) else f)
+
+    def _onBatchChecked(self, seens, msgs, keys):
+        fresh = [(m, k) for m, k, seen in zip(msgs, keys, seens) if not seen]
+        if len(fresh) < len(msgs):
+            logger.debug("skip %d already processed messages", len(msgs) - len(fresh))
+        if not fresh:
+            return None
+        d = self._runCallback([self._decodeMessage(m) for m, _ in fresh])
+        return d.addCallback(self._markProcessed, [k for _, k in fresh])
+
+    def _consumeParams(self):
+        return dict(
+            callback=(self.onMessagesBatch if self.batch_size else self.onMessage),
+            parallel=self.parallel,
+            no_ack=self.no_ack,
+            requeue_delay=self.requeue_delay,
+            on_error=self.on_error,
+            batch_size=self.batch_size,
+            batch_timeout=self.batch_timeout,
+            autotune=self.autotune,
+            prefetch_count=self.prefetch_count,
+            prefetch_global=self.prefetch_global,
+            priority=self.priority,
+        )
+
 
 class _QueueConsumer(_BaseConsumer):
 
@@ -1017,14 +2572,7 @@ class _QueueConsumer(_BaseConsumer):
         self.queue = queue
 
     def _consume(self, protocol):
-        return protocol.consumeQueue(
-            queue=self.queue,
-            callback=self.onMessage,
-            parallel=self.parallel,
-            no_ack=self.no_ack,
-            requeue_delay=self.requeue_delay,
-            on_error=self.on_error,
-        )
+        return protocol.consumeQueue(queue=self.queue, **self._consumeParams())
 
 
 class _ExchangeConsumer(_BaseConsumer):
@@ -1038,13 +2586,8 @@ class _ExchangeConsumer(_BaseConsumer):
     def _consume(self, protocol):
         return protocol.consumeExchange(
             exchange=self.exchange,
-            callback=self.onMessage,
-            parallel=self.parallel,
-            no_ack=self.no_ack,
-            requeue_delay=self.requeue_delay,
-            on_error=self.on_error,
             routing_key=self.routing_key,
-        )
+            **self._consumeParams())
 
 
 class _ConsumersContainer(service.MultiService):
@@ -1054,15 +2597,147 @@ class _ConsumersContainer(service.MultiService):
         self.amqp_service = amqp_service
 
 
-class AMQPService(object, pclient.PersistentClientService):
+class _BatchSender(object):
+
+    """Accumulates messages & publishes them via `publishMessages`."""
+
+    clock = reactor
+
+    def __init__(
+            self, amqp_service, exchange,
+            routing_key=None, routing_key_fn=None,
+            content_type='json', confirm=True,
+            batch_size=100, batch_delay=0.01,
+            serializer=None, content_encoding=None,
+    ):
+
+        assert batch_size > 0
+        self.amqp_service = amqp_service
+        self.exchange = exchange
+        self.routing_key = routing_key
+        self.routing_key_fn = routing_key_fn
+        self.content_type = content_type
+        self.confirm = confirm
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.serializer = serializer
+        self.content_encoding = content_encoding
+
+        self._pending = []
+        self._flush_call = None
+
+    def __call__(self, data):
+        rk = self.routing_key or (self.routing_key_fn and self.routing_key_fn(data)) or ''
+        d = defer.Deferred()
+        self._pending.append((rk, data, d))
+        if len(self._pending) >= self.batch_size:
+            self.flush()
+        elif self._flush_call is None:
+            self._flush_call = self.clock.callLater(self.batch_delay, self.flush)
+        return d
+
+    def flush(self):
+
+        if self._flush_call is not None and self._flush_call.active():
+            self._flush_call.cancel()
+        self._flush_call = None
+
+        pending = self._pending
+        self._pending = []
+        if not pending:
+            return defer.succeed(None)
+
+        logger.debug("flush batch of %d messages to %r", len(pending), self.exchange)
+        d = self.amqp_service.publishMessages(
+            exchange=self.exchange,
+            messages=[(rk, data) for rk, data, _ in pending],
+            content_type=self.content_type,
+            confirm=self.confirm,
+            serializer=self.serializer,
+            content_encoding=self.content_encoding,
+        )
+        return d.addCallbacks(
+            self._batchPublished, self._batchFailed,
+            callbackArgs=(pending,), errbackArgs=(pending,),
+        )
+
+    def _batchPublished(self, results, pending):
+        for (success, result), (_, _, d) in zip(results, pending):
+            if success:
+                d.callback(result)
+            else:
+                d.errback(result)
+
+    def _batchFailed(self, f, pending):
+        logger.error("fail to publish batch of %d messages: %s", len(pending), f.value)
+        for _, _, d in pending:
+            d.errback(f)
+
+
+class _SendersMixin(object):
+
+    # requires `publishMessage`, `publishMessages` and `_batch_senders` list
+
+    def makeSender(self, exchange, routing_key=None, routing_key_fn=None,
+                   content_type='json', confirm=True, serializers=None,
+                   content_encoding=None):
+
+        assert routing_key is None or routing_key_fn is None
+        logger.debug(
+            "build sender callback for conn %r, " "exchange %r, ctype %s, confirm flag %r",
+            self, exchange, content_type, confirm)
+
+        # resolve codec once, not per message
+        serializer = (serializers or MESSAGE_SERIALIZERS).lookup(content_type)
+
+        def send(data):
+            rk = routing_key or (routing_key_fn and routing_key_fn(data)) or ''
+            return self.publishMessage(
+                exchange=exchange,
+                routing_key=rk,
+                body=data,
+                content_type=content_type,
+                confirm=confirm,
+                serializer=serializer,
+                content_encoding=content_encoding,
+            )
+        return send
+
+    def makeBatchSender(self, exchange, routing_key=None, routing_key_fn=None,
+                        content_type='json', confirm=True, batch_size=100, batch_delay=0.01,
+                        serializers=None, content_encoding=None):
+
+        assert routing_key is None or routing_key_fn is None
+        logger.debug(
+            "build batch sender for conn %r, exchange %r, ctype %s, "
+            "confirm flag %r, batch size %d, batch delay %r",
+            self, exchange, content_type, confirm, batch_size, batch_delay)
+
+        sender = _BatchSender(
+            self, exchange,
+            routing_key=routing_key,
+            routing_key_fn=routing_key_fn,
+            content_type=content_type,
+            confirm=confirm,
+            batch_size=batch_size,
+            batch_delay=batch_delay,
+            serializer=(serializers or MESSAGE_SERIALIZERS).lookup(content_type),
+            content_encoding=content_encoding,
+        )
+        self._batch_senders.append(sender)
+        return sender
+
+
+class AMQPService(_SendersMixin, pclient.PersistentClientService):
     # amqp service contains all conusumers as subservices
 
     name = 'amqp'
-    protocolProxiedMethods = ['publishMessage']
+    protocolProxiedMethods = ['publishMessage', 'publishMessages']
 
     def __init__(self, *args, **kwargs):
         pclient.PersistentClientService.__init__(self, *args, **kwargs)
         self.consumer_services = _ConsumersContainer(self)
+        self._batch_senders = []
 
     def startService(self):
         pclient.PersistentClientService.startService(self)
@@ -1074,6 +2749,7 @@ class AMQPService(object, pclient.PersistentClientService):
 
     @defer.inlineCallbacks
     def stopService(self):
+        yield defer.gatherResults([s.flush() for s in self._batch_senders])
         yield self.consumer_services.stopService()
         yield defer.maybeDeferred(pclient.PersistentClientService.stopService, self)
 
@@ -1092,8 +2768,19 @@ class AMQPService(object, pclient.PersistentClientService):
         for ss in self.consumer_services.services:
             ss.clientProtocolReady(protocol)
 
+    def delayedRejectsStats(self):
+        p = self.getProtocol()
+        if p is None:
+            return {'pending': 0, 'consumers': {}}
+        return p.delayedRejectsStats()
+
     def setupQueueConsuming(self, queue, callback, no_ack=False, parallel=0,
-                            deserialize=True, requeue_delay=None, on_error=None):
+                            deserialize=True, requeue_delay=None, on_error=None,
+                            serializers=None, batch_size=None, batch_timeout=None,
+                            autotune=None, prefetch_count=None, prefetch_global=False,
+                            dedup=None, dedup_key=None,
+                            priority=None, scheduler=None, weight=1, min_share=0,
+                            drain_timeout=None):
 
         logger.debug("setup queue consuming for conn %r, queue %r", self, queue)
         qc = _QueueConsumer(
@@ -1104,14 +2791,34 @@ class AMQPService(object, pclient.PersistentClientService):
             deserialize=deserialize,
             requeue_delay=requeue_delay,
             on_error=on_error,
+            serializers=serializers,
+            batch_size=batch_size,
+            batch_timeout=batch_timeout,
+            autotune=autotune,
+            prefetch_count=prefetch_count,
+            prefetch_global=prefetch_global,
+            dedup=dedup,
+            dedup_key=dedup_key,
+            priority=priority,
+            scheduler=scheduler,
+            weight=weight,
+            min_share=min_share,
+            drain_timeout=drain_timeout,
         )
         qc.setServiceParent(self.consumer_services)
         return qc
 
     def setupExchangeConsuming(self, exchange, callback, routing_key='', requeue_delay=None,
-                               parallel=0, deserialize=True, no_ack=False, on_error=None):
+                               parallel=0, deserialize=True, no_ack=False, on_error=None,
+                               serializers=None, batch_size=None, batch_timeout=None,
+                               autotune=None, prefetch_count=None, prefetch_global=False,
+                               dedup=None, dedup_key=None,
+                               priority=None, scheduler=None, weight=1, min_share=0,
+                               drain_timeout=None):
 
         logger.debug("setup exchange consuming for conn %r, exch %r", self, exchange)
+        if on_error == 'retry_dlx':
+            raise ValueError("on_error 'retry_dlx' is not supported for exchange consuming")
         qc = _ExchangeConsumer(
             callback=callback,
             exchange=exchange,
@@ -1121,32 +2828,175 @@ class AMQPService(object, pclient.PersistentClientService):
             parallel=parallel,
             requeue_delay=requeue_delay,
             on_error=on_error,
+            serializers=serializers,
+            batch_size=batch_size,
+            batch_timeout=batch_timeout,
+            autotune=autotune,
+            prefetch_count=prefetch_count,
+            prefetch_global=prefetch_global,
+            dedup=dedup,
+            dedup_key=dedup_key,
+            priority=priority,
+            scheduler=scheduler,
+            weight=weight,
+            min_share=min_share,
+            drain_timeout=drain_timeout,
         )
         qc.setServiceParent(self.consumer_services)
         return qc
 
     def unsetupConsuming(self, consumer):
         assert isinstance(consumer, _BaseConsumer)
-        self.consumer_services.removeService(consumer)
+        return self.consumer_services.removeService(consumer)
 
-    def makeSender(self, exchange, routing_key=None, routing_key_fn=None,
-                   content_type='json', confirm=True):
 
-        assert routing_key is None or routing_key_fn is None
-        logger.debug(
-            "build sender callback for conn %r, " "exchange %r, ctype %s, confirm flag %r",
-            self, exchange, content_type, confirm)
+class _ConsumersGroup(object):
 
-        def send(data):
-            rk = routing_key or (routing_key_fn and routing_key_fn(data)) or ''
-            return self.publishMessage(
-                exchange=exchange,
-                routing_key=rk,
-                body=data,
-                content_type=content_type,
-                confirm=confirm,
-            )
-        return send
+    """Consumers of one queue on all shards of `AMQPServiceGroup`.
+
+    Can be started and stopped like a single consumer.
+    """
+
+    def __init__(self, consumers):
+        self.consumers = list(consumers)
+
+    def __iter__(self):
+        return iter(self.consumers)
+
+    def __len__(self):
+        return len(self.consumers)
+
+    @property
+    def running(self):
+        return any(c.running for c in self.consumers)
+
+    def startService(self):
+        for c in self.consumers:
+            c.startService()
+
+    def stopService(self):
+        return defer.gatherResults([
+            defer.maybeDeferred(c.stopService) for c in self.consumers])
+
+
+class AMQPServiceGroup(_SendersMixin, service.MultiService):
+
+    """Logical AMQP service over several connections (shards).
+
+    Messages are published via one of shards (selected by routing key hash,
+    round robin or by count of unconfirmed messages). Queues are consumed
+    via all shards, exchanges - via one shard (to avoid duplicates).
+    """
+
+    SHARD_SELECTORS = (
+        'least_loaded',
+        'round_robin',
+        'rk_hash',
+    )
+
+    def __init__(self, shards=(), selector=None):
+        service.MultiService.__init__(self)
+        assert not selector or selector in self.SHARD_SELECTORS
+        self.selector = selector or 'least_loaded'
+        self._batch_senders = []
+        self._rr_counter = 0
+        for s in shards:
+            s.setServiceParent(self)
+
+    @defer.inlineCallbacks
+    def stopService(self):
+        yield defer.gatherResults([s.flush() for s in self._batch_senders])
+        yield defer.maybeDeferred(service.MultiService.stopService, self)
+
+    def _nextShard(self):
+        self._rr_counter += 1
+        return self.services[self._rr_counter % len(self.services)]
+
+    @staticmethod
+    def _shardLoad(protocol):
+        return protocol._unconfirmedCount() + len(protocol._publish_waiters)
+
+    def _selectShard(self, routing_key):
+
+        shards = self.services
+        assert shards, "no shards in group"
+
+        if self.selector == 'rk_hash':
+            return shards[_hashKey(routing_key) % len(shards)]
+
+        if self.selector == 'least_loaded':
+            ready = [(s, s.getProtocol()) for s in shards]
+            ready = [(self._shardLoad(p), i, s) for i, (s, p) in enumerate(ready) if p]
+            if ready:
+                return min(ready)[2]
+
+        return self._nextShard()
+
+    def publishMessage(self, exchange, routing_key, body, **kwargs):
+        shard = self._selectShard(routing_key)
+        return shard.publishMessage(
+            exchange=exchange, routing_key=routing_key, body=body, **kwargs)
+
+    def publishMessages(self, exchange, messages, **kwargs):
+
+        if self.selector != 'rk_hash':
+            shard = self._selectShard(None)
+            return shard.publishMessages(exchange=exchange, messages=messages, **kwargs)
+
+        # split batch by shards, keep order of results
+        by_shard = collections.OrderedDict()
+        for i, (rk, body) in enumerate(messages):
+            by_shard.setdefault(self._selectShard(rk), []).append((i, rk, body))
+
+        results = [None] * len(messages)
+
+        def store_results(shard_results, idxs):
+            for i, r in zip(idxs, shard_results):
+                results[i] = r
+
+        def store_failure(f, idxs):
+            for i in idxs:
+                results[i] = (False, f)
+
+        ds = []
+        for shard, ms in by_shard.items():
+            idxs = [i for i, _, _ in ms]
+            d = defer.maybeDeferred(
+                shard.publishMessages,
+                exchange=exchange, messages=[(rk, body) for _, rk, body in ms], **kwargs)
+            d.addCallbacks(
+                store_results, store_failure,
+                callbackArgs=(idxs,), errbackArgs=(idxs,))
+            ds.append(d)
+
+        return defer.gatherResults(ds).addCallback(lambda _: results)
+
+    def setupQueueConsuming(self, queue, callback, **kwargs):
+        logger.debug("setup queue consuming for group %r, queue %r", self, queue)
+        return _ConsumersGroup(
+            s.setupQueueConsuming(queue, callback, **kwargs) for s in self.services)
+
+    def setupExchangeConsuming(self, exchange, callback, **kwargs):
+        logger.debug("setup exchange consuming for group %r, exch %r", self, exchange)
+        shard = self.services[_hashKey(exchange) % len(self.services)]
+        return shard.setupExchangeConsuming(exchange, callback, **kwargs)
+
+    def unsetupConsuming(self, consumer):
+        consumers = list(consumer) if isinstance(consumer, _ConsumersGroup) else [consumer]
+        ds = []
+        for c in consumers:
+            for s in self.services:
+                if c in s.consumer_services:
+                    ds.append(defer.maybeDeferred(s.unsetupConsuming, c))
+        return defer.gatherResults(ds)
+
+    def delayedRejectsStats(self):
+        stats = {'pending': 0, 'consumers': {}}
+        for s in self.services:
+            x = s.delayedRejectsStats()
+            stats['pending'] += x['pending']
+            stats['consumers'].update(x['consumers'])
+        return stats
 
 
 class AMQPCollectionService(pclient.PersistentClientsCollectionService):
@@ -1160,6 +3010,38 @@ class AMQPCollectionService(pclient.PersistentClientsCollectionService):
         'host': "localhost",
     }
 
+    def buildClientEndpoint(self, params):
+        ep = params.get('endpoint')
+        if ep and ep.startswith('loop:'):
+            # in-process fake broker (tests & benchmarks)
+            from twoost import fakeamqp
+            return fakeamqp.FakeBrokerEndpoint(fakeamqp.getBroker(ep[5:]))
+        return pclient.PersistentClientsCollectionService.buildClientEndpoint(self, params)
+
+    def _initClientService(self, connection, params):
+
+        if not params.get('shards'):
+            return pclient.PersistentClientsCollectionService._initClientService(
+                self, connection, params)
+
+        params = dict(params)
+        shards = params.pop('shards')
+        if isinstance(shards, int):
+            shards = [{}] * shards
+
+        group = AMQPServiceGroup(selector=params.pop('shard_selector', None))
+        for i, shard_params in enumerate(shards):
+            p = dict(self.defaultParams)
+            p.update(params)
+            p.update(shard_params)
+            logger.debug("create shard %d of %r, params %r", i, connection, p)
+            s = self.buildClientService(self.buildClientEndpoint(p), self.buildClientFactory(p), p)
+            s.setName("%s#%d" % (connection, i))
+            s.setServiceParent(group)
+
+        group.setName(connection)
+        group.setServiceParent(self)
+
     def setupQueueConsuming(self, connection, *args, **kwargs):
         return self[connection].setupQueueConsuming(*args, **kwargs)
 
@@ -1168,3 +3050,6 @@ class AMQPCollectionService(pclient.PersistentClientsCollectionService):
 
     def makeSender(self, connection, *args, **kwargs):
         return self[connection].makeSender(*args, **kwargs)
+
+    def makeBatchSender(self, connection, *args, **kwargs):
+        return self[connection].makeBatchSender(*args, **kwargs)
@@ -0,0 +1,240 @@
+# coding: utf-8
+
+from __future__ import print_function, division, absolute_import
+
+"""
+RPC over AMQP: requests are published to server queue, replies are sent
+back via rabbitmq 'direct reply-to' (no reply queues are declared).
+
+Request - json list of args, method name is in `type` property.
+Reply - json object `{"result": ...}` or `{"error": ..., "error_type": ...}`.
+"""
+
+import json
+import uuid
+
+import zope.interface
+
+from twisted.internet import defer
+from twisted.internet.error import ConnectionDone
+from twisted.application import service
+from twisted.python import failure, reflect
+
+from pika.spec import BasicProperties as _BasicProperties
+
+from twoost import amqp, timed, health, pclient
+
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+__all__ = [
+    'AMQPRPCError',
+    'AMQPRPCProxy',
+    'AMQPRPCServer',
+]
+
+
+class AMQPRPCError(Exception):
+
+    def __init__(self, message, error_type=None):
+        Exception.__init__(self, message, error_type)
+        self.message = message
+        self.error_type = error_type
+
+
+# -- server
+
+class AMQPRPCServer(service.Service):
+
+    """Exposes methods dict via AMQP queue (queue should be declared by schema)."""
+
+    def __init__(self, amqp_service, queue, methods=None, enable_echo=True, parallel=10):
+        self.amqp_service = amqp_service
+        self.queue = queue
+        self.parallel = parallel
+        self._methods = dict(methods or {})
+        self._consumer = None
+
+        if enable_echo:
+            self.amqprpc__echo = lambda x: x
+
+    def lookupProcedure(self, method):
+        if method in self._methods:
+            return self._methods[method]
+        return getattr(self, "amqprpc_%s" % method, None)
+
+    def listProcedures(self):
+        a = set(self._methods)
+        b = set(reflect.prefixedMethodNames(self.__class__, 'amqprpc_'))
+        return sorted(a | b)
+
+    def startService(self):
+        service.Service.startService(self)
+        logger.debug("serve rpc requests from queue %r", self.queue)
+        self._consumer = self.amqp_service.setupQueueConsuming(
+            self.queue, self._onRequest,
+            deserialize=False, parallel=self.parallel, on_error='reject')
+
+    @defer.inlineCallbacks
+    def stopService(self):
+        consumer, self._consumer = self._consumer, None
+        if consumer is not None:
+            yield defer.maybeDeferred(self.amqp_service.unsetupConsuming, consumer)
+        yield defer.maybeDeferred(service.Service.stopService, self)
+
+    @defer.inlineCallbacks
+    def _onRequest(self, msg):
+
+        method = msg.type
+        logger.debug("rpc request %r, correlation id %r", method, msg.correlation_id)
+
+        try:
+            callback = self.lookupProcedure(method) if method else None
+            if callback is None:
+                raise AMQPRPCError("no method %r" % method, 'NoSuchMethod')
+            args = msg.data
+            if not isinstance(args, list):
+                args = [args]
+            result = yield defer.maybeDeferred(callback, *args)
+            reply = {'result': result}
+        except Exception as e:
+            logger.error("rpc method %r failed: %s", method, e)
+            reply = {
+                'error': str(e.message if isinstance(e, AMQPRPCError) else e),
+                'error_type': getattr(e, 'error_type', None) or type(e).__name__,
+            }
+
+        if not msg.reply_to:
+            logger.debug("no 'reply_to' for rpc request %r - skip reply", method)
+            return
+
+        yield self.amqp_service.publishMessage(
+            exchange='',
+            routing_key=msg.reply_to,
+            body=reply,
+            content_type='json',
+            properties={'correlation_id': msg.correlation_id},
+            confirm=False,
+        )
+
+
+# -- client
+
+@zope.interface.implementer(health.IHealthChecker)
+class AMQPRPCProxy(object):
+
+    """Calls methods of `AMQPRPCServer` via `amqp_service` connection."""
+
+    def __init__(self, amqp_service, queue, exchange='', timeout=60, health_check=True):
+        self.amqp_service = amqp_service
+        self.queue = queue
+        self.exchange = exchange
+        self.timeout = timeout
+        self.health_check = health_check
+
+        # correlation id => deferred
+        self._calls = {}
+        self._protocol = None
+        self._channel = None
+        self._channel_waiters = None
+
+    def _replyChannel(self):
+
+        p = self.amqp_service.getProtocol()
+        if p is None:
+            return defer.fail(pclient.NoPersisentClientConnection())
+
+        if p is not self._protocol:
+            # replies to previous connection never come
+            self._failCalls(failure.Failure(ConnectionDone("amqp connection was lost")))
+            self._protocol = p
+            self._channel = None
+            self._channel_waiters = None
+
+        if self._channel is not None and self._channel.is_open:
+            return defer.succeed(self._channel)
+
+        if self._channel_waiters is None:
+            waiters = self._channel_waiters = []
+            p.openReplyChannel(self._onReply).addBoth(self._replyChannelOpened, p, waiters)
+
+        d = defer.Deferred()
+        self._channel_waiters.append(d)
+        return d
+
+    def _replyChannelOpened(self, result, p, waiters):
+        if self._channel_waiters is waiters:
+            self._channel_waiters = None
+        if p is self._protocol and not isinstance(result, failure.Failure):
+            self._channel = result
+        for d in waiters:
+            if isinstance(result, failure.Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
+
+    def callRemote(self, method, *args):
+        logger.debug("remote call to %r, method %r with args %r", self.queue, method, args)
+        return self._replyChannel().addCallback(self._publishRequest, method, args)
+
+    def _publishRequest(self, channel, method, args):
+
+        cid = uuid.uuid4().hex
+        d = defer.Deferred(lambda _: self._calls.pop(cid, None))
+        self._calls[cid] = d
+
+        def failed(f):
+            if self._calls.pop(cid, None) is not None:
+                d.errback(f)
+
+        properties = _BasicProperties(
+            content_type='application/json',
+            type=method,
+            correlation_id=cid,
+            reply_to=amqp.DIRECT_REPLY_TO,
+            # request is useless after timeout
+            expiration=(str(int(self.timeout * 1000)) if self.timeout else None),
+        )
+        defer.maybeDeferred(
+            channel.basic_publish, self.exchange, self.queue,
+            json.dumps(args), properties=properties,
+        ).addErrback(failed)
+
+        return timed.timeoutDeferred(d, self.timeout)
+
+    def _onReply(self, msg):
+
+        d = self._calls.pop(msg.correlation_id, None)
+        if d is None:
+            logger.debug("late reply, correlation id %r", msg.correlation_id)
+            return
+
+        try:
+            reply = msg.data
+        except Exception:
+            d.errback()
+            return
+
+        if 'error' in reply:
+            d.errback(AMQPRPCError(reply['error'], reply.get('error_type')))
+        else:
+            d.callback(reply.get('result'))
+
+    def _failCalls(self, reason):
+        calls, self._calls = self._calls, {}
+        for d in calls.values():
+            d.errback(reason)
+
+    def close(self):
+        self._failCalls(failure.Failure(ConnectionDone("rpc proxy was closed")))
+        if self._channel is not None and self._channel.is_open:
+            self._channel.close()
+        self._protocol = self._channel = None
+
+    def checkHealth(self):
+        if not self.health_check:
+            raise NotImplementedError
+        token = uuid.uuid4().hex
+        return self.callRemote('_echo', token).addCallback(lambda _: "")
@@ -0,0 +1,868 @@
+# coding: utf-8
+
+from __future__ import print_function, division
+
+"""
+In-process AMQP 0-9-1 broker stand-in for tests & benchmarks.
+
+Supports exchanges (direct, fanout, topic), queues, bindings, publisher
+confirms, prefetch, acks/rejects with redelivery, message ttl,
+dead-lettering and direct reply-to. Clients are connected via in-memory transport, use
+`FakeBrokerEndpoint` or `loop:<broker-name>` endpoint of `AMQPCollectionService`.
+"""
+
+import uuid
+import collections
+
+import zope.interface
+
+from twisted.internet import defer, reactor, protocol, interfaces
+from twisted.internet.error import ConnectionDone
+from twisted.python import failure
+
+from pika import frame, spec
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+__all__ = [
+    'FakeBroker',
+    'FakeBrokerEndpoint',
+    'getBroker',
+]
+
+
+# pseudo-queue of rabbitmq 'direct reply-to' feature
+DIRECT_REPLY_TO = 'amq.rabbitmq.reply-to'
+
+
+class _ChannelError(Exception):
+
+    def __init__(self, reply_code, reply_text):
+        Exception.__init__(self, reply_code, reply_text)
+        self.reply_code = reply_code
+        self.reply_text = reply_text
+
+
+class _Message(object):
+
+    __slots__ = (
+        'exchange', 'routing_key', 'properties', 'body',
+        'redelivered', 'expires_at',
+    )
+
+    def __init__(self, exchange, routing_key, properties, body):
+        self.exchange = exchange
+        self.routing_key = routing_key
+        self.properties = properties
+        self.body = body
+        self.redelivered = False
+        self.expires_at = None
+
+
+class _Queue(object):
+
+    def __init__(self, broker, name, durable=False, exclusive_owner=None,
+                 auto_delete=False, arguments=None):
+        self.broker = broker
+        self.name = name
+        self.durable = durable
+        self.exclusive_owner = exclusive_owner
+        self.auto_delete = auto_delete
+        self.arguments = dict(arguments or {})
+        self.messages = collections.deque()
+        self.consumers = []
+        self._rr_counter = 0
+        self._expire_call = None
+
+    @property
+    def message_ttl(self):
+        return self.arguments.get('x-message-ttl')
+
+    def put(self, msg, front=False):
+
+        ttls = [self.message_ttl, msg.properties.expiration]
+        ttls = [int(t) for t in ttls if t is not None]
+        if ttls and msg.expires_at is None:
+            ttl = min(ttls)
+            msg.expires_at = self.broker.clock.seconds() + ttl / 1000
+
+        if front:
+            self.messages.appendleft(msg)
+        else:
+            self.messages.append(msg)
+
+        self.dispatch()
+        if msg.expires_at is not None and self.messages:
+            self._scheduleExpire()
+
+    def _scheduleExpire(self):
+        if self._expire_call is not None and self._expire_call.active():
+            return
+        deadline = min(m.expires_at for m in self.messages if m.expires_at is not None)
+        delay = max(0, deadline - self.broker.clock.seconds())
+        self._expire_call = self.broker.clock.callLater(delay, self._expire)
+
+    def _expire(self):
+        self._expire_call = None
+        now = self.broker.clock.seconds()
+        alive = collections.deque()
+        expired = []
+        for m in self.messages:
+            if m.expires_at is not None and m.expires_at <= now:
+                expired.append(m)
+            else:
+                alive.append(m)
+        self.messages = alive
+        for m in expired:
+            self.deadLetter(m, 'expired')
+        if any(m.expires_at is not None for m in self.messages):
+            self._scheduleExpire()
+
+    def deadLetter(self, msg, reason):
+
+        dlx = self.arguments.get('x-dead-letter-exchange')
+        if dlx is None:
+            return
+
+        rk = self.arguments.get('x-dead-letter-routing-key') or msg.routing_key
+        props = msg.properties
+        headers = dict(props.headers or {})
+        headers['x-death'] = [{
+            'queue': self.name,
+            'reason': reason,
+            'exchange': msg.exchange,
+            'routing-keys': [msg.routing_key],
+        }] + list(headers.get('x-death') or [])
+        props.headers = headers
+        props.expiration = None
+
+        logger.debug("dead-letter message from %r to %r/%r", self.name, dlx, rk)
+        self.broker.publish(dlx, rk, props, msg.body)
+
+    def dispatch(self):
+
+        consumers = self.consumers
+        while self.messages and consumers:
+            # round-robin among free consumers with highest `x-priority`
+            best = None
+            for i in range(len(consumers)):
+                c = consumers[(self._rr_counter + i) % len(consumers)]
+                if c.channel.hasCapacity() and (best is None or c.priority > best[1].priority):
+                    best = i, c
+            if best is None:
+                # all consumers are busy
+                return
+            i, c = best
+            self._rr_counter += i + 1
+            c.channel.deliver(c, self.messages.popleft())
+
+
+class _Consumer(object):
+
+    def __init__(self, channel, tag, queue, no_ack, priority=0):
+        self.channel = channel
+        self.tag = tag
+        self.queue = queue
+        self.no_ack = no_ack
+        self.priority = priority
+
+
+class FakeBroker(object):
+
+    """Broker state shared by all connections: exchanges, queues & bindings."""
+
+    clock = reactor
+
+    def __init__(self, name=None):
+        self.name = name
+        self.exchanges = {}
+        self.queues = {}
+        # 'amq.rabbitmq.reply-to.<token>' -> consumer
+        self.reply_consumers = {}
+        # exchange -> [(routing_key, queue or exchange, is_exchange)]
+        self.bindings = collections.defaultdict(list)
+        for e, t in [
+                ('', 'direct'), ('amq.direct', 'direct'),
+                ('amq.fanout', 'fanout'), ('amq.topic', 'topic'),
+        ]:
+            self.exchanges[e] = t
+
+    # -- schema
+
+    def declareExchange(self, exchange, exchange_type='direct', passive=False):
+        t = self.exchanges.get(exchange)
+        if passive or t is not None:
+            if t is None:
+                raise _ChannelError(404, "NOT_FOUND - no exchange '%s'" % exchange)
+            if not passive and t != exchange_type:
+                raise _ChannelError(406, "PRECONDITION_FAILED - inequivalent arg 'type'")
+            return
+        if exchange_type not in ('direct', 'fanout', 'topic'):
+            raise _ChannelError(503, "COMMAND_INVALID - unknown exchange type")
+        self.exchanges[exchange] = exchange_type
+
+    def deleteExchange(self, exchange):
+        self.exchanges.pop(exchange, None)
+        self.bindings.pop(exchange, None)
+
+    def declareQueue(self, queue, passive=False, durable=False, exclusive_owner=None,
+                     auto_delete=False, arguments=None):
+
+        queue = queue or "amq.gen-%s" % uuid.uuid4().hex
+        q = self.queues.get(queue)
+
+        if passive and q is None:
+            raise _ChannelError(404, "NOT_FOUND - no queue '%s'" % queue)
+        if q is not None:
+            if (not passive and arguments is not None and
+                    dict(arguments) != q.arguments):
+                raise _ChannelError(406, "PRECONDITION_FAILED - inequivalent args")
+            return q
+
+        q = self.queues[queue] = _Queue(
+            self, queue, durable=durable, exclusive_owner=exclusive_owner,
+            auto_delete=auto_delete, arguments=arguments)
+        return q
+
+    def getQueue(self, queue):
+        q = self.queues.get(queue)
+        if q is None:
+            raise _ChannelError(404, "NOT_FOUND - no queue '%s'" % queue)
+        return q
+
+    def deleteQueue(self, queue):
+        q = self.queues.pop(queue, None)
+        if q is None:
+            return 0
+        for bs in self.bindings.values():
+            bs[:] = [b for b in bs if b[2] or b[1] != queue]
+        for c in list(q.consumers):
+            c.channel.cancelConsumer(c.tag, notify=True)
+        return len(q.messages)
+
+    def bind(self, exchange, destination, routing_key='', to_exchange=False):
+        if exchange not in self.exchanges:
+            raise _ChannelError(404, "NOT_FOUND - no exchange '%s'" % exchange)
+        if to_exchange and destination not in self.exchanges:
+            raise _ChannelError(404, "NOT_FOUND - no exchange '%s'" % destination)
+        if not to_exchange:
+            self.getQueue(destination)
+        b = (routing_key or '', destination, to_exchange)
+        if b not in self.bindings[exchange]:
+            self.bindings[exchange].append(b)
+
+    def unbind(self, exchange, destination, routing_key='', to_exchange=False):
+        b = (routing_key or '', destination, to_exchange)
+        bs = self.bindings.get(exchange, [])
+        if b in bs:
+            bs.remove(b)
+
+    # -- routing
+
+    @staticmethod
+    def _topicMatch(pattern, routing_key):
+
+        def match(p, k):
+            if not p:
+                return not k
+            if p[0] == '#':
+                return any(match(p[1:], k[i:]) for i in range(len(k) + 1))
+            return bool(k) and p[0] in ('*', k[0]) and match(p[1:], k[1:])
+
+        return match(pattern.split('.'), routing_key.split('.'))
+
+    def route(self, exchange, routing_key, _seen=None):
+
+        if exchange == '':
+            return [routing_key] if routing_key in self.queues else []
+
+        t = self.exchanges.get(exchange)
+        if t is None:
+            raise _ChannelError(404, "NOT_FOUND - no exchange '%s'" % exchange)
+
+        queues = []
+        seen = _seen if _seen is not None else set([exchange])
+        for rk, dest, to_exchange in self.bindings.get(exchange, ()):
+            if t == 'fanout':
+                match = True
+            elif t == 'topic':
+                match = self._topicMatch(rk, routing_key)
+            else:
+                match = rk == routing_key
+            if not match:
+                continue
+            if to_exchange:
+                if dest not in seen:
+                    seen.add(dest)
+                    queues.extend(self.route(dest, routing_key, seen))
+            elif dest not in queues:
+                queues.append(dest)
+        return queues
+
+    def publish(self, exchange, routing_key, properties, body):
+
+        if not exchange and routing_key.startswith(DIRECT_REPLY_TO + '.'):
+            c = self.reply_consumers.get(routing_key)
+            if c is None:
+                return 0
+            c.channel.deliver(c, _Message(exchange, routing_key, properties, body))
+            return 1
+
+        queues = self.route(exchange, routing_key)
+        for q in queues:
+            # each queue gets own copy of mutable properties
+            props = properties if len(queues) == 1 else _copyProperties(properties)
+            self.queues[q].put(_Message(exchange, routing_key, props, body))
+        return len(queues)
+
+
+def _copyProperties(p):
+    c = spec.BasicProperties()
+    c.__dict__.update(p.__dict__)
+    if p.headers is not None:
+        c.headers = dict(p.headers)
+    return c
+
+
+class _BrokerChannel(object):
+
+    def __init__(self, connection, number):
+        self.connection = connection
+        self.number = number
+        self.broker = connection.broker
+        self.confirm = False
+        self.publish_seq = 0
+        self.confirmed_seq = 0
+        self.prefetch_count = 0
+        self.delivery_tag = 0
+        self.unacked = collections.OrderedDict()
+        self.consumers = {}
+        self.reply_to = None
+        self._publish = None
+        self._publish_body = None
+        self._publish_props = None
+        self._publish_size = 0
+
+    def hasCapacity(self):
+        return not self.prefetch_count or len(self.unacked) < self.prefetch_count
+
+    def deliver(self, consumer, msg):
+        self.delivery_tag += 1
+        dt = self.delivery_tag
+        if not consumer.no_ack:
+            self.unacked[dt] = consumer.queue, msg
+        self.connection.sendContent(
+            self.number,
+            spec.Basic.Deliver(consumer.tag, dt, msg.redelivered, msg.exchange, msg.routing_key),
+            msg.properties, msg.body)
+
+    def _dispatchAll(self):
+        for q in set(c.queue for c in self.consumers.values()):
+            if q is not None:
+                q.dispatch()
+
+    def _settle(self, delivery_tag, multiple):
+        if multiple:
+            dts = [dt for dt in self.unacked if dt <= delivery_tag or not delivery_tag]
+        elif delivery_tag in self.unacked:
+            dts = [delivery_tag]
+        else:
+            raise _ChannelError(406, "PRECONDITION_FAILED - unknown delivery tag %d" % delivery_tag)
+        return [self.unacked.pop(dt) for dt in dts]
+
+    def ack(self, delivery_tag, multiple=False):
+        self._settle(delivery_tag, multiple)
+        self._dispatchAll()
+
+    def reject(self, delivery_tag, multiple=False, requeue=True):
+        settled = self._settle(delivery_tag, multiple)
+        for q, msg in reversed(settled):
+            if requeue:
+                msg.redelivered = True
+                q.put(msg, front=True)
+            else:
+                q.deadLetter(msg, 'rejected')
+        self._dispatchAll()
+
+    def consume(self, queue, consumer_tag, no_ack, arguments=None):
+        if queue == DIRECT_REPLY_TO:
+            return self._consumeReplies(consumer_tag, no_ack)
+        q = self.broker.getQueue(queue)
+        if q.exclusive_owner not in (None, self.connection):
+            raise _ChannelError(403, "ACCESS_REFUSED - queue '%s' is exclusive" % queue)
+        consumer_tag = consumer_tag or "amq.ctag-%s" % uuid.uuid4().hex
+        if consumer_tag in self.consumers:
+            raise _ChannelError(530, "NOT_ALLOWED - reused consumer tag")
+        priority = int((arguments or {}).get('x-priority') or 0)
+        c = self.consumers[consumer_tag] = _Consumer(self, consumer_tag, q, no_ack, priority)
+        q.consumers.append(c)
+        return c
+
+    def _consumeReplies(self, consumer_tag, no_ack):
+        if not no_ack:
+            raise _ChannelError(406, "PRECONDITION_FAILED - reply consumer cannot acknowledge")
+        if self.reply_to:
+            raise _ChannelError(406, "PRECONDITION_FAILED - reply consumer already set")
+        consumer_tag = consumer_tag or "amq.ctag-%s" % uuid.uuid4().hex
+        c = self.consumers[consumer_tag] = _Consumer(self, consumer_tag, None, True)
+        self.reply_to = "%s.%s" % (DIRECT_REPLY_TO, uuid.uuid4().hex)
+        self.broker.reply_consumers[self.reply_to] = c
+        return c
+
+    def cancelConsumer(self, consumer_tag, notify=False):
+        c = self.consumers.pop(consumer_tag, None)
+        if c is None:
+            return
+        if c.queue is None:
+            self.broker.reply_consumers.pop(self.reply_to, None)
+            self.reply_to = None
+            return
+        if c in c.queue.consumers:
+            c.queue.consumers.remove(c)
+        if notify:
+            self.connection.sendMethod(self.number, spec.Basic.Cancel(consumer_tag, nowait=True))
+        q = c.queue
+        if q.auto_delete and not q.consumers and self.broker.queues.get(q.name) is q:
+            self.broker.deleteQueue(q.name)
+
+    def startPublish(self, method):
+        self._publish = method
+        self._publish_body = []
+        self._publish_size = 0
+        self._publish_props = None
+
+    def publishHeader(self, header):
+        if header.properties.reply_to == DIRECT_REPLY_TO:
+            if not self.reply_to:
+                self._publish = None
+                raise _ChannelError(406, "PRECONDITION_FAILED - fast reply consumer does not exist")
+            header.properties.reply_to = self.reply_to
+        self._publish_props = header.properties
+        self._publish_size = header.body_size
+        if not header.body_size:
+            self._finishPublish()
+
+    def publishBody(self, body):
+        self._publish_body.append(body.fragment)
+        self._publish_size -= len(body.fragment)
+        if self._publish_size <= 0:
+            self._finishPublish()
+
+    def _finishPublish(self):
+        m = self._publish
+        body = b"".join(self._publish_body)
+        props = self._publish_props
+        self._publish = self._publish_body = self._publish_props = None
+        if self.confirm:
+            self.publish_seq += 1
+        self.broker.publish(m.exchange, m.routing_key, props, body)
+        if self.confirm:
+            self.connection.scheduleConfirms(self)
+
+    def close(self):
+        for c in list(self.consumers):
+            self.cancelConsumer(c)
+        # unacked messages return to their queues
+        if self.unacked:
+            self.reject(0, multiple=True, requeue=True)
+
+
+class FakeBrokerProtocol(protocol.Protocol):
+
+    """Server side of in-memory AMQP connection."""
+
+    frame_max = 131072
+
+    def __init__(self, broker):
+        self.broker = broker
+        self.channels = {}
+        self._buffer = b""
+        self._confirm_channels = set()
+        self._closing = False
+
+    def connectionMade(self):
+        logger.debug("fake broker %r: client connected", self.broker.name)
+
+    # -- output
+
+    def sendMethod(self, channel_number, method):
+        self.transport.write(frame.Method(channel_number, method).marshal())
+
+    def sendContent(self, channel_number, method, properties, body):
+        frames = [
+            frame.Method(channel_number, method).marshal(),
+            frame.Header(channel_number, len(body), properties).marshal(),
+        ]
+        chunk = self.frame_max - spec.FRAME_HEADER_SIZE - spec.FRAME_END_SIZE
+        for i in range(0, len(body), chunk):
+            frames.append(frame.Body(channel_number, body[i:i + chunk]).marshal())
+        self.transport.writeSequence(frames)
+
+    def scheduleConfirms(self, channel):
+        self._confirm_channels.add(channel)
+
+    def _sendConfirms(self):
+        # one `multiple` ack per channel for all publishes of received chunk
+        for ch in self._confirm_channels:
+            if ch.publish_seq > ch.confirmed_seq and self.channels.get(ch.number) is ch:
+                ch.confirmed_seq = ch.publish_seq
+                self.sendMethod(ch.number, spec.Basic.Ack(ch.publish_seq, multiple=True))
+        self._confirm_channels.clear()
+
+    # -- input
+
+    def dataReceived(self, data):
+        self._buffer += data
+        try:
+            while self._buffer and not self._closing:
+                consumed, f = frame.decode_frame(self._buffer)
+                if not consumed:
+                    break
+                self._buffer = self._buffer[consumed:]
+                self.frameReceived(f)
+        finally:
+            self._sendConfirms()
+
+    def frameReceived(self, f):
+
+        if isinstance(f, frame.ProtocolHeader):
+            self.sendMethod(0, spec.Connection.Start(
+                server_properties={
+                    'product': 'twoost-fakeamqp',
+                    'cluster_name': self.broker.name or 'fakeamqp@%x' % id(self.broker),
+                    'capabilities': {
+                        'publisher_confirms': True,
+                        'basic.nack': True,
+                        'consumer_cancel_notify': True,
+                        'exchange_exchange_bindings': True,
+                    },
+                },
+                mechanisms='PLAIN',
+                locales='en_US',
+            ))
+            return
+
+        if isinstance(f, frame.Heartbeat):
+            return
+
+        ch = self.channels.get(f.channel_number)
+
+        if isinstance(f, frame.Header):
+            if ch is not None:
+                try:
+                    ch.publishHeader(f)
+                except _ChannelError as e:
+                    self._closeChannel(f.channel_number, e.reply_code, e.reply_text, spec.Basic.Publish())
+            return
+
+        if isinstance(f, frame.Body):
+            if ch is not None:
+                ch.publishBody(f)
+            return
+
+        method = f.method
+        handler = getattr(self, 'amqp_' + method.NAME.replace('.', '_'), None)
+        if handler is None:
+            logger.error("fake broker: unsupported method %r", method.NAME)
+            self._closeConnection(540, "NOT_IMPLEMENTED - %s" % method.NAME, method)
+            return
+
+        if f.channel_number and ch is None and method.NAME != 'Channel.Open':
+            # channel is closing - ignore everything except CloseOk
+            return
+
+        try:
+            handler(ch or f.channel_number, method)
+        except _ChannelError as e:
+            logger.debug("fake broker: close channel %d - %s", f.channel_number, e.reply_text)
+            self._closeChannel(f.channel_number, e.reply_code, e.reply_text, method)
+
+    def _closeChannel(self, channel_number, reply_code, reply_text, method):
+        ch = self.channels.pop(channel_number, None)
+        if ch is not None:
+            ch.close()
+        self.sendMethod(channel_number, spec.Channel.Close(
+            reply_code, reply_text, method.INDEX >> 16, method.INDEX & 0xffff))
+
+    def _closeConnection(self, reply_code, reply_text, method=None):
+        self.sendMethod(0, spec.Connection.Close(
+            reply_code, reply_text,
+            method.INDEX >> 16 if method else 0,
+            method.INDEX & 0xffff if method else 0))
+
+    # -- connection
+
+    def amqp_Connection_StartOk(self, _, method):
+        self.sendMethod(0, spec.Connection.Tune(
+            channel_max=0, frame_max=self.frame_max, heartbeat=0))
+
+    def amqp_Connection_TuneOk(self, _, method):
+        if method.frame_max:
+            self.frame_max = min(self.frame_max, method.frame_max)
+
+    def amqp_Connection_Open(self, _, method):
+        self.sendMethod(0, spec.Connection.OpenOk())
+
+    def amqp_Connection_Close(self, _, method):
+        self._closing = True
+        self.sendMethod(0, spec.Connection.CloseOk())
+        self.transport.loseConnection()
+
+    def amqp_Connection_CloseOk(self, _, method):
+        self._closing = True
+        self.transport.loseConnection()
+
+    def connectionLost(self, reason=failure.Failure(ConnectionDone())):
+        logger.debug("fake broker %r: client disconnected", self.broker.name)
+        channels = list(self.channels.values())
+        self.channels.clear()
+        for ch in channels:
+            ch.close()
+        for q in list(self.broker.queues.values()):
+            if q.exclusive_owner is self:
+                self.broker.deleteQueue(q.name)
+
+    # -- channel
+
+    def amqp_Channel_Open(self, channel_number, method):
+        if channel_number in self.channels:
+            self._closeConnection(504, "CHANNEL_ERROR - second 'channel.open'", method)
+            return
+        self.channels[channel_number] = _BrokerChannel(self, channel_number)
+        self.sendMethod(channel_number, spec.Channel.OpenOk())
+
+    def amqp_Channel_Close(self, ch, method):
+        self.channels.pop(ch.number, None)
+        ch.close()
+        self.sendMethod(ch.number, spec.Channel.CloseOk())
+
+    def amqp_Channel_CloseOk(self, channel_number, method):
+        pass
+
+    def amqp_Channel_Flow(self, ch, method):
+        self.sendMethod(ch.number, spec.Channel.FlowOk(method.active))
+
+    def amqp_Confirm_Select(self, ch, method):
+        ch.confirm = True
+        if not method.nowait:
+            self.sendMethod(ch.number, spec.Confirm.SelectOk())
+
+    # -- schema
+
+    def amqp_Exchange_Declare(self, ch, method):
+        self.broker.declareExchange(method.exchange, method.type, method.passive)
+        if not method.nowait:
+            self.sendMethod(ch.number, spec.Exchange.DeclareOk())
+
+    def amqp_Exchange_Delete(self, ch, method):
+        self.broker.deleteExchange(method.exchange)
+        if not method.nowait:
+            self.sendMethod(ch.number, spec.Exchange.DeleteOk())
+
+    def amqp_Exchange_Bind(self, ch, method):
+        self.broker.bind(method.source, method.destination, method.routing_key, True)
+        if not method.nowait:
+            self.sendMethod(ch.number, spec.Exchange.BindOk())
+
+    def amqp_Exchange_Unbind(self, ch, method):
+        self.broker.unbind(method.source, method.destination, method.routing_key, True)
+        if not method.nowait:
+            self.sendMethod(ch.number, spec.Exchange.UnbindOk())
+
+    def amqp_Queue_Declare(self, ch, method):
+        q = self.broker.declareQueue(
+            method.queue,
+            passive=method.passive,
+            durable=method.durable,
+            exclusive_owner=(self if method.exclusive else None),
+            auto_delete=method.auto_delete,
+            arguments=method.arguments,
+        )
+        if not method.nowait:
+            self.sendMethod(ch.number, spec.Queue.DeclareOk(
+                q.name, len(q.messages), len(q.consumers)))
+
+    def amqp_Queue_Bind(self, ch, method):
+        self.broker.bind(method.exchange, method.queue, method.routing_key)
+        if not method.nowait:
+            self.sendMethod(ch.number, spec.Queue.BindOk())
+
+    def amqp_Queue_Unbind(self, ch, method):
+        self.broker.unbind(method.exchange, method.queue, method.routing_key)
+        self.sendMethod(ch.number, spec.Queue.UnbindOk())
+
+    def amqp_Queue_Purge(self, ch, method):
+        q = self.broker.getQueue(method.queue)
+        cnt = len(q.messages)
+        q.messages.clear()
+        if not method.nowait:
+            self.sendMethod(ch.number, spec.Queue.PurgeOk(cnt))
+
+    def amqp_Queue_Delete(self, ch, method):
+        cnt = self.broker.deleteQueue(method.queue)
+        if not method.nowait:
+            self.sendMethod(ch.number, spec.Queue.DeleteOk(cnt))
+
+    # -- basic
+
+    def amqp_Basic_Qos(self, ch, method):
+        ch.prefetch_count = method.prefetch_count
+        self.sendMethod(ch.number, spec.Basic.QosOk())
+        ch._dispatchAll()
+
+    def amqp_Basic_Consume(self, ch, method):
+        c = ch.consume(method.queue, method.consumer_tag, method.no_ack, method.arguments)
+        if not method.nowait:
+            self.sendMethod(ch.number, spec.Basic.ConsumeOk(c.tag))
+        if c.queue is not None:
+            c.queue.dispatch()
+
+    def amqp_Basic_Cancel(self, ch, method):
+        ch.cancelConsumer(method.consumer_tag)
+        if not method.nowait:
+            self.sendMethod(ch.number, spec.Basic.CancelOk(method.consumer_tag))
+
+    def amqp_Basic_Publish(self, ch, method):
+        if method.exchange not in self.broker.exchanges:
+            raise _ChannelError(404, "NOT_FOUND - no exchange '%s'" % method.exchange)
+        ch.startPublish(method)
+
+    def amqp_Basic_Ack(self, ch, method):
+        ch.ack(method.delivery_tag, method.multiple)
+
+    def amqp_Basic_Nack(self, ch, method):
+        ch.reject(method.delivery_tag, method.multiple, method.requeue)
+
+    def amqp_Basic_Reject(self, ch, method):
+        ch.reject(method.delivery_tag, False, method.requeue)
+
+    def amqp_Basic_Recover(self, ch, method):
+        if ch.unacked:
+            ch.reject(0, multiple=True, requeue=True)
+        self.sendMethod(ch.number, spec.Basic.RecoverOk())
+
+
+# --- in-memory transport
+
+@zope.interface.implementer(interfaces.IAddress)
+class _LoopAddress(object):
+
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return "_LoopAddress(%r)" % self.name
+
+
+@zope.interface.implementer(interfaces.ITransport)
+class _LoopTransport(object):
+
+    """Buffers writes and delivers them to peer on next reactor iteration."""
+
+    disconnecting = False
+
+    def __init__(self, clock, address):
+        self.clock = clock
+        self.address = address
+        self.protocol = None
+        self.peer = None
+        self._buffer = []
+        self._flush_call = None
+        self._lost = False
+
+    def write(self, data):
+        if self.disconnecting:
+            return
+        self._buffer.append(data)
+        self._scheduleFlush()
+
+    def writeSequence(self, data):
+        if self.disconnecting:
+            return
+        self._buffer.extend(data)
+        self._scheduleFlush()
+
+    def _scheduleFlush(self):
+        if self._flush_call is None:
+            self._flush_call = self.clock.callLater(0, self._flush)
+
+    def _flush(self):
+        self._flush_call = None
+        if self._buffer and not self.peer._lost:
+            data = b"".join(self._buffer)
+            del self._buffer[:]
+            self.peer.protocol.dataReceived(data)
+
+    def loseConnection(self):
+        if self.disconnecting:
+            return
+        self.disconnecting = True
+        self.clock.callLater(0, self._disconnect)
+
+    abortConnection = loseConnection
+
+    def _disconnect(self):
+        if self._buffer and not self.peer._lost:
+            self._flush()
+        reason = failure.Failure(ConnectionDone())
+        for t in (self, self.peer):
+            if not t._lost:
+                t._lost = True
+                t.disconnecting = True
+                if t._flush_call is not None and t._flush_call.active():
+                    t._flush_call.cancel()
+                t.protocol.connectionLost(reason)
+
+    def getPeer(self):
+        return self.peer.address
+
+    def getHost(self):
+        return self.address
+
+
+@zope.interface.implementer(interfaces.IStreamClientEndpoint)
+class FakeBrokerEndpoint(object):
+
+    """Connects client factory to `FakeBroker` via in-memory transport."""
+
+    def __init__(self, broker, clock=None):
+        self.broker = broker
+        self.clock = clock or broker.clock
+
+    def connect(self, factory):
+        # connection is established asynchronously - like real endpoints do
+        d = defer.Deferred()
+        self.clock.callLater(0, lambda: defer.maybeDeferred(self._connect, factory).chainDeferred(d))
+        return d
+
+    def _connect(self, factory):
+
+        client_addr = _LoopAddress("client")
+        server_addr = _LoopAddress(self.broker.name or "fake-broker")
+
+        p = factory.buildProtocol(server_addr)
+        if p is None:
+            raise ConnectionDone("factory refused connection")
+
+        server = FakeBrokerProtocol(self.broker)
+        ct = _LoopTransport(self.clock, client_addr)
+        st = _LoopTransport(self.clock, server_addr)
+        ct.protocol, st.protocol = p, server
+        ct.peer, st.peer = st, ct
+
+        server.makeConnection(st)
+        p.makeConnection(ct)
+        return p
+
+
+_brokers = {}
+
+
+def getBroker(name):
+    """Returns (creates if needed) named broker, used for `loop:<name>` endpoints."""
+    b = _brokers.get(name)
+    if b is None:
+        b = _brokers[name] = FakeBroker(name)
+    return b
@@ -1,9 +1,12 @@
 # coding: utf-8
 
+import collections
+
 import zope.interface
 
-from twisted.internet import defer, protocol
+from twisted.internet import defer, protocol, reactor
 from twisted.application import service
+from twisted.python import failure
 
 from twoost import timed
 
@@ -14,6 +17,8 @@ logger = logging.getLogger(__name__)
 __all__ = [
     'IHealthChecker',
     'HealthCheckFactory',
+    'CircuitBreaker',
+    'CircuitOpenError',
 ]
 
 
@@ -114,6 +119,176 @@ def parseServicesHealth(ssh):
     return res
 
 
+# --- circuit breaker
+
+class CircuitOpenError(Exception):
+    pass
+
+
+@zope.interface.implementer(IHealthChecker)
+class CircuitBreaker(object):
+
+    """Fails calls fast while backend looks dead.
+
+    Closed breaker watches last `window` calls and opens when share of
+    failed (or slower than `slow_call_duration`) calls reaches
+    `failure_rate` (`slow_call_rate`). Open breaker rejects calls with
+    `CircuitOpenError` for `reset_timeout` seconds, then it is half-open:
+    `half_open_calls` trial calls close it or open it again.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    clock = reactor
+
+    def __init__(
+            self, name=None,
+            failure_rate=0.5, slow_call_duration=None, slow_call_rate=0.5,
+            window=50, min_calls=10,
+            reset_timeout=30, half_open_calls=1,
+            ignore_errors=(),
+    ):
+        assert 0 < failure_rate <= 1 and 0 < slow_call_rate <= 1
+        assert 0 < min_calls <= window
+        self.name = name
+        self.failure_rate = failure_rate
+        self.slow_call_duration = slow_call_duration
+        self.slow_call_rate = slow_call_rate
+        self.window = window
+        self.min_calls = min_calls
+        self.reset_timeout = reset_timeout
+        self.half_open_calls = half_open_calls
+        # errors which don't mean backend failure (app-level errors)
+        self.ignore_errors = tuple(ignore_errors)
+
+        self.state = self.CLOSED
+        self._opened_at = None
+        self._half_opened_at = None
+        # trial calls are counted per half-open period
+        self._half_open_period = 0
+        self._trials_issued = 0
+        self._trial_successes = 0
+        self._resetWindow()
+
+    def _resetWindow(self):
+        self._outcomes = collections.deque()
+        self._failed = 0
+        self._slow = 0
+
+    def _open(self):
+        logger.warning(
+            "open circuit breaker %s, %d of %d calls failed, %d slow",
+            self.name, self._failed, len(self._outcomes), self._slow)
+        self.state = self.OPEN
+        self._opened_at = self.clock.seconds()
+        self._resetWindow()
+
+    def _close(self):
+        logger.info("close circuit breaker %s", self.name)
+        self.state = self.CLOSED
+        self._resetWindow()
+
+    def _halfOpen(self, now):
+        logger.debug("circuit breaker %s is half-open", self.name)
+        self.state = self.HALF_OPEN
+        self._half_opened_at = now
+        self._half_open_period += 1
+        self._trials_issued = 0
+        self._trial_successes = 0
+
+    def _acquire(self):
+        now = self.clock.seconds()
+        if self.state == self.OPEN:
+            if now - self._opened_at < self.reset_timeout:
+                raise CircuitOpenError("circuit breaker %s is open" % (self.name or ""))
+            self._halfOpen(now)
+        elif (self.state == self.HALF_OPEN
+              and self._trials_issued >= self.half_open_calls
+              and now - self._half_opened_at >= self.reset_timeout):
+            # trials are hung - let new ones in
+            self._halfOpen(now)
+        if self.state == self.HALF_OPEN:
+            # no more than `half_open_calls` trials, even when some are finished
+            if self._trials_issued >= self.half_open_calls:
+                raise CircuitOpenError("circuit breaker %s is half-open" % (self.name or ""))
+            self._trials_issued += 1
+            return self._half_open_period
+        return None
+
+    def call(self, f, *args, **kwargs):
+        try:
+            trial = self._acquire()
+        except CircuitOpenError:
+            return defer.fail()
+        started = self.clock.seconds()
+        d = defer.maybeDeferred(f, *args, **kwargs)
+        return d.addBoth(self._onResult, trial, started)
+
+    def _onResult(self, result, trial, started):
+
+        failed = (
+            isinstance(result, failure.Failure)
+            and not (self.ignore_errors and result.check(*self.ignore_errors)))
+        slow = bool(
+            self.slow_call_duration
+            and self.clock.seconds() - started > self.slow_call_duration)
+
+        if trial:
+            # ignore trials of previous half-open periods
+            if self.state == self.HALF_OPEN and trial == self._half_open_period:
+                if failed or slow:
+                    self._open()
+                else:
+                    self._trial_successes += 1
+                    if self._trial_successes >= self.half_open_calls:
+                        self._close()
+
+        elif self.state == self.CLOSED:
+            self._outcomes.append((failed, slow))
+            self._failed += failed
+            self._slow += slow
+            if len(self._outcomes) > self.window:
+                f, s = self._outcomes.popleft()
+                self._failed -= f
+                self._slow -= s
+            n = len(self._outcomes)
+            if n >= self.min_calls and (
+                    self._failed >= self.failure_rate * n
+                    or (self.slow_call_duration and self._slow >= self.slow_call_rate * n)):
+                self._open()
+
+        return result
+
+    def stats(self):
+        return {
+            'state': self.state,
+            'calls': len(self._outcomes),
+            'failed': self._failed,
+            'slow': self._slow,
+        }
+
+    def checkHealth(self):
+        if self.state == self.OPEN:
+            left = self.reset_timeout - (self.clock.seconds() - self._opened_at)
+            raise CircuitOpenError("circuit breaker is open, retry in %d secs" % max(left, 0))
+        return "circuit breaker is %s" % self.state
+
+
+def makeCircuitBreaker(params, name=None):
+    """Builds breaker from config value (`None`, `True`, dict or breaker itself)."""
+    if not params:
+        return None
+    if isinstance(params, CircuitBreaker):
+        return params
+    if params is True:
+        params = {}
+    params = dict(params)
+    params.setdefault('name', name)
+    return CircuitBreaker(**params)
+
+
 class HealthCheckProtocol(protocol.Protocol):
 
     def responseAppHealth(self, h):
@@ -1,5 +1,8 @@
 # coding: utf-8
 
+import math
+import bisect
+import hashlib
 import itertools
 import functools
 
@@ -115,6 +118,74 @@ class _MemCacheMultiClientProxy(object):
         raise NotImplementedError
 
 
+class KetamaRing(object):
+
+    """Consistent hashing of keys to servers, compatible with libketama.
+
+    `servers` is dict `name => (address, weight)`. Keys of dead servers
+    (`isAlive(name)` is false) go to the next alive server on the ring,
+    keys of alive servers don't move. With equal weights it is the same
+    as the ring rebuilt without dead servers (otherwise rebuilt ring
+    would redistribute points by the new total weight).
+    """
+
+    hashes_per_server = 40
+
+    def __init__(self, servers, isAlive=None):
+        self.isAlive = isAlive
+        total_weight = float(sum(w for _, w in servers.values()))
+        points = []
+        for name, (address, weight) in sorted(servers.items()):
+            ks = int(math.floor(weight / total_weight * self.hashes_per_server * len(servers)))
+            for k in range(ks):
+                digest = bytearray(hashlib.md5("%s-%d" % (address, k)).digest())
+                for h in range(4):
+                    points.append((self._point(digest, h), name))
+        points.sort()
+        self._points = [p for p, _ in points]
+        self._names = [n for _, n in points]
+
+    @staticmethod
+    def _point(digest, h):
+        return (
+            (digest[3 + h * 4] << 24)
+            | (digest[2 + h * 4] << 16)
+            | (digest[1 + h * 4] << 8)
+            | digest[h * 4])
+
+    @classmethod
+    def hashKey(cls, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        return cls._point(bytearray(hashlib.md5(key).digest()), 0)
+
+    def lookup(self, key):
+
+        n = len(self._points)
+        i = bisect.bisect_left(self._points, self.hashKey(key))
+        if i == n:
+            i = 0
+
+        name = self._names[i]
+        if self.isAlive is None or self.isAlive(name):
+            return name
+
+        dead = set([name])
+        for j in xrange(1, n):
+            nm = self._names[(i + j) % n]
+            if nm in dead:
+                continue
+            if self.isAlive(nm):
+                logger.debug("server %r is dead, use %r for key %r", name, nm, key)
+                return nm
+            dead.add(nm)
+
+        # everything is dead
+        return name
+
+    __call__ = lookup
+
+
 class MemCacheFactory(PersistentClientFactory):
     protocol = MemCacheProtocol
 
@@ -149,5 +220,23 @@ class MemCacheService(PersistentClientsCollectionService):
         'callretry_delay': 0,
     }
 
-    def multiClient(self, resolveClientNameByKey):
+    _ketama_ring = None
+
+    def ketamaRing(self):
+        if self._ketama_ring is None:
+            servers = {}
+            for name, params in self.connections.items():
+                p = dict(self.defaultParams)
+                p.update(params)
+                address = p.get('endpoint') or "%s:%s" % (p['host'], p['port'])
+                servers[name] = address, p.get('weight', 1)
+            self._ketama_ring = KetamaRing(servers, isAlive=self._isClientAlive)
+        return self._ketama_ring
+
+    def _isClientAlive(self, name):
+        return self.getServiceNamed(name).isReady()
+
+    def multiClient(self, resolveClientNameByKey=None):
+        if resolveClientNameByKey is None:
+            resolveClientNameByKey = self.ketamaRing()
         return _MemCacheMultiClientProxy(self, resolveClientNameByKey)
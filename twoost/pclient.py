@@ -6,9 +6,10 @@ from __future__ import print_function, division
 Persisten protocol.
 """
 
+import heapq
 import random
+import itertools
 import collections
-import functools
 
 import zope.interface
 
@@ -29,6 +30,7 @@ __all__ = [
     'PersistentClientProtocol',
     'PersistentClientFactory',
     'PersistentClientService',
+    'PooledPersistentClientService',
     'NoPersisentClientConnection',
     'PersistentClientsCollectionService',
 ]
@@ -93,6 +95,15 @@ class PersistentClientService(service.Service):
     # retryConnection calls after reconnect
     callretry_delay = 15
     callretry_max_count = 500
+    callretry_max_bytes = None  # approx size of args of delayed calls
+    callretry_replay_rate = None  # calls per second, all at once by default
+    callretry_replay_tick = 0.1
+
+    # `health.CircuitBreaker` (or its params)
+    circuit_breaker = None
+
+    # called with the service when it may become (not) ready
+    readinessChanged = None
 
     # -- state
     clock = reactor
@@ -104,14 +115,21 @@ class PersistentClientService(service.Service):
     _protocolStoppingDeferred = None
     _disconnectCallID = None
     _delayedCalls = None
+    _delayedCallsDeadlines = None
     _delayedCallsCnt = 0
+    _delayedCallsBytes = 0
+    _delayedCallsTimer = None
+    _delayedCallsReplay = None
 
     def __init__(self, endpoint, factory, **kwargs):
 
         self.endpoint = endpoint
         self.factory = factory
 
+        # cid => call, in order of calls (for replay)
         self._delayedCalls = collections.OrderedDict()
+        # heap of (expires, cid), may contain already finished calls
+        self._delayedCallsDeadlines = []
         self.reconnect_delay = self.reconnect_initial_delay
         self._reconnect_retries = 0
 
@@ -123,11 +141,17 @@ class PersistentClientService(service.Service):
                 'reconnect_max_retries',
                 'disconnect_delay',
                 'callretry_delay',
-                'callretry_delay',
+                'callretry_max_count',
+                'callretry_max_bytes',
+                'callretry_replay_rate',
+                'callretry_replay_tick',
         ]:
             if p in kwargs:
                 setattr(self, p, kwargs[p])
 
+        self.circuit_breaker = health.makeCircuitBreaker(
+            kwargs.get('circuit_breaker', self.circuit_breaker), name=repr(endpoint))
+
     def startService(self):
         logger.debug("start pclient service %r", self)
         service.Service.startService(self)
@@ -166,27 +190,52 @@ class PersistentClientService(service.Service):
         return f.check(ConnectionClosed)
 
     def protocolCall(self, method_name, *args, **kwargs):
-        logger.debug("on %s call %s(%r, %r)", self, method_name, args, kwargs)
+        if self.circuit_breaker is None:
+            return self._protocolCall(method_name, *args, **kwargs)
+        d = self.circuit_breaker.call(self._protocolCall, method_name, *args, **kwargs)
+        return d.addErrback(self._trapCircuitOpen)
+
+    def _trapCircuitOpen(self, f):
+        f.trap(health.CircuitOpenError)
+        raise self.noClientError("circuit breaker is open")
 
+    def _protocolCall(self, method_name, *args, **kwargs):
         p = self.getProtocol()
-        if p:
-            wm = getattr(self._protocol, method_name)
-            logger.debug("on %s call %s(%r, %r)", wm, method_name, args, kwargs)
-            d = defer.maybeDeferred(wm, *args, **kwargs)
+        # keep FIFO order - don't overtake calls waiting for (paced) replay
+        if p and not self._delayedCalls:
+            d = defer.maybeDeferred(getattr(p, method_name), *args, **kwargs)
             if self.callretry_delay:
-                def handle_connection_done(e):
-                    if self.needToRetryProtocolCall(e):
-                        return self._protocolCallDelayed(method_name, *args, **kwargs)
-                    else:
-                        return e
-
-                d.addErrback(handle_connection_done)
+                d.addErrback(self._retryProtocolCall, method_name, args, kwargs)
             return d
         else:
+            logger.debug(
+                "no protocol on %s or replay in progress - delay call %s(%r, %r)",
+                self, method_name, args, kwargs)
+            return defer.maybeDeferred(self._protocolCallDelayed, method_name, *args, **kwargs)
+
+    def _retryProtocolCall(self, f, method_name, args, kwargs):
+        if self.needToRetryProtocolCall(f):
             return self._protocolCallDelayed(method_name, *args, **kwargs)
+        return f
 
     def _buildProtocolCallProxy(self, name):
-        return functools.partial(self.protocolCall, name)
+
+        protocol_call = self.protocolCall
+
+        def proxy(*args, **kwargs):
+            p = self.getProtocol()
+            if (p is None or self.callretry_delay or self._delayedCalls
+                    or self.circuit_breaker is not None):
+                return protocol_call(name, *args, **kwargs)
+            # fast path - no retries, so no errbacks are needed
+            try:
+                r = getattr(p, name)(*args, **kwargs)
+            except Exception:
+                return defer.fail()
+            return r if isinstance(r, defer.Deferred) else defer.succeed(r)
+
+        proxy.__name__ = name
+        return proxy
 
     def __getattr__(self, name):
         if name in self.protocolProxiedMethods:
@@ -201,53 +250,113 @@ class PersistentClientService(service.Service):
         if not rd or rd < self.reconnect_delay:
             return failure.Failure(self.noClientError("no active client"))
 
-        if len(self._delayedCalls) > self.callretry_max_count:
+        if len(self._delayedCalls) >= self.callretry_max_count:
             return failure.Failure(
                 self.noClientError("no active client - too many delayed calls"))
 
-        delay = self.callretry_delay
-        if self.reconnect_delay_jitter:
-            delay = random.normalvariate(
-                delay,
-                delay * self.reconnect_delay_jitter)
-
-        def on_timeout():
-            _, d = self._delayedCalls.pop(cid, (None, None))
-            if d and not d.called:
-                d.errback(self.noClientError("no active client - timeout"))
-
-        def on_cancel(result):
-            self._delayedCalls.pop(cid, None)
-            if rcall and rcall.active():
-                rcall.cancel()
-            return result
+        size = _estimateCallSize(args, kwargs)
+        max_bytes = self.callretry_max_bytes
+        if max_bytes and self._delayedCallsBytes + size > max_bytes:
+            return failure.Failure(
+                self.noClientError("no active client - delayed calls are too big"))
 
         logger.debug("schedule %s(*%r, **%r)", method, args, kwargs)
         self._delayedCallsCnt += 1
         cid = self._delayedCallsCnt
 
-        rcall = self.clock.callLater(delay, on_timeout)
-        d = defer.Deferred().addBoth(on_cancel)
-        self._delayedCalls[cid] = ((method, args, kwargs), d)
+        # `callretry_delay` may be changed, so calls aren't ordered by expiration time
+        expires = self.clock.seconds() + rd
+        d = defer.Deferred().addBoth(self._forgetDelayedCall, cid)
+        self._delayedCalls[cid] = (expires, size, method, args, kwargs, d)
+        heapq.heappush(self._delayedCallsDeadlines, (expires, cid))
+        self._delayedCallsBytes += size
+        self._scheduleDelayedCallsTimer()
 
         return d
 
+    def _forgetDelayedCall(self, result, cid):
+        dc = self._delayedCalls.pop(cid, None)
+        if dc is not None:
+            self._delayedCallsBytes -= dc[1]
+        if not self._delayedCalls:
+            del self._delayedCallsDeadlines[:]
+            self._cancelDelayedCallsTimer()
+        return result
+
+    def _cancelDelayedCallsTimer(self):
+        if self._delayedCallsTimer is not None and self._delayedCallsTimer.active():
+            self._delayedCallsTimer.cancel()
+        self._delayedCallsTimer = None
+
+    def _scheduleDelayedCallsTimer(self):
+        # one timer for all calls - fires at the nearest expiration time
+        deadlines = self._delayedCallsDeadlines
+        while deadlines and deadlines[0][1] not in self._delayedCalls:
+            heapq.heappop(deadlines)
+        if not deadlines:
+            return
+        expires = deadlines[0][0]
+        timer = self._delayedCallsTimer
+        if timer is not None and timer.active():
+            if timer.getTime() <= expires:
+                return
+            timer.cancel()
+        self._delayedCallsTimer = self.clock.callLater(
+            max(0, expires - self.clock.seconds()), self._expireDelayedCalls)
+
+    def _expireDelayedCalls(self):
+        self._delayedCallsTimer = None
+        now = self.clock.seconds()
+        deadlines = self._delayedCallsDeadlines
+        while deadlines and deadlines[0][0] <= now:
+            _, cid = heapq.heappop(deadlines)
+            dc = self._delayedCalls.get(cid)
+            if dc is not None:
+                dc[-1].errback(self.noClientError("no active client - timeout"))
+        self._scheduleDelayedCallsTimer()
+
     def _runDelayedCalls(self):
-        logger.debug("run delayed calls on %s", self)
-        assert self.getProtocol()
-        smc = list(self._delayedCalls.values())
-        self._delayedCalls.clear()
-        for (name, args, kwargs), d in smc:
+
+        if self._delayedCallsReplay is not None and self._delayedCallsReplay.active():
+            self._delayedCallsReplay.cancel()
+        self._delayedCallsReplay = None
+        p = self.getProtocol()
+        if not p or not self._delayedCalls:
+            return
+
+        rate = self.callretry_replay_rate
+        if rate:
+            n = max(1, int(rate * self.callretry_replay_tick))
+        else:
+            n = len(self._delayedCalls)
+        logger.debug("run %d of %d delayed calls on %s", n, len(self._delayedCalls), self)
+
+        for _ in range(min(n, len(self._delayedCalls))):
+            _, (_, size, name, args, kwargs, d) = self._delayedCalls.popitem(last=False)
+            self._delayedCallsBytes -= size
             logger.debug("call %s(*%r, **%r)", name, args, kwargs)
-            wm = getattr(self._protocol, name)
-            dd = defer.maybeDeferred(wm, *args, **kwargs)
-            dd.chainDeferred(d)
+            wm = getattr(p, name)
+            defer.maybeDeferred(wm, *args, **kwargs).chainDeferred(d)
+
+        if self._delayedCalls:
+            # paced replay - don't flood just reconnected server
+            self._delayedCallsReplay = self.clock.callLater(
+                self.callretry_replay_tick, self._runDelayedCalls)
+        else:
+            del self._delayedCallsDeadlines[:]
+            self._cancelDelayedCallsTimer()
 
     def _dropDelayedCalls(self):
         logger.debug("drop delayed calls on %s", self)
-        for _, d in list(self._delayedCalls.itervalues()):
+        if self._delayedCallsReplay is not None and self._delayedCallsReplay.active():
+            self._delayedCallsReplay.cancel()
+        self._delayedCallsReplay = None
+        for _, _, _, _, _, d in list(self._delayedCalls.values()):
             d.cancel()
         self._delayedCalls.clear()
+        del self._delayedCallsDeadlines[:]
+        self._delayedCallsBytes = 0
+        self._cancelDelayedCallsTimer()
 
     # --- connection stuff
 
@@ -255,8 +364,13 @@ class PersistentClientService(service.Service):
         assert isinstance(protocol_proxy, _PClientProtocolProxy)
         return self.clientConnected(protocol_proxy._protocol)
 
+    def _notifyReadiness(self):
+        if self.readinessChanged is not None:
+            self.readinessChanged(self)
+
     def clientConnected(self, protocol):
         self._protocol = protocol
+        self._notifyReadiness()
 
         if IPersistentClientProtocol.providedBy(protocol):
             prd = protocol.notifyProtocolReady()
@@ -276,6 +390,7 @@ class PersistentClientService(service.Service):
     def clientConnectionLost(self, reason):
         logger.debug("connection on %s lost: %s", self, reason)
         self._protocol = None
+        self._notifyReadiness()
         self._cancelDisconnectCall()
         if self._protocolStoppingDeferred is not None:
             d = self._protocolStoppingDeferred
@@ -285,15 +400,20 @@ class PersistentClientService(service.Service):
 
     def clientProtocolFailed(self, reason):
         self._protocol_ready = False
+        self._notifyReadiness()
         logger.error("%s protocol failed: %s", self, reason)
 
     def getProtocol(self):
         if self._protocol and self._protocol_ready:
             return self._protocol
 
+    def isReady(self):
+        return bool(self._protocol and self._protocol_ready)
+
     def clientProtocolReady(self, protocol):
         logger.debug("client protocol ready")
         self._protocol_ready = True
+        self._notifyReadiness()
         self.resetReconnectDelay()
         self._runDelayedCalls()
         self._scheduleDisconnect()
@@ -380,10 +500,138 @@ class PersistentClientService(service.Service):
         self._scheduleDisconnect()
 
     def checkHealth(self):
+        if self.circuit_breaker is not None:
+            self.circuit_breaker.checkHealth()
         if not self.getProtocol():
             raise Exception("reconnect in %s secs" % int(self.reconnect_delay))
 
 
+@zope.interface.implementer(health.IHealthChecker)
+class PooledPersistentClientService(service.MultiService):
+
+    """Keeps `pool_size` persistent connections to one endpoint.
+
+    Each connection is a `clientService` (reconnects independently),
+    calls are dispatched to the ready connection with the least
+    count of calls in progress.
+    """
+
+    # list of proxied methods (delegate to one of connections)
+    protocolProxiedMethods = []
+
+    clientService = PersistentClientService
+
+    def __init__(self, endpoint, factory, pool_size=4, clientService=None, **kwargs):
+        service.MultiService.__init__(self)
+        assert pool_size > 0
+
+        self.endpoint = endpoint
+        self.factory = factory
+        self.pool_size = pool_size
+        if clientService is not None:
+            self.clientService = clientService
+
+        self._rr_counter = 0
+        # connection name => calls in progress (services are old-style
+        # classes, hashing them goes through `__getattr__`)
+        self._busy = {}
+        # ready connections, updated by `readinessChanged` hook
+        self._ready = []
+        for i in range(pool_size):
+            s = self.clientService(endpoint, factory, **kwargs)
+            s.setName(str(i))
+            s.readinessChanged = self._clientReadinessChanged
+            s.setServiceParent(self)
+            self._busy[s.name] = 0
+
+    def _clientReadinessChanged(self, client):
+        # rare event, so just rebuild the list (keeping order of connections)
+        self._ready = [s for s in self.services if s.isReady()]
+
+    def _leastBusyClient(self, start):
+        ready = self._ready
+        n = len(ready)
+        busy = self._busy
+        best = None
+        best_busy = None
+        # round robin between equally busy connections
+        for i in xrange(n):
+            s = ready[(start + i) % n]
+            cb = s.circuit_breaker
+            if cb is not None and cb.state == cb.OPEN:
+                continue
+            b = busy[s.name]
+            if best is None or b < best_busy:
+                if not b:
+                    return s
+                best = s
+                best_busy = b
+        if best is None:
+            # delay call (or fail) on any connection
+            return self.services[start % len(self.services)]
+        return best
+
+    def _selectClient(self):
+        self._rr_counter += 1
+        return self._leastBusyClient(self._rr_counter)
+
+    def _callDone(self, result, name):
+        self._busy[name] -= 1
+        return result
+
+    def protocolCall(self, method_name, *args, **kwargs):
+        s = self._selectClient()
+        self._busy[s.name] += 1
+        return s.protocolCall(method_name, *args, **kwargs).addBoth(self._callDone, s.name)
+
+    def _buildProtocolCallProxy(self, name):
+
+        # connection => its own (fast path) proxy
+        proxies = dict((s.name, s._buildProtocolCallProxy(name)) for s in self.services)
+        select_client = self._selectClient
+        call_done = self._callDone
+        busy = self._busy
+
+        def proxy(*args, **kwargs):
+            n = select_client().name
+            busy[n] += 1
+            return proxies[n](*args, **kwargs).addBoth(call_done, n)
+
+        proxy.__name__ = name
+        return proxy
+
+    def __getattr__(self, name):
+        if name in self.protocolProxiedMethods:
+            m = self._buildProtocolCallProxy(name)
+            setattr(self, name, m)
+            return m
+        raise AttributeError(name)
+
+    def getProtocol(self):
+        return self._leastBusyClient(self._rr_counter).getProtocol()
+
+    def isReady(self):
+        # any connection is ready
+        return bool(self._ready)
+
+    def dropConnection(self):
+        return defer.gatherResults([s.dropConnection() for s in self.services])
+
+    def checkHealth(self):
+        # each connection is checked by itself too (as subservice)
+        ready = sum(1 for s in self.services if s.isReady())
+        if not ready:
+            raise Exception("no ready connections (of %d)" % len(self.services))
+        return "%d of %d connections are ready" % (ready, len(self.services))
+
+
+def _estimateCallSize(args, kwargs):
+    size = 0
+    for x in itertools.chain(args, kwargs.values()):
+        size += len(x) if isinstance(x, basestring) else 8
+    return size
+
+
 class _PClientProtocolProxy(TheProxy):
     """A proxy for a Protocol to provide connectionLost notification."""
 
@@ -425,6 +673,7 @@ class PersistentClientsCollectionService(service.MultiService):
 
     factory = None
     clientService = PersistentClientService
+    pooledClientService = PooledPersistentClientService
     protocolProxiedMethods = None
     defaultParams = {}
 
@@ -447,7 +696,15 @@ class PersistentClientsCollectionService(service.MultiService):
         return self.factory(**params)
 
     def buildClientService(self, endpoint, factory, params):
-        s = self.clientService(endpoint, factory, **params)
+        params = dict(params)
+        params.pop('endpoint', None)  # endpoint string is already parsed
+        pool_size = params.pop('pool_size', None)
+        if pool_size:
+            s = self.pooledClientService(
+                endpoint, factory, pool_size=pool_size,
+                clientService=self.clientService, **params)
+        else:
+            s = self.clientService(endpoint, factory, **params)
         if self.protocolProxiedMethods:
             s.protocolProxiedMethods = self.protocolProxiedMethods
         return s
@@ -1,5 +1,7 @@
 # coding: utf-8
 
+import functools
+
 import zope.interface
 
 from twisted.internet import reactor, defer
@@ -21,9 +23,13 @@ __all__ = [
 
 class _BaseRPCService(service.Service):
 
-    def __init__(self, timeout=60, parallel=None):
-        self.timeout = 60
+    def __init__(self, timeout=60, parallel=None, circuit_breaker=None):
+        self.timeout = timeout
         self.parallel = parallel
+        # shared by all callers, so timeouts of one method fail others fast
+        self.circuit_breaker = health.makeCircuitBreaker(circuit_breaker)
+        if self.circuit_breaker is not None:
+            zope.interface.alsoProvides(self, health.IHealthChecker)
 
     def callRemote(self, *args):
         raise NotImplementedError
@@ -35,13 +41,22 @@ class _BaseRPCService(service.Service):
         def call(*args):
             return self.callRemote(method, *args)
 
-        return call
+        if self.circuit_breaker is None:
+            return call
+
+        # check breaker before waiting for parallel limit
+        return functools.partial(self.circuit_breaker.call, call)
+
+    def checkHealth(self):
+        if self.circuit_breaker is None:
+            raise NotImplementedError
+        return self.circuit_breaker.checkHealth()
 
 
 class LoopRPCProxy(_BaseRPCService):
 
-    def __init__(self, target, timeout=60.0):
-        _BaseRPCService.__init__(self, timeout)
+    def __init__(self, target, timeout=60.0, circuit_breaker=None):
+        _BaseRPCService.__init__(self, timeout, circuit_breaker=circuit_breaker)
         self.target = target
 
     def callRemote(self, method, *args):
@@ -54,12 +69,12 @@ class _NoiselessHTTP11ClientFactory(client.HTTPConnectionPool._factory):
 
 class _HTTPClientProxyService(_BaseRPCService):
 
-    def __init__(self, http_pool, proxy, timeout=60):
-        _BaseRPCService.__init__(self, timeout)
+    def __init__(self, http_pool, proxy, timeout=60, circuit_breaker=None):
+        _BaseRPCService.__init__(self, timeout, circuit_breaker=circuit_breaker)
         self.http_pool = http_pool
         self.proxy = proxy
         if health.IHealthChecker.providedBy(proxy):
-            zope.interface.directlyProvides(self, health.IHealthChecker)
+            zope.interface.alsoProvides(self, health.IHealthChecker)
 
     def callRemote(self, method, *args):
         return self.proxy.callRemote(method, *args)
@@ -71,6 +86,10 @@ class _HTTPClientProxyService(_BaseRPCService):
         yield defer.maybeDeferred(service.Service.stopService, self)
 
     def checkHealth(self):
+        if not health.IHealthChecker.providedBy(self.proxy):
+            return _BaseRPCService.checkHealth(self)
+        if self.circuit_breaker is not None:
+            self.circuit_breaker.checkHealth()
         return self.proxy.checkHealth()
 
 
@@ -111,7 +130,9 @@ def make_xmlrpc_proxy(params):
     http_pool, agent = make_http_pool_and_agent(params)
     logger.debug("create xml-proxy, url %r", url)
     proxy = httprpc.XMLRPCProxy(url, agent=agent)
-    return _HTTPClientProxyService(http_pool, proxy, timeout=timeout)
+    return _HTTPClientProxyService(
+        http_pool, proxy, timeout=timeout,
+        circuit_breaker=params.get('circuit_breaker'))
 
 
 def make_dumbrpc_proxy(params):
@@ -120,7 +141,63 @@ def make_dumbrpc_proxy(params):
     http_pool, agent = make_http_pool_and_agent(params)
     logger.debug("create dumprpc-proxy, url %r", url)
     proxy = httprpc.DumbRPCProxy(url, agent=agent)
-    return _HTTPClientProxyService(http_pool, proxy, timeout=timeout)
+    return _HTTPClientProxyService(
+        http_pool, proxy, timeout=timeout,
+        circuit_breaker=params.get('circuit_breaker'))
+
+
+@zope.interface.implementer(health.IHealthChecker)
+class _AMQPRPCProxyService(_BaseRPCService):
+
+    def __init__(self, proxy, amqp_service=None, timeout=60, circuit_breaker=None):
+        _BaseRPCService.__init__(self, timeout, circuit_breaker=circuit_breaker)
+        self.proxy = proxy
+        # own connection, `None` when shared one is used
+        self.amqp_service = amqp_service
+
+    def callRemote(self, method, *args):
+        return self.proxy.callRemote(method, *args)
+
+    def startService(self):
+        if self.amqp_service is not None:
+            self.amqp_service.startService()
+        _BaseRPCService.startService(self)
+
+    @defer.inlineCallbacks
+    def stopService(self):
+        self.proxy.close()
+        if self.amqp_service is not None:
+            yield defer.maybeDeferred(self.amqp_service.stopService)
+        yield defer.maybeDeferred(service.Service.stopService, self)
+
+    def checkHealth(self):
+        if self.circuit_breaker is not None:
+            self.circuit_breaker.checkHealth()
+        return self.proxy.checkHealth()
+
+
+def make_amqprpc_proxy(params):
+
+    from twoost import amqp, amqprpc
+
+    queue = params['queue']
+    exchange = params.get('exchange', '')
+    timeout = params.get('timeout', 60.0)
+
+    # connection params or already running `AMQPService`
+    conn = params.get('amqp')
+    if isinstance(conn, dict):
+        own_service = amqp.AMQPCollectionService({'amqprpc': conn})
+        amqp_service = own_service['amqprpc']
+    else:
+        own_service = None
+        amqp_service = conn
+
+    logger.debug("create amqprpc-proxy, queue %r, exchange %r", queue, exchange)
+    proxy = amqprpc.AMQPRPCProxy(amqp_service, queue, exchange=exchange, timeout=timeout)
+    return _AMQPRPCProxyService(
+        proxy, own_service, timeout=timeout,
+        circuit_breaker=params.get('circuit_breaker'))
 
 
 def make_loop_proxy(params):
@@ -129,13 +206,16 @@ def make_loop_proxy(params):
     if isinstance(target, basestring):
         target = reflect.namedAny(target)
     logger.debug("create loop-rpc-proxy, target is %r", target)
-    return LoopRPCProxy(target=target, timeout=timeout)
+    return LoopRPCProxy(
+        target=target, timeout=timeout,
+        circuit_breaker=params.get('circuit_breaker'))
 
 
 RPC_PROXY_FACTORY = {
     'xmlrpc': make_xmlrpc_proxy,
     'dumbrpc': make_dumbrpc_proxy,
     'loop': make_loop_proxy,
+    'amqprpc': make_amqprpc_proxy,
 }
 
 
@@ -2,13 +2,18 @@
 
 from __future__ import print_function, division, absolute_import
 
+import os
+import json
+import zlib
 import zope.interface
 
-from twisted.internet import reactor, endpoints
+from twisted.internet import reactor, endpoints, task
 from twisted.internet import defer
-from twisted.trial.unittest import TestCase
+from twisted.trial.unittest import TestCase, SkipTest
 
-from twoost import amqp
+from pika import spec
+
+from twoost import amqp, fakeamqp
 from twoost.timed import sleep
 
 import twisted.internet.base  # noqa
@@ -17,6 +22,9 @@ import logging
 logger = logging.getLogger(__name__)
 
 
+# use in-process fake broker when real one is not specified
+AMQP_TEST_HOST = os.environ.get('TWOOST_TEST_AMQP_HOST')
+
 Q1 = 'test_mcstats_amqp_queue_1'
 QX = 'test_mcstats_amqp_queue_x'
 
@@ -69,6 +77,674 @@ class SingleExchangeSchema(object):
 
 # tests
 
+class SerializersRegistryTest(TestCase):
+
+    def test_lookup(self):
+        r = amqp.SerializersRegistry({'json': json, None: amqp._NopeSerializer})
+        self.assertIs(json, r.lookup('json'))
+        self.assertIs(json, r.lookup('JSON'))
+        self.assertIs(amqp._NopeSerializer, r.lookup(''))
+        self.assertRaises(KeyError, r.lookup, 'application/xml')
+
+    def test_register_drops_cache(self):
+        r = amqp.SerializersRegistry({'json': json})
+        self.assertIs(json, r.lookup('Json'))
+        r['json'] = amqp._NopeSerializer
+        self.assertIs(amqp._NopeSerializer, r.lookup('Json'))
+
+    def test_msgpack_bin_type(self):
+        if not amqp.msgpack:
+            raise SkipTest("msgpack is not installed")
+        s = amqp.MsgpackSerializer(use_bin_type=True)
+        data = {u'text': u'\u0442\u0435\u043a\u0441\u0442', u'raw': b'\xff\x00'}
+        self.assertEqual(data, s.loads(s.dumps(data)))
+        self.assertIsInstance(s.loads(s.dumps(b'\xff')), bytes)
+
+
+class AMQPMessageTest(TestCase):
+
+    def makeMessage(self, body, **props):
+        return amqp.AMQPMessage(
+            body=body,
+            deliver=spec.Basic.Deliver('ct-1', 7, True, E1, Q1),
+            properties=spec.BasicProperties(**props),
+        )
+
+    def test_fields(self):
+        m = self.makeMessage("BODY", content_type='plain/text', message_id='m1')
+        self.assertEqual("BODY", m.body)
+        self.assertEqual(7, m.delivery_tag)
+        self.assertEqual('ct-1', m.consumer_tag)
+        self.assertTrue(m.redelivered)
+        self.assertEqual(E1, m.exchange)
+        self.assertEqual(Q1, m.routing_key)
+        self.assertEqual('plain/text', m.content_type)
+        self.assertEqual('m1', m.message_id)
+        self.assertRaises(AttributeError, setattr, m, 'some_attr', 1)
+
+    def test_lazy_data(self):
+        m = self.makeMessage('{"x": [1, 2]}', content_type='json')
+        self.assertIs(amqp._NOT_DECODED, m._data)
+        self.assertEqual({'x': [1, 2]}, m.data)
+        self.assertIs(m.data, m.data)
+
+
+class CompressionTest(TestCase):
+
+    def test_roundtrip(self):
+        data = {'x': "y" * 1000}
+        for enc in ['zlib', 'deflate', 'gzip', 'lz4', 'zstd']:
+            if enc not in amqp.MESSAGE_ENCODINGS:
+                continue
+            body = amqp.serialize(data, 'json', content_encoding=enc)
+            self.assertTrue(len(body) < 1000, enc)
+            self.assertEqual(data, amqp.deserialize(body, 'json', content_encoding=enc))
+
+    def test_gzip_format(self):
+        import gzip
+        import StringIO
+        body = amqp.encode("hello", 'gzip')
+        self.assertEqual("hello", gzip.GzipFile(fileobj=StringIO.StringIO(body)).read())
+
+    def test_unknown_encoding(self):
+        self.assertEqual("{}", amqp.decode("{}", 'utf-8'))
+        self.assertRaises(KeyError, amqp.encode, "{}", 'utf-8')
+
+    def test_message_data(self):
+        m = amqp.AMQPMessage(
+            body=amqp.encode('{"x": 1}', 'gzip'),
+            deliver=spec.Basic.Deliver('ct-1', 7, True, E1, Q1),
+            properties=spec.BasicProperties(content_type='json', content_encoding='gzip'),
+        )
+        self.assertEqual({'x': 1}, m.data)
+
+    def test_threshold(self):
+
+        class Channel(object):
+            is_open = True
+            published = []
+
+            def basic_publish(self, exchange, routing_key, body, properties=None):
+                self.published.append((exchange, routing_key, body, properties))
+
+        ch = Channel()
+        p = amqp._AMQPProtocol(parameters={}, compression='zlib', compression_threshold=100)
+        p._ready_for_publish = True
+        p._write_channels = [amqp._PublishChannel(ch, confirm=False)]
+
+        p.publishMessage('', Q1, "small", confirm=False)
+        p.publishMessage('', Q1, "x" * 100, confirm=False)
+        p.publishMessages('', [(Q1, "small"), (Q1, "x" * 100)], confirm=False)
+        # already encoded body
+        p.publishMessage('', Q1, "y" * 100, confirm=False, properties={'content_encoding': 'gzip'})
+
+        self.assertEqual(
+            [None, 'zlib', None, 'zlib', 'gzip'],
+            [props.content_encoding for _, _, _, props in ch.published])
+        self.assertEqual("x" * 100, zlib.decompress(ch.published[1][2]))
+        self.assertEqual("y" * 100, ch.published[4][2])
+
+
+class _FakeQosChannel(object):
+
+    def __init__(self):
+        self.qos = []
+
+    def basic_qos(self, prefetch_count, all_channels):
+        self.qos.append(prefetch_count)
+
+
+class _FakePendingQueue(object):
+
+    def __init__(self):
+        self.pending = []
+
+
+class ConsumerAutotunerTest(TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.channel = _FakeQosChannel()
+        self.queue = _FakePendingQueue()
+        self.tuner = amqp._ConsumerAutotuner(
+            self.channel, self.queue, parallel=2, prefetch_count=4,
+            parallel_max=4, prefetch_max=20, interval=1)
+        self.tuner.clock = self.clock
+        self.tuner.start()
+        self.addCleanup(self.tuner.stop)
+
+    def tick(self, latency, n=10):
+        for _ in range(n):
+            self.tuner.record(latency)
+        self.clock.advance(1)
+
+    def test_additive_increase(self):
+        self.queue.pending = [1, 2, 3]
+        self.tick(0.1)
+        self.tick(0.1)
+        self.assertEqual(4, self.tuner.parallel)
+        self.assertEqual(4, self.tuner.semaphore.limit)
+        self.queue.pending = []
+        self.tick(0.1)
+        self.assertEqual(8, self.tuner.prefetch_count)
+        self.assertEqual([8], self.channel.qos)
+
+    def test_multiplicative_decrease(self):
+        self.tick(0.1)
+        self.tick(1.0)
+        self.assertEqual(1, self.tuner.parallel)
+        self.assertEqual(3, self.tuner.prefetch_count)
+        self.assertEqual([6, 3], self.channel.qos)
+
+    def test_idle_tick(self):
+        self.clock.advance(5)
+        self.assertEqual(2, self.tuner.parallel)
+        self.assertEqual([], self.channel.qos)
+
+
+class _FakeRejectChannel(object):
+
+    is_open = True
+
+    def __init__(self):
+        self.rejected = []
+        self.acked = []
+
+    def basic_reject(self, delivery_tag, requeue=True):
+        self.rejected.append((delivery_tag, requeue))
+
+    def basic_ack(self, delivery_tag):
+        self.acked.append(delivery_tag)
+
+
+class DelayedRejectsTest(TestCase):
+
+    def test_rejects_batched_per_tick(self):
+
+        clock = task.Clock()
+        p = amqp.AMQPFactory(requeue_delay=10, requeue_tick=5).buildProtocol(None)
+        p._delayed_rejects.clock = clock
+        p._consumer_state['ct-1'] = {'on_error': 'requeue_forever'}
+
+        ch = _FakeRejectChannel()
+        for dt in range(1, 4):
+            msg = amqp.AMQPMessage(
+                body="", deliver=spec.Basic.Deliver('ct-1', dt, False, E1, Q1),
+                properties=spec.BasicProperties())
+            p._handleFailedIncomingMessage(ch, msg)
+
+        self.assertEqual({'pending': 3, 'consumers': {'ct-1': 3}}, p.delayedRejectsStats())
+        self.assertEqual(1, len(clock.getDelayedCalls()))
+
+        clock.advance(9)
+        self.assertEqual([], ch.rejected)
+        clock.advance(1)
+        self.assertEqual([(1, True), (2, True), (3, True)], ch.rejected)
+        self.assertEqual({'pending': 0, 'consumers': {}}, p.delayedRejectsStats())
+
+    def test_cleanup_closed_channel(self):
+
+        p = amqp.AMQPFactory(requeue_delay=10).buildProtocol(None)
+        p._delayed_rejects.clock = task.Clock()
+        p._consumer_state['ct-1'] = {'on_error': 'requeue_forever'}
+
+        ch = _FakeRejectChannel()
+        msg = amqp.AMQPMessage(
+            body="", deliver=spec.Basic.Deliver('ct-1', 1, False, E1, Q1),
+            properties=spec.BasicProperties())
+        p._handleFailedIncomingMessage(ch, msg)
+
+        # broker requeues unacked messages of closed channel itself
+        ch.is_open = False
+        p._cleanupConsumingQueue('ct-1', defer.DeferredQueue())
+        self.assertEqual([], ch.rejected)
+        self.assertEqual({'pending': 0, 'consumers': {}}, p.delayedRejectsStats())
+
+
+class RetryDLXTest(TestCase):
+
+    def setUp(self):
+        self.published = []
+        self.p = amqp.AMQPFactory(requeue_delay=5, retry_max_attempts=2).buildProtocol(None)
+        self.p.publishMessage = lambda *args, **kwargs: self.published.append((args, kwargs))
+        self.p._consumer_state['ct-1'] = {'on_error': 'retry_dlx', 'queue': Q1}
+        self.ch = _FakeRejectChannel()
+
+    def failMessage(self, dt, headers=None):
+        msg = amqp.AMQPMessage(
+            body="{}", deliver=spec.Basic.Deliver('ct-1', dt, False, '', Q1),
+            properties=spec.BasicProperties(
+                content_type='json', headers=headers, expiration='1000'))
+        self.p._handleFailedIncomingMessage(self.ch, msg)
+
+    def test_republish_to_retry_queue(self):
+        self.failMessage(1, headers={'x': 1})
+        self.assertEqual([1], self.ch.acked)
+        (args, kwargs), = self.published
+        self.assertEqual(('', Q1 + '.retry-5000ms', "{}"), args)
+        self.assertEqual('json', kwargs['content_type'])
+        self.assertEqual({'headers': {'x': 1, amqp.RETRY_ATTEMPTS_HEADER: 1}}, kwargs['properties'])
+
+    def test_max_attempts(self):
+        self.failMessage(1, headers={amqp.RETRY_ATTEMPTS_HEADER: 2})
+        self.assertEqual([], self.published)
+        self.assertEqual([(1, False)], self.ch.rejected)
+
+    def test_schema_from_dict(self):
+        declared = []
+
+        class Builder(object):
+            def declareQueue(self, **kwargs):
+                declared.append(kwargs)
+
+        amqp.schemaFromDict({'queue': {Q1: {'retry_delay': 0.5}}}).declareSchema(Builder())
+        self.assertEqual([
+            {'queue': Q1},
+            {'queue': Q1 + '.retry-500ms', 'durable': True, 'message_ttl': 500,
+             'dead_letter_exchange': '', 'dead_letter_exchange_rk': Q1},
+        ], declared)
+
+
+class SchemaRecorderTest(TestCase):
+
+    def record(self, schema):
+        r = amqp._SchemaRecorder()
+        amqp.loadSchema(schema).declareSchema(r)
+        return r
+
+    def test_phases(self):
+        r = self.record({
+            'queue': {'q1': None},
+            'exchange': {'e1': {'type': 'fanout'}},
+            'bind': [('e1', 'q1')],
+            'bind_exchange': [('e1', 'e2')],
+        })
+        phases = [[m for m, _ in calls] for calls in r.phases()]
+        self.assertEqual([
+            ['declareExchange'],
+            ['declareQueue'],
+            ['bindQueue', 'bindExchange'],
+        ], phases)
+        self.assertEqual('fanout', r.phases()[0][0][1]['exchange_type'])
+
+    def test_fingerprint(self):
+        f1 = self.record({'queue': {'q1': {'arguments': {'a': 1, 'b': 2}}}}).fingerprint()
+        f2 = self.record({'queue': {'q1': {'arguments': {'b': 2, 'a': 1}}}}).fingerprint()
+        f3 = self.record({'queue': {'q1': {'durable': True}}}).fingerprint()
+        self.assertEqual(f1, f2)
+        self.assertNotEqual(f1, f3)
+
+
+class _FakePublishChannel(object):
+
+    is_open = True
+
+    def __init__(self):
+        self.published = []
+        self.close_callbacks = []
+
+    def confirm_delivery(self, callback):
+        self.on_confirm = callback
+
+    def add_on_close_callback(self, cb):
+        self.close_callbacks.append(cb)
+
+    def basic_publish(self, exchange, routing_key, body, properties=None):
+        self.published.append(routing_key)
+
+    def closeByBroker(self):
+        self.is_open = False
+        for cb in self.close_callbacks:
+            cb(self, 406, "PRECONDITION_FAILED")
+
+
+class PublishChannelsPoolTest(TestCase):
+
+    def makeProtocol(self, selector):
+        p = amqp.AMQPFactory(
+            publish_channels=3, publish_channel_selector=selector).buildProtocol(None)
+        p.channel = lambda: defer.succeed(_FakePublishChannel())
+        p._open_publish_channels()
+        p._ready_for_publish = True
+        return p
+
+    def test_round_robin(self):
+        p = self.makeProtocol('round_robin')
+        for i in range(6):
+            p.publishMessage('', 'rk', "x")
+        self.assertEqual([2, 2, 2], [len(pc) for pc in p._safewrite_channels])
+
+    def test_rk_hash(self):
+        p = self.makeProtocol('rk_hash')
+        for i in range(6):
+            p.publishMessage('', 'rk-%d' % (i % 2), "x", confirm=False)
+        for rk in ['rk-0', 'rk-1']:
+            cnts = [pc.channel.published.count(rk) for pc in p._write_channels]
+            self.assertEqual([0, 0, 3], sorted(cnts), "same rk - same channel")
+
+    def test_failed_batch(self):
+        p = self.makeProtocol('round_robin')
+
+        def fail(*args, **kwargs):
+            raise ValueError("can't publish")
+        p._safewrite_channels[2].channel.basic_publish = fail
+
+        self.assertRaises(ValueError, p.publishMessages, '', [('rk', "x")] * 3)
+        # confirms of the batch are dropped, delivery tags are given back
+        self.assertEqual([0, 0, 0], [len(pc) for pc in p._safewrite_channels])
+        self.assertEqual([0, 0, 0], [pc.delivery_tag_counter for pc in p._safewrite_channels])
+
+    def test_replace_closed_channel(self):
+        p = self.makeProtocol('round_robin')
+        ds = [p.publishMessage('', 'rk', "x") for _ in range(3)]
+        old = p._safewrite_channels[0]
+        failed = []
+        for d in ds:
+            d.addErrback(failed.append)
+
+        old.channel.closeByBroker()
+        self.assertEqual(1, len(failed))
+        self.assertTrue(failed[0].check(amqp.ChannelClosed))
+        self.assertIsNot(old, p._safewrite_channels[0])
+        self.assertEqual(2, p._unconfirmedCount())
+
+
+class _FakeShard(amqp.AMQPService):
+
+    def __init__(self, name, load=None):
+        amqp.AMQPService.__init__(self, None, amqp.AMQPFactory())
+        self.setName(name)
+        self.load = load
+        self.published = []
+
+    def getProtocol(self):
+        if self.load is not None:
+            p = amqp.AMQPFactory().buildProtocol(None)
+            p._publish_waiters.extend([None] * self.load)
+            return p
+
+    def publishMessage(self, exchange, routing_key, body, **kwargs):
+        self.published.append(body)
+        return defer.succeed(None)
+
+    def publishMessages(self, exchange, messages, **kwargs):
+        self.published.extend(body for _, body in messages)
+        return defer.succeed([(True, self.name)] * len(messages))
+
+
+class AMQPServiceGroupTest(TestCase):
+
+    def test_least_loaded(self):
+        shards = [_FakeShard('s0', load=3), _FakeShard('s1'), _FakeShard('s2', load=1)]
+        g = amqp.AMQPServiceGroup(shards)
+        g.publishMessage('', 'rk', 'm1')
+        self.assertEqual([[], [], ['m1']], [s.published for s in shards])
+
+    def test_rk_hash_batch(self):
+        shards = [_FakeShard('s0'), _FakeShard('s1')]
+        g = amqp.AMQPServiceGroup(shards, selector='rk_hash')
+        messages = [('rk-%d' % i, i) for i in range(10)]
+
+        results = []
+        g.publishMessages('', messages).addCallback(results.extend)
+
+        self.assertEqual(10, len(results))
+        for (rk, _), (success, shard_name) in zip(messages, results):
+            self.assertTrue(success)
+            self.assertIs(g._selectShard(rk), g.getServiceNamed(shard_name))
+
+        # unicode routing keys are hashed as utf-8
+        rk = u"ключ"
+        self.assertIs(g._selectShard(rk.encode('utf-8')), g._selectShard(rk))
+
+    def test_queue_consumers(self):
+        shards = [_FakeShard('s0'), _FakeShard('s1')]
+        g = amqp.AMQPServiceGroup(shards)
+        qc = g.setupQueueConsuming(Q1, lambda m: None)
+        self.assertEqual(2, len(qc))
+        self.assertFalse(qc.running)
+        for s, c in zip(shards, qc):
+            self.assertIn(c, list(s.consumer_services))
+
+        self.successResultOf(g.unsetupConsuming(qc))
+        self.assertEqual([[], []], [list(s.consumer_services) for s in shards])
+
+    def test_sharded_collection(self):
+        c = amqp.AMQPCollectionService({
+            'single': {},
+            'sharded': {'shards': 3, 'shard_selector': 'round_robin'},
+        })
+        self.assertIsInstance(c['single'], amqp.AMQPService)
+        self.assertIsInstance(c['sharded'], amqp.AMQPServiceGroup)
+        self.assertEqual(
+            ['sharded#0', 'sharded#1', 'sharded#2'],
+            [s.name for s in c['sharded']])
+
+
+class _FakeMemcache(object):
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return defer.succeed((0, self.data.get(key)))
+
+    def set(self, key, value, expireTime=0):
+        self.data[key] = value
+        return defer.succeed(True)
+
+
+class MessageDedupCacheTest(TestCase):
+
+    def makeCache(self, **kwargs):
+        c = amqp.MessageDedupCache(**kwargs)
+        c.clock = self.clock = task.Clock()
+        return c
+
+    def test_lru(self):
+        c = self.makeCache(max_size=2)
+        c.add('a')
+        c.add('b')
+        self.assertTrue(c.contains('a'))
+        c.add('c')
+        self.assertEqual(2, len(c))
+        self.assertTrue(c.contains('a'))
+        self.assertFalse(c.contains('b'))
+        self.assertEqual(2, c.hits)
+
+    def test_ttl(self):
+        c = self.makeCache(ttl=10)
+        c.add('a')
+        self.clock.advance(5)
+        self.assertTrue(c.contains('a'))
+        self.clock.advance(5)
+        self.assertFalse(c.contains('a'))
+        self.assertEqual(0, len(c))
+
+    def test_memcache(self):
+        mc = _FakeMemcache()
+        c1 = self.makeCache(memcache=mc)
+        c2 = self.makeCache(memcache=mc)
+        c1.add('a')
+        self.assertEqual({'twoost-dedup:a': "1"}, mc.data)
+        self.assertTrue(self.successResultOf(c2.contains('a')))
+        self.assertFalse(self.successResultOf(c2.contains('b')))
+        # now cached locally
+        self.assertIs(True, c2.contains('a'))
+
+    def test_consumer_skips_processed(self):
+        results = []
+        qc = amqp._QueueConsumer(
+            Q1, results.append, dedup=self.makeCache(), deserialize=False)
+
+        def msg(message_id):
+            return amqp.AMQPMessage(
+                body="", deliver=spec.Basic.Deliver('ct-1', 1, False, '', Q1),
+                properties=spec.BasicProperties(message_id=message_id))
+
+        for mid in ['m1', 'm2', 'm1', None, None]:
+            qc.onMessage(msg(mid))
+        qc.onMessagesBatch([msg('m2'), msg('m3'), msg('m3')])
+        qc.onMessagesBatch([msg('m1')])
+
+        self.assertEqual(
+            ['m1', 'm2', None, None, ['m3']],
+            [[m.message_id for m in r] if isinstance(r, list) else r.message_id for r in results])
+
+    def test_consumer_retries_failed(self):
+        calls = []
+
+        def callback(m):
+            calls.append(m.message_id)
+            if len(calls) == 1:
+                raise Exception("fail")
+
+        qc = amqp._QueueConsumer(Q1, callback, dedup=self.makeCache(), deserialize=False)
+        m = amqp.AMQPMessage(
+            body="", deliver=spec.Basic.Deliver('ct-1', 1, False, '', Q1),
+            properties=spec.BasicProperties(message_id='m1'))
+
+        self.failureResultOf(qc.onMessage(m))
+        self.successResultOf(qc.onMessage(m))
+        self.successResultOf(qc.onMessage(m))
+        self.assertEqual(['m1', 'm1'], calls)
+
+    def test_consumer_waits_in_progress(self):
+        pending = []
+
+        def callback(m):
+            pending.append(defer.Deferred())
+            return pending[-1]
+
+        qc = amqp._QueueConsumer(Q1, callback, dedup=self.makeCache(), deserialize=False)
+
+        def msg(message_id):
+            return amqp.AMQPMessage(
+                body="", deliver=spec.Basic.Deliver('ct-1', 1, False, '', Q1),
+                properties=spec.BasicProperties(message_id=message_id))
+
+        d = qc.onMessage(msg('m1'))
+        dups = [qc.onMessage(msg('m1')), qc.onMessagesBatch([msg('m1')])]
+        self.assertEqual(1, len(pending))
+        for x in dups:
+            self.assertNoResult(x)
+
+        # original succeeded - duplicates are skipped (acked)
+        pending[0].callback(None)
+        self.successResultOf(d)
+        for x in dups:
+            self.successResultOf(x)
+        self.assertEqual(1, len(pending))
+        self.assertEqual({}, qc._dedup_inflight)
+
+    def test_consumer_original_fails(self):
+        pending = []
+
+        def callback(m):
+            pending.append(defer.Deferred())
+            return pending[-1]
+
+        qc = amqp._QueueConsumer(Q1, callback, dedup=self.makeCache(), deserialize=False)
+        m = amqp.AMQPMessage(
+            body="", deliver=spec.Basic.Deliver('ct-1', 1, False, '', Q1),
+            properties=spec.BasicProperties(message_id='m1'))
+
+        d = qc.onMessage(m)
+        dups = [qc.onMessage(m), qc.onMessage(m)]
+
+        # original failed - one of duplicates is processed instead
+        pending[0].errback(ValueError("fail"))
+        self.failureResultOf(d, ValueError)
+        self.assertEqual(2, len(pending))
+        for x in dups:
+            self.assertNoResult(x)
+
+        pending[1].callback(None)
+        for x in dups:
+            self.successResultOf(x)
+        self.assertEqual(2, len(pending))
+        self.assertEqual({}, qc._dedup_inflight)
+
+
+class ConsumersSchedulerTest(TestCase):
+
+    def setUp(self):
+        self.sch = amqp.ConsumersScheduler(4)
+        self.served = []
+
+    def fill(self, consumer, n):
+        ds = []
+        for _ in range(n):
+            d = self.sch.acquire(consumer)
+            d.addCallback(lambda _, c=consumer: self.served.append(c))
+            ds.append(d)
+        return ds
+
+    def test_limit_and_weights(self):
+        self.sch.register('a', weight=1)
+        self.sch.register('b', weight=3)
+        self.fill('a', 10)
+        self.fill('b', 10)
+        self.assertEqual(4, self.sch.active)
+        self.assertEqual(16, self.sch.stats()['waiting'])
+        self.assertEqual(['a'] * 4, self.served)
+
+        # freed slot goes to consumer with less `active / weight`
+        del self.served[:]
+        for _ in range(3):
+            self.sch.release('a')
+        self.assertEqual(['b', 'b', 'b'], self.served)
+        self.sch.release('b')
+        self.sch.release('a')
+        self.assertEqual(['b', 'b', 'b', 'b', 'a'], self.served)
+
+    def test_min_share(self):
+        self.sch.register('a')
+        self.sch.register('b', min_share=1)
+        self.fill('a', 10)
+        # one slot is reserved for idle 'b'
+        self.assertEqual(3, self.sch.active)
+        self.fill('b', 2)
+        self.assertEqual(['a'] * 3 + ['b'], self.served)
+        self.sch.release('b')
+        self.sch.release('a')
+        self.assertEqual(['a'] * 3 + ['b', 'b', 'a'], self.served)
+
+    def test_cancel_and_unregister(self):
+        self.sch.register('a')
+        self.sch.register('b')
+        self.fill('a', 4)
+        d1, d2 = self.fill('b', 2)
+        d1.cancel()
+        self.failureResultOf(d1, defer.CancelledError)
+        self.sch.unregister('b')
+        self.failureResultOf(d2, defer.CancelledError)
+        self.assertEqual(0, self.sch.stats()['waiting'])
+
+    def test_consumers_share_scheduler(self):
+        calls = []
+        sleeps = []
+
+        def callback(m):
+            calls.append(m)
+            d = defer.Deferred()
+            sleeps.append(d)
+            return d
+
+        qc1 = amqp._QueueConsumer(Q1, callback, scheduler=self.sch, min_share=1, deserialize=False)
+        qc2 = amqp._QueueConsumer('q2', callback, scheduler=self.sch, deserialize=False)
+        self.sch.register(qc1, min_share=1)
+        self.sch.register(qc2)
+
+        for i in range(5):
+            qc2.onMessage(i)
+        qc1.onMessage('x')
+        self.assertEqual([0, 1, 2, 'x'], calls)
+
+        sleeps[0].callback(None)
+        self.assertEqual([0, 1, 2, 'x', 3], calls)
+
+
 class BaseTest(TestCase):
 
     schema = None
@@ -78,13 +754,18 @@ class BaseTest(TestCase):
             'schema': self.schema,
             'host': "localhost",
             'port': 5672,
+            # short requeue delays are used across the tests
+            'requeue_tick': 0.01,
         }
 
     @defer.inlineCallbacks
     def setUp(self):
         params = self.clientParams()
 
-        self.endpoint = endpoints.TCP4ClientEndpoint(reactor, "localhost", 5672)
+        if AMQP_TEST_HOST:
+            self.endpoint = endpoints.TCP4ClientEndpoint(reactor, AMQP_TEST_HOST, 5672)
+        else:
+            self.endpoint = fakeamqp.FakeBrokerEndpoint(fakeamqp.FakeBroker())
         self.factory = amqp.AMQPFactory(**params)
         self.client = amqp.AMQPService(self.endpoint, self.factory, **params)
         self.client.startService()
@@ -470,6 +1151,128 @@ class QueueConsumerTest(BaseTest):
         yield sleep(0.5)
         self.assertEqual(0, len(results), "no more messages (consuming cancelled)")
 
+    @defer.inlineCallbacks
+    def test_consumer_priority(self):
+
+        low, high = [], []
+        sql_low = self.client.setupQueueConsuming(Q1, low.append, priority=1)
+        sql_high = self.client.setupQueueConsuming(Q1, high.append, priority=10)
+        yield sleep(0.1)
+
+        for i in range(5):
+            yield self.client.publishMessage(exchange='', routing_key=Q1, body=str(i))
+        yield sleep(0.2)
+
+        self.assertEqual([], low)
+        self.assertEqual(["0", "1", "2", "3", "4"], high)
+
+        yield sql_high.stopService()
+        yield sql_low.stopService()
+
+    @defer.inlineCallbacks
+    def test_consumer_prefetch(self):
+
+        results = []
+
+        def on_msg(m):
+            results.append(m)
+            return sleep(0.2)
+
+        # unlimited parallelism, but only 1 unacked message per consumer
+        sql = self.client.setupQueueConsuming(Q1, on_msg, parallel=-1, prefetch_count=1)
+        yield sql.stopService()
+
+        for i in range(5):
+            self.client.publishMessage(
+                exchange='', routing_key=Q1, confirm=0,
+                body=str(i), content_type='plain/text')
+
+        yield sql.startService()
+        yield sleep(0.3)
+        self.assertEqual(2, len(results))
+
+        yield sql.stopService()
+        yield self.clearQueue(Q1)
+
+    @defer.inlineCallbacks
+    def test_drain_on_stop(self):
+
+        started, finished = [], []
+
+        @defer.inlineCallbacks
+        def on_msg(m):
+            started.append(m)
+            yield sleep(0.3)
+            finished.append(m)
+
+        sql = self.client.setupQueueConsuming(
+            Q1, on_msg, parallel=1, prefetch_count=10, drain_timeout=2)
+        for i in range(5):
+            yield self.client.publishMessage(exchange='', routing_key=Q1, body=str(i))
+        yield sleep(0.1)
+
+        t0 = reactor.seconds()
+        yield sql.stopService()
+        self.assertTrue(reactor.seconds() - t0 < 1)
+        # in-flight message is processed, prefetched ones are returned to queue
+        self.assertEqual(["0"], started)
+        self.assertEqual(["0"], finished)
+
+        redelivered = []
+        sql = self.client.setupQueueConsuming(Q1, redelivered.append, deserialize=False)
+        yield sleep(0.2)
+        self.assertEqual(["1", "2", "3", "4"], [m.body for m in redelivered])
+        self.assertTrue(all(m.redelivered for m in redelivered))
+        yield sql.stopService()
+
+    @defer.inlineCallbacks
+    def test_fail_while_draining(self):
+
+        @defer.inlineCallbacks
+        def on_msg(m):
+            yield sleep(0.3)
+            if m == "0":
+                raise ValueError("fail")
+
+        sql = self.client.setupQueueConsuming(
+            Q1, on_msg, parallel=1, prefetch_count=10,
+            on_error='requeue_forever', requeue_delay=5, drain_timeout=2)
+        for i in range(3):
+            yield self.client.publishMessage(exchange='', routing_key=Q1, body=str(i))
+        yield sleep(0.1)
+        yield sql.stopService()
+
+        # message failed during drain is requeued as well
+        redelivered = []
+        sql = self.client.setupQueueConsuming(Q1, redelivered.append, deserialize=False)
+        yield sleep(0.2)
+        self.assertEqual(["0", "1", "2"], sorted(m.body for m in redelivered))
+        yield sql.stopService()
+
+    @defer.inlineCallbacks
+    def test_drain_keeps_held_messages(self):
+
+        @defer.inlineCallbacks
+        def on_msg(m):
+            if m == "0":
+                raise ValueError("fail")
+            yield sleep(0.3)
+
+        sql = self.client.setupQueueConsuming(
+            Q1, on_msg, parallel=1, prefetch_count=10,
+            on_error='do_nothing', drain_timeout=2)
+        for i in range(5):
+            yield self.client.publishMessage(exchange='', routing_key=Q1, body=str(i))
+        yield sleep(0.1)
+        yield sql.stopService()
+
+        # failed message is held, only prefetched ones are returned to queue
+        redelivered = []
+        sql = self.client.setupQueueConsuming(Q1, redelivered.append, deserialize=False)
+        yield sleep(0.2)
+        self.assertEqual(["2", "3", "4"], sorted(m.body for m in redelivered))
+        yield sql.stopService()
+
     @defer.inlineCallbacks
     def test_ping_pong(self):
 
@@ -492,6 +1295,57 @@ class QueueConsumerTest(BaseTest):
         yield sql.stopService()
         yield self.clearQueue(Q1)
 
+    @defer.inlineCallbacks
+    def test_batch_sender(self):
+
+        results = []
+        sql = self.client.setupQueueConsuming(Q1, results.append)
+        send = self.client.makeBatchSender(
+            exchange='', routing_key=Q1, batch_size=10, batch_delay=0.05)
+
+        ds = [send({'n': i}) for i in range(25)]
+        yield defer.gatherResults(ds)
+        yield sleep(0.2)
+
+        self.assertEqual([{'n': i} for i in range(25)], results)
+        yield sql.stopService()
+
+    @defer.inlineCallbacks
+    def test_batch_consumer(self):
+
+        batches = []
+        sql = self.client.setupQueueConsuming(
+            Q1, batches.append, batch_size=10, batch_timeout=0.05)
+        yield sleep(0.2)
+
+        for i in range(25):
+            yield self.client.publishMessage(
+                exchange='', routing_key=Q1, body=i, content_type='json')
+        yield sleep(0.3)
+
+        self.assertTrue(all(len(b) <= 10 for b in batches))
+        self.assertEqual(list(range(25)), sum(batches, []))
+
+        yield sql.stopService()
+        yield self.clearQueue(Q1)
+
+    @defer.inlineCallbacks
+    def test_compressed_messages(self):
+
+        messages = []
+        sql = self.client.setupQueueConsuming(Q1, messages.append, deserialize=False)
+        send = self.client.makeSender(exchange='', routing_key=Q1, content_encoding='gzip')
+
+        yield send({'n': 1})
+        yield send({'n': 2, 'text': "z" * 2000})
+        yield sleep(0.2)
+
+        self.assertEqual([None, 'gzip'], [m.content_encoding for m in messages])
+        self.assertEqual([1, 2], [m.data['n'] for m in messages])
+        self.assertTrue(len(messages[1].body) < 100)
+
+        yield sql.stopService()
+
     @defer.inlineCallbacks
     def test_quick_consume_and_cancel(self):
         sql = self.client.setupQueueConsuming(Q1, lambda _: None)
@@ -501,6 +1355,55 @@ class QueueConsumerTest(BaseTest):
             yield defer.maybeDeferred(sql.stopService)
 
 
+class PublishWindowTest(BaseTest):
+
+    schema = SingleQueueSchema(Q1)
+
+    def clientParams(self):
+        params = BaseTest.clientParams(self)
+        params['max_unconfirmed'] = 5
+        return params
+
+    @defer.inlineCallbacks
+    def test_publish_window(self):
+
+        yield self.clearQueue(Q1)
+        p = self.client.getProtocol()
+
+        ds = [
+            self.client.publishMessage(exchange='', routing_key=Q1, body=str(i))
+            for i in range(50)
+        ]
+        self.assertTrue(p._unconfirmedCount() <= 5, "window is respected")
+        self.assertTrue(p._publish_waiters, "some publishers are waiting")
+
+        yield defer.gatherResults(ds)
+        self.assertFalse(p._publish_waiters)
+        yield self.clearQueue(Q1)
+
+    @defer.inlineCallbacks
+    def test_batch_publish_window(self):
+
+        yield self.clearQueue(Q1)
+        p = self.client.getProtocol()
+
+        d1 = self.client.publishMessage(exchange='', routing_key=Q1, body="x")
+        # batch waits for free slots for all its messages
+        d2 = self.client.publishMessages('', [(Q1, str(i)) for i in range(5)])
+        self.assertEqual(1, p._unconfirmedCount())
+        # batch bigger than the window is published by chunks
+        d3 = self.client.publishMessages('', [(Q1, str(i)) for i in range(12)])
+        self.assertEqual(1, p._unconfirmedCount())
+
+        yield d1
+        results = yield d2
+        self.assertEqual(5, len(results))
+        results = yield d3
+        self.assertEqual(12, len(results))
+        self.assertTrue(all(success for success, _ in results))
+        yield self.clearQueue(Q1)
+
+
 class ExchangeConsumerTest(BaseTest):
 
     schema = SingleExchangeSchema(E1)
@@ -537,3 +1440,52 @@ class ExchangeConsumerTest(BaseTest):
 
         for sel in sels:
             yield sel.stopService()
+
+    @defer.inlineCallbacks
+    def test_no_retry_dlx(self):
+
+        # retry queue can't follow exclusive queue of exchange consumer
+        self.assertRaises(
+            ValueError, self.client.setupExchangeConsuming,
+            E1, lambda m: None, on_error='retry_dlx')
+
+        p = self.client.getProtocol()
+        yield self.assertFailure(
+            p.consumeExchange(callback=lambda m: None, exchange=E1, on_error='retry_dlx'),
+            ValueError)
+
+
+class SchemaDeclareTest(BaseTest):
+
+    schema = TestSchema()
+
+    def clientParams(self):
+        params = BaseTest.clientParams(self)
+        params['schema_cache'] = True
+        params['schema_channels'] = 4
+        return params
+
+    @defer.inlineCallbacks
+    def test_declare_and_cache(self):
+
+        if AMQP_TEST_HOST:
+            raise SkipTest("needs access to fake broker state")
+
+        broker = self.endpoint.broker
+        self.assertEqual(set([Q1, 'mcs_amqp_q1', 'mcs_amqp_q2', 'mcs_amqp_q3']), set(broker.queues))
+        self.assertEqual(
+            set([('', 'mcs_amqp_q1', False), ('', 'mcs_amqp_q2', False)]),
+            set(broker.bindings['mcs_amqp_e12']))
+
+        # same schema & same broker - declaration is skipped
+        broker.deleteQueue('mcs_amqp_q3')
+        self.client.reconnect_max_delay = 0.01
+        yield self.client.dropConnection()
+        yield sleep(0.5)
+        self.assertNotIn('mcs_amqp_q3', broker.queues)
+
+        # schema was changed - declare again
+        self.factory.schema = SingleQueueSchema(QX)
+        yield self.client.dropConnection()
+        yield sleep(0.5)
+        self.assertIn(QX, broker.queues)
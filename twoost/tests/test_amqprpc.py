@@ -0,0 +1,120 @@
+# coding: utf-8
+
+from __future__ import print_function, division, absolute_import
+
+from twisted.internet import defer
+from twisted.trial.unittest import TestCase
+
+from twoost import amqp, amqprpc, fakeamqp, rpcproxy, timed
+
+
+RPC_QUEUE = 'test_amqprpc_queue'
+
+
+class AMQPRPCTest(TestCase):
+
+    @defer.inlineCallbacks
+    def setUp(self):
+
+        self.broker = fakeamqp.getBroker('amqprpc-test')
+        params = {'schema': {'queue': {RPC_QUEUE: {}}}}
+        self.amqp = amqp.AMQPService(
+            fakeamqp.FakeBrokerEndpoint(self.broker), amqp.AMQPFactory(**params), **params)
+        self.amqp.startService()
+
+        self.server = amqprpc.AMQPRPCServer(self.amqp, RPC_QUEUE, {
+            'ping': lambda: 'pong',
+            'sum': lambda *args: sum(args),
+            'sleep': self._sleep,
+            'fail': self._fail,
+        })
+        self.server.startService()
+
+        self.proxy = rpcproxy.make_rpc_proxy({
+            'protocol': 'amqprpc',
+            'amqp': {'endpoint': 'loop:amqprpc-test'},
+            'queue': RPC_QUEUE,
+            'timeout': 1,
+        })
+        self.proxy.startService()
+
+        self._sleeps = []
+        yield timed.sleep(0.2)
+
+    def _sleep(self, t):
+        d = timed.sleep(t)
+        d.addErrback(lambda f: f.trap(defer.CancelledError) and None)
+        self._sleeps.append(d)
+        return d
+
+    def _fail(self):
+        raise ValueError("some error")
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        for s in self._sleeps:
+            s.cancel()
+        yield self.proxy.stopService()
+        yield self.server.stopService()
+        yield self.amqp.stopService()
+
+    @defer.inlineCallbacks
+    def test_ping_pong(self):
+        r = yield self.proxy.callRemote('ping')
+        self.assertEqual('pong', r)
+
+    @defer.inlineCallbacks
+    def test_concurrent_calls(self):
+        rs = yield defer.gatherResults([
+            self.proxy.callRemote('sum', i, i, 1)
+            for i in range(20)
+        ])
+        self.assertEqual([2 * i + 1 for i in range(20)], rs)
+        self.assertEqual({}, self.proxy.proxy._calls)
+
+    @defer.inlineCallbacks
+    def test_echo(self):
+        payload = {'list': [1, 2, 3], 'none': None, 'unicode': u"текст"}
+        r = yield self.proxy.callRemote('_echo', payload)
+        self.assertEqual(payload, r)
+        yield self.proxy.checkHealth()
+
+    @defer.inlineCallbacks
+    def test_errors(self):
+        try:
+            yield self.proxy.callRemote('fail')
+        except amqprpc.AMQPRPCError as e:
+            self.assertEqual('ValueError', e.error_type)
+            self.assertEqual("some error", e.message)
+        else:
+            self.fail("expected AMQPRPCError")
+
+        try:
+            yield self.proxy.callRemote('unknown_method')
+        except amqprpc.AMQPRPCError as e:
+            self.assertEqual('NoSuchMethod', e.error_type)
+        else:
+            self.fail("expected AMQPRPCError")
+
+    @defer.inlineCallbacks
+    def test_timeout(self):
+        call = self.proxy.makeCaller('sleep', timeout=0.2)
+        try:
+            yield call(5)
+        except timed.TimeoutError:
+            pass
+        else:
+            self.fail("expected TimeoutError")
+        self.assertEqual({}, self.proxy.proxy._calls)
+
+    @defer.inlineCallbacks
+    def test_reconnect(self):
+        r = yield self.proxy.callRemote('sum', 1, 2)
+        self.assertEqual(3, r)
+
+        self.proxy.amqp_service['amqprpc'].reconnect_max_delay = 0.01
+        yield self.proxy.amqp_service['amqprpc'].dropConnection()
+        yield timed.sleep(0.3)
+
+        r = yield self.proxy.callRemote('sum', 3, 4)
+        self.assertEqual(7, r)
@@ -0,0 +1,74 @@
+# coding: utf-8
+
+from __future__ import print_function, division, absolute_import
+
+from twisted.internet import task
+from twisted.trial.unittest import TestCase
+
+from pika import spec
+
+from twoost import fakeamqp
+
+
+class FakeBrokerRoutingTest(TestCase):
+
+    def setUp(self):
+        self.broker = fakeamqp.FakeBroker()
+        self.broker.clock = self.clock = task.Clock()
+
+    def publish(self, exchange, routing_key, body="x", **props):
+        return self.broker.publish(
+            exchange, routing_key, spec.BasicProperties(**props), body)
+
+    def bodies(self, queue):
+        return [m.body for m in self.broker.getQueue(queue).messages]
+
+    def test_topic_match(self):
+        m = fakeamqp.FakeBroker._topicMatch
+        self.assertTrue(m("a.*.c", "a.b.c"))
+        self.assertFalse(m("a.*.c", "a.c"))
+        self.assertTrue(m("a.#", "a"))
+        self.assertTrue(m("a.#", "a.b.c"))
+        self.assertTrue(m("#.c", "a.b.c"))
+        self.assertFalse(m("a.#.d", "a.b.c"))
+
+    def test_route(self):
+        b = self.broker
+        b.declareExchange('ex', 'topic')
+        b.declareExchange('fan', 'fanout')
+        b.declareQueue('q1')
+        b.declareQueue('q2')
+        b.bind('ex', 'q1', 'a.*')
+        b.bind('ex', 'fan', '#', to_exchange=True)
+        b.bind('fan', 'q2')
+
+        self.assertEqual(2, self.publish('ex', 'a.b', "1"))
+        self.assertEqual(1, self.publish('ex', 'z', "2"))
+        self.assertEqual(1, self.publish('', 'q1', "3"))
+        self.assertEqual(0, self.publish('', 'nope', "4"))
+
+        self.assertEqual(["1", "3"], self.bodies('q1'))
+        self.assertEqual(["1", "2"], self.bodies('q2'))
+
+    def test_ttl_dead_letter(self):
+        b = self.broker
+        b.declareQueue('q')
+        b.declareQueue('q.retry', arguments={
+            'x-message-ttl': 1000,
+            'x-dead-letter-exchange': '',
+            'x-dead-letter-routing-key': 'q',
+        })
+
+        self.publish('', 'q.retry', "1")
+        self.clock.advance(0.5)
+        self.publish('', 'q.retry', "2", expiration='100')
+        self.clock.advance(0.2)
+        # like rabbitmq: expired message waits behind the head of queue
+        self.assertEqual([], self.bodies('q'))
+        self.assertEqual(["1", "2"], self.bodies('q.retry'))
+
+        self.clock.advance(0.5)
+        self.assertEqual(["1", "2"], self.bodies('q'))
+        death = b.getQueue('q').messages[0].properties.headers['x-death']
+        self.assertEqual('q.retry', death[0]['queue'])
+        self.assertEqual('expired', death[0]['reason'])
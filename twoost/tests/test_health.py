@@ -0,0 +1,137 @@
+# coding: utf-8
+
+from __future__ import print_function, division, absolute_import
+
+from twisted.internet import defer, task
+from twisted.trial.unittest import TestCase
+
+from twoost import health, rpcproxy
+
+
+class _Backend(object):
+
+    def __init__(self):
+        self.fail = False
+        self.calls = 0
+
+    def ping(self):
+        self.calls += 1
+        if self.fail:
+            raise ValueError("backend is down")
+        return 'pong'
+
+
+class CircuitBreakerTest(TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.backend = _Backend()
+
+    def makeBreaker(self, **kwargs):
+        cb = health.CircuitBreaker(**kwargs)
+        cb.clock = self.clock
+        return cb
+
+    def call(self, cb, f=None):
+        d = cb.call(f or self.backend.ping)
+        d.addErrback(lambda f: f.trap(ValueError) and 'error')
+        return d
+
+    def test_open_on_failures(self):
+        cb = self.makeBreaker(min_calls=4, window=10, failure_rate=0.5)
+        self.backend.fail = True
+        for _ in range(4):
+            self.assertEqual('error', self.successResultOf(self.call(cb)))
+        self.assertEqual(cb.OPEN, cb.state)
+        self.assertRaises(health.CircuitOpenError, cb.checkHealth)
+
+        # fail fast - backend isn't called
+        self.failureResultOf(self.call(cb), health.CircuitOpenError)
+        self.assertEqual(4, self.backend.calls)
+
+    def test_rate_in_window(self):
+        cb = self.makeBreaker(min_calls=4, window=4, failure_rate=0.75)
+        for i in range(20):
+            self.backend.fail = (i % 3 == 0)
+            self.call(cb)
+        self.assertEqual(cb.CLOSED, cb.state)
+        self.assertEqual("circuit breaker is closed", cb.checkHealth())
+
+    def test_half_open(self):
+        cb = self.makeBreaker(min_calls=2, reset_timeout=10, half_open_calls=2)
+        self.backend.fail = True
+        self.call(cb)
+        self.call(cb)
+        self.assertEqual(cb.OPEN, cb.state)
+
+        # failed trial call opens breaker again
+        self.clock.advance(10)
+        self.call(cb)
+        self.assertEqual(cb.OPEN, cb.state)
+
+        self.clock.advance(10)
+        trials = [defer.Deferred(), defer.Deferred()]
+        for d in trials:
+            cb.call(lambda d=d: d)
+        self.assertEqual(cb.HALF_OPEN, cb.state)
+        # only `half_open_calls` trials at once
+        self.failureResultOf(self.call(cb), health.CircuitOpenError)
+        trials[0].callback(None)
+        self.assertEqual(cb.HALF_OPEN, cb.state)
+        # finished trial doesn't free a slot for one more
+        self.failureResultOf(self.call(cb), health.CircuitOpenError)
+        trials[1].callback(None)
+        self.assertEqual(cb.CLOSED, cb.state)
+
+    def test_half_open_hung_trials(self):
+        cb = self.makeBreaker(min_calls=1, reset_timeout=10, half_open_calls=1)
+        self.backend.fail = True
+        self.call(cb)
+        self.clock.advance(10)
+        hung = defer.Deferred()
+        cb.call(lambda: hung)
+        self.failureResultOf(self.call(cb), health.CircuitOpenError)
+
+        # new trial after `reset_timeout`, late result of hung one is ignored
+        self.clock.advance(10)
+        self.backend.fail = False
+        self.assertEqual('pong', self.successResultOf(self.call(cb)))
+        self.assertEqual(cb.CLOSED, cb.state)
+        hung.errback(ValueError())
+        self.assertEqual(cb.CLOSED, cb.state)
+        self.failureResultOf(hung)
+
+    def test_slow_calls(self):
+        cb = self.makeBreaker(min_calls=2, slow_call_duration=1)
+        for _ in range(2):
+            d = defer.Deferred()
+            cb.call(lambda: d)
+            self.clock.advance(2)
+            d.callback(None)
+        self.assertEqual(cb.OPEN, cb.state)
+
+    def test_ignore_errors(self):
+        cb = self.makeBreaker(min_calls=2, ignore_errors=[ValueError])
+        self.backend.fail = True
+        for _ in range(5):
+            self.call(cb)
+        self.assertEqual(cb.CLOSED, cb.state)
+
+    def test_rpc_caller(self):
+        proxy = rpcproxy.make_rpc_proxy({
+            'protocol': 'loop',
+            'target': self.backend,
+            'timeout': 0,
+            'circuit_breaker': {'min_calls': 3, 'failure_rate': 0.6},
+        })
+        self.assertTrue(health.IHealthChecker.providedBy(proxy))
+        proxy.circuit_breaker.clock = self.clock
+
+        call = proxy.makeCaller('ping')
+        self.assertEqual('pong', self.successResultOf(call()))
+        self.backend.fail = True
+        self.failureResultOf(call(), ValueError)
+        self.failureResultOf(call(), ValueError)
+        self.failureResultOf(call(), health.CircuitOpenError)
+        self.assertRaises(health.CircuitOpenError, proxy.checkHealth)
+        self.assertEqual(3, self.backend.calls)
@@ -10,7 +10,7 @@ from twisted.internet import defer, error
 from twisted.application.service import Application, IService
 from twisted.trial.unittest import TestCase
 
-from twoost import app, conf, timed, pclient
+from twoost import app, conf, timed, pclient, memcache
 
 
 def gr(n):
@@ -118,3 +118,63 @@ class MemcacheTestCase(TestCase):
         self.assertEqual(expected_vs, vs)
         self.assertTrue(vs0)
         self.assertTrue(len(vs0) < len(vs))
+
+
+class KetamaRingTest(TestCase):
+
+    def ring(self, names, weights=None, **kwargs):
+        weights = weights or {}
+        return memcache.KetamaRing(dict(
+            (n, ("%s.example.com:11211" % n, weights.get(n, 1)))
+            for n in names
+        ), **kwargs)
+
+    def test_weights(self):
+        ring = self.ring(['a', 'b', 'c'], {'c': 2})
+        keys = gr(4000)
+        c = sum(1 for k in keys if ring.lookup(k) == 'c')
+        self.assertTrue(0.4 < c / len(keys) < 0.6, c)
+
+    def test_add_server(self):
+        r3 = self.ring(['a', 'b', 'c'])
+        r4 = self.ring(['a', 'b', 'c', 'd'])
+        keys = gr(4000)
+        moved = [k for k in keys if r3.lookup(k) != r4.lookup(k)]
+        self.assertTrue(len(moved) < len(keys) * 0.35, len(moved))
+        self.assertEqual(set(['d']), set(r4.lookup(k) for k in moved))
+
+    def test_eject_and_rejoin(self):
+        dead = set(['b'])
+        ring = self.ring(['a', 'b', 'c'], isAlive=lambda n: n not in dead)
+        ring_ab = self.ring(['a', 'c'])
+        keys = gr(1000)
+        self.assertEqual([ring_ab.lookup(k) for k in keys], [ring(k) for k in keys])
+
+        dead.clear()
+        self.assertIn('b', set(ring(k) for k in keys))
+
+        dead.update(['a', 'b', 'c'])
+        self.assertTrue(ring(keys[0]))
+
+    def test_eject_weighted(self):
+        dead = set()
+        ring = self.ring(['a', 'b', 'c'], {'a': 3, 'c': 2}, isAlive=lambda n: n not in dead)
+        keys = gr(1000)
+        before = dict((k, ring(k)) for k in keys)
+        dead.add('b')
+        # only keys of dead server are moved
+        for k in keys:
+            if before[k] == 'b':
+                self.assertIn(ring(k), ('a', 'c'))
+            else:
+                self.assertEqual(before[k], ring(k))
+
+    def test_service_ring(self):
+        mc = memcache.MemCacheService({
+            'c0': {'host': 'localhost', 'port': 11211},
+            'c1': {'host': 'localhost', 'port': 11212, 'weight': 3},
+        })
+        ring = mc.ketamaRing()
+        self.assertIs(ring, mc.multiClient().resolveClientNameByKey)
+        # 40 hashes per server (by weight), 4 points per hash
+        self.assertEqual((20 + 60) * 4, len(ring._points))
@@ -0,0 +1,234 @@
+# coding: utf-8
+
+from __future__ import print_function, division, absolute_import
+
+from twisted.internet import defer, protocol, task
+from twisted.test import proto_helpers
+from twisted.trial.unittest import TestCase
+
+from twoost import health, pclient
+from twoost.memcache import MemCacheService
+
+
+class _SlowProtocol(protocol.Protocol):
+
+    def connectionMade(self):
+        self.calls = []
+
+    def call(self, x):
+        d = defer.Deferred()
+        self.calls.append((x, d))
+        return d
+
+
+class _FakeEndpoint(object):
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.protocols = []
+
+    def _connect(self, factory):
+        p = factory.buildProtocol(None)
+        transport = proto_helpers.StringTransportWithDisconnection()
+        transport.protocol = p
+        p.makeConnection(transport)
+        self.protocols.append(p)
+        return p
+
+    def connect(self, factory):
+        # connect asynchronously - like real endpoints do
+        return task.deferLater(self.clock, 0, self._connect, factory)
+
+
+class DelayedCallsTest(TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.endpoint = _FakeEndpoint(self.clock)
+        factory = pclient.PersistentClientFactory()
+        factory.protocol = _SlowProtocol
+        self.client = pclient.PersistentClientService(
+            self.endpoint, factory, callretry_delay=5,
+            reconnect_delay_jitter=0)
+        self.client.protocolProxiedMethods = ['call']
+        self.client.clock = self.clock
+
+    def tearDown(self):
+        for dc in self.client._delayedCalls.values():
+            dc[-1].addErrback(lambda _: None)
+        self.client._dropDelayedCalls()
+        return self.client.stopService()
+
+    def connect(self):
+        self.client.startService()
+        self.clock.advance(0)
+        return self.endpoint.protocols[-1]
+
+    def test_timeout(self):
+        ds = [self.client.call(i) for i in range(3)]
+        self.clock.advance(1)
+        ds.append(self.client.call(3))
+        # one timer for all calls
+        self.assertEqual(1, len(self.clock.getDelayedCalls()))
+
+        self.clock.advance(4)
+        for d in ds[:3]:
+            self.failureResultOf(d, pclient.NoPersisentClientConnection)
+        self.assertNoResult(ds[3])
+
+        ds[3].cancel()
+        self.failureResultOf(ds[3])
+        self.assertEqual({}, dict(self.client._delayedCalls))
+
+    def test_timeout_delay_changed(self):
+        self.client.callretry_delay = 10
+        d1 = self.client.call(1)
+        self.client.callretry_delay = 2
+        d2 = self.client.call(2)
+
+        self.clock.advance(2)
+        self.failureResultOf(d2, pclient.NoPersisentClientConnection)
+        self.assertNoResult(d1)
+        self.clock.advance(8)
+        self.failureResultOf(d1, pclient.NoPersisentClientConnection)
+        self.assertEqual([], self.clock.getDelayedCalls())
+
+    def test_bounds(self):
+        self.client.callretry_max_count = 2
+        self.client.callretry_max_bytes = 10
+        self.assertNoResult(self.client.call("x" * 8))
+        self.failureResultOf(self.client.call("x" * 8), pclient.NoPersisentClientConnection)
+        self.assertNoResult(self.client.call("x"))
+        self.failureResultOf(self.client.call("x"), pclient.NoPersisentClientConnection)
+
+    def test_paced_replay(self):
+        self.client.callretry_replay_rate = 20
+        for i in range(5):
+            self.client.call(i)
+
+        p = self.connect()
+        self.assertEqual([0, 1], [x for x, _ in p.calls])
+        self.clock.advance(0.1)
+        self.assertEqual([0, 1, 2, 3], [x for x, _ in p.calls])
+        self.clock.advance(0.1)
+        self.assertEqual([0, 1, 2, 3, 4], [x for x, _ in p.calls])
+
+        p.calls[0][1].callback('ok')
+        self.assertEqual(0, self.client._delayedCallsBytes)
+
+    def test_paced_replay_order(self):
+        self.client.callretry_replay_rate = 10
+        for i in range(3):
+            self.client.call(i)
+
+        p = self.connect()
+        self.client.call('new')
+        self.assertEqual([0], [x for x, _ in p.calls])
+        self.clock.pump([0.1] * 3)
+        self.assertEqual([0, 1, 2, 'new'], [x for x, _ in p.calls])
+
+        # replay is over - call right away
+        self.client.call('next')
+        self.assertEqual('next', p.calls[-1][0])
+
+    def test_fast_path(self):
+        self.client.callretry_delay = 0
+        p = self.connect()
+        d = self.client.call(1)
+        p.calls[0][1].callback('ok')
+        self.assertEqual('ok', self.successResultOf(d))
+        self.failureResultOf(self.client.call(1, 2), TypeError)
+
+    def test_circuit_breaker(self):
+        self.client.callretry_delay = 0
+        cb = self.client.circuit_breaker = health.makeCircuitBreaker({'min_calls': 2})
+        cb.clock = self.clock
+
+        for _ in range(3):
+            self.failureResultOf(self.client.call(1), pclient.NoPersisentClientConnection)
+        self.assertEqual(cb.OPEN, cb.state)
+        self.assertRaises(health.CircuitOpenError, self.client.checkHealth)
+
+        self.clock.advance(cb.reset_timeout)
+        p = self.connect()
+        self.client.call(1)
+        self.assertEqual(cb.HALF_OPEN, cb.state)
+        p.calls[0][1].callback(None)
+        self.assertEqual(cb.CLOSED, cb.state)
+
+
+class PooledClientServiceTest(TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.endpoint = _FakeEndpoint(self.clock)
+        factory = pclient.PersistentClientFactory()
+        factory.protocol = _SlowProtocol
+        self.pool = pclient.PooledPersistentClientService(
+            self.endpoint, factory, pool_size=3,
+            reconnect_delay_jitter=0, callretry_delay=0)
+        self.pool.protocolProxiedMethods = ['call']
+        for s in self.pool:
+            s.clock = self.clock
+        self.pool.startService()
+        self.clock.advance(0)
+
+    def tearDown(self):
+        return self.pool.stopService()
+
+    def connection(self, i):
+        return self.pool.getServiceNamed(str(i))
+
+    def test_least_busy(self):
+        ds = dict((i, self.pool.call(i)) for i in range(3))
+        self.assertEqual([1, 1, 1], [len(p.calls) for p in self.endpoint.protocols])
+
+        # connection with finished call is the least busy one
+        p = self.endpoint.protocols[1]
+        x, d = p.calls.pop()
+        d.callback('ok')
+        self.assertEqual('ok', self.successResultOf(ds[x]))
+        self.pool.call('next')
+        self.assertEqual('next', p.calls[-1][0])
+
+    def test_reconnect_independently(self):
+        self.assertEqual("3 of 3 connections are ready", self.pool.checkHealth())
+
+        self.connection(0).getProtocol().transport.loseConnection()
+        self.assertEqual("2 of 3 connections are ready", self.pool.checkHealth())
+        self.assertTrue(self.pool.isReady())
+        self.assertFalse(self.connection(0).isReady())
+        self.assertRaises(Exception, self.connection(0).checkHealth)
+
+        for i in range(4):
+            self.pool.call(i)
+        self.assertEqual([0, 2, 2], [len(p.calls) for p in self.endpoint.protocols])
+
+        self.clock.advance(self.connection(0).reconnect_delay)
+        self.assertEqual(4, len(self.endpoint.protocols))
+        self.assertEqual("3 of 3 connections are ready", self.pool.checkHealth())
+
+    def test_get_protocol_keeps_order(self):
+        for i in range(5):
+            self.pool.getProtocol()
+        self.assertEqual(0, self.pool._rr_counter)
+        for i in range(3):
+            self.pool.call(i)
+        self.assertEqual([1, 1, 1], [len(p.calls) for p in self.endpoint.protocols])
+
+    def test_no_connections(self):
+        for s in self.pool:
+            s.getProtocol().transport.loseConnection()
+        self.assertFalse(self.pool.isReady())
+        self.assertRaises(Exception, self.pool.checkHealth)
+        self.failureResultOf(self.pool.call(1), pclient.NoPersisentClientConnection)
+
+    def test_collection_pool_size(self):
+        mc = MemCacheService({
+            'c0': {'host': 'localhost', 'pool_size': 2},
+            'c1': {'host': 'localhost'},
+        })
+        self.assertIsInstance(mc['c0'], pclient.PooledPersistentClientService)
+        self.assertEqual(2, len(list(mc['c0'])))
+        self.assertIsInstance(mc['c1'], pclient.PersistentClientService)
+        self.assertTrue(callable(mc['c0'].get))
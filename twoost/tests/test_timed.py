@@ -2,7 +2,7 @@
 
 from __future__ import print_function, division, absolute_import
 
-from twisted.internet import defer
+from twisted.internet import defer, task
 from twisted.trial.unittest import TestCase
 
 from twoost import timed
@@ -57,3 +57,63 @@ class TimeoutTest(TestCase):
 
         self.assertEqual(0, self.cnt)
         self.assertEqual(3, self.max_cnt)
+
+
+class ResizableSemaphoreTest(TestCase):
+
+    def test_grow_and_shrink(self):
+
+        s = timed.ResizableSemaphore(2)
+        acquired = []
+        for i in range(5):
+            s.acquire().addCallback(lambda _, i=i: acquired.append(i))
+        self.assertEqual([0, 1], acquired)
+
+        s.resize(4)
+        self.assertEqual([0, 1, 2, 3], acquired)
+
+        s.resize(1)
+        s.release()
+        s.release()
+        s.release()
+        self.assertEqual([0, 1, 2, 3], acquired, "limit is 1, one user is still active")
+
+        s.release()
+        self.assertEqual([0, 1, 2, 3, 4], acquired)
+        s.release()
+        self.assertEqual((1, 1), (s.tokens, s.limit))
+
+
+class BucketSchedulerTest(TestCase):
+
+    def test_buckets(self):
+
+        clock = task.Clock()
+        batches = []
+        s = timed.BucketScheduler(tick=1, clock=clock, run_calls=batches.append)
+
+        for i in range(5):
+            s.schedule(0.5 + i * 0.1, i, None, i)
+        s.schedule(2.5, 'late', None)
+        self.assertEqual(6, len(s))
+        self.assertEqual(1, len(clock.getDelayedCalls()))
+
+        self.assertEqual((None, ()), s.cancel('late'))
+        self.assertIs(None, s.cancel('late'))
+        self.assertRaises(KeyError, s.schedule, 1, 0, None)
+
+        clock.advance(1)
+        self.assertEqual([[(None, (i,)) for i in range(5)]], batches)
+        self.assertEqual(0, len(s))
+        self.assertEqual([], clock.getDelayedCalls())
+
+    def test_earlier_bucket_rearms(self):
+        clock = task.Clock()
+        called = []
+        s = timed.BucketScheduler(tick=1, clock=clock)
+        s.schedule(10, 'a', called.append, 'a')
+        s.schedule(2, 'b', called.append, 'b')
+        clock.advance(2)
+        self.assertEqual(['b'], called)
+        clock.advance(8)
+        self.assertEqual(['b', 'a'], called)
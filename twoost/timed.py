@@ -1,10 +1,16 @@
 # coding: utf-8
 
+import math
+import heapq
 import functools
+import collections
 
 from twisted.internet import defer, reactor, task
 from twisted.python import failure
 
+import logging
+logger = logging.getLogger(__name__)
+
 __all__ = [
     'sleep',
     'timeoutDeferred',
@@ -12,6 +18,8 @@ __all__ = [
     'withParallelLimit',
     'TimeoutError',
     'CloseableDeferredQueue',
+    'ResizableSemaphore',
+    'BucketScheduler',
 ]
 
 
@@ -115,3 +123,150 @@ class CloseableDeferredQueue(defer.DeferredQueue):
             return defer.succeed(self.pending.pop(0))
         self._ensure_open()
         return defer.DeferredQueue.get(self)
+
+
+class ResizableSemaphore(defer.DeferredSemaphore):
+
+    # tokens to be dropped by next releases (after shrinking)
+    _debt = 0
+
+    def resize(self, limit):
+
+        if limit < 1:
+            raise ValueError("ResizableSemaphore requires limit >= 1")
+
+        delta = limit - self.limit
+        self.limit = limit
+
+        if delta >= 0:
+            paid = min(self._debt, delta)
+            self._debt -= paid
+            for _ in range(delta - paid):
+                self.tokens += 1
+                if self.waiting:
+                    self.tokens -= 1
+                    self.waiting.pop(0).callback(self)
+        else:
+            taken = min(self.tokens, -delta)
+            self.tokens -= taken
+            self._debt += -delta - taken
+
+    def release(self):
+        if self._debt:
+            self._debt -= 1
+        else:
+            defer.DeferredSemaphore.release(self)
+
+
+class BucketScheduler(object):
+
+    """Coarse-grained scheduler for lots of delayed calls.
+
+    Calls are grouped into buckets of `tick` seconds, only one timed call
+    is registered in the reactor. All calls of a bucket are passed
+    to `run_calls` (list of `(fn, args)`) at once.
+    """
+
+    def __init__(self, tick=1.0, clock=None, run_calls=None):
+        assert tick > 0
+        self.tick = tick
+        self.clock = clock or reactor
+        self.run_calls = run_calls or self._runCalls
+        self._buckets = {}
+        self._key_bucket = {}
+        self._bucket_heap = []
+        self._timer = None
+        self._timer_bucket = None
+
+    def __len__(self):
+        return len(self._key_bucket)
+
+    def __contains__(self, key):
+        return key in self._key_bucket
+
+    def schedule(self, delay, key, fn, *args):
+
+        if key in self._key_bucket:
+            raise KeyError("call %r already scheduled" % (key,))
+
+        n = int(math.ceil((self.clock.seconds() + delay) / self.tick))
+        bucket = self._buckets.get(n)
+        if bucket is None:
+            bucket = self._buckets[n] = collections.OrderedDict()
+            heapq.heappush(self._bucket_heap, n)
+
+        bucket[key] = fn, args
+        self._key_bucket[key] = n
+        self._rearm()
+
+    def cancel(self, key):
+        n = self._key_bucket.pop(key, None)
+        if n is None:
+            return None
+        bucket = self._buckets[n]
+        call = bucket.pop(key)
+        if not bucket:
+            # heap entry is dropped lazily
+            del self._buckets[n]
+        return call
+
+    def cancelAll(self):
+        calls = [c for b in self._buckets.values() for c in b.values()]
+        self._buckets.clear()
+        self._key_bucket.clear()
+        del self._bucket_heap[:]
+        if self._timer is not None and self._timer.active():
+            self._timer.cancel()
+        self._timer = None
+        return calls
+
+    def _rearm(self):
+
+        heap = self._bucket_heap
+        while heap and heap[0] not in self._buckets:
+            heapq.heappop(heap)
+
+        timer_active = self._timer is not None and self._timer.active()
+        if not heap:
+            if timer_active:
+                self._timer.cancel()
+            self._timer = None
+            return
+
+        n = heap[0]
+        if timer_active:
+            if self._timer_bucket <= n:
+                return
+            self._timer.cancel()
+
+        self._timer_bucket = n
+        delay = max(0, n * self.tick - self.clock.seconds())
+        self._timer = self.clock.callLater(delay, self._fire)
+
+    def _fire(self):
+
+        self._timer = None
+        due_bucket = self._timer_bucket
+        heap = self._bucket_heap
+        calls = []
+
+        while heap and heap[0] <= due_bucket:
+            bucket = self._buckets.pop(heapq.heappop(heap), None)
+            if bucket:
+                for key, call in bucket.items():
+                    del self._key_bucket[key]
+                    calls.append(call)
+
+        try:
+            if calls:
+                self.run_calls(calls)
+        finally:
+            self._rearm()
+
+    @staticmethod
+    def _runCalls(calls):
+        for fn, args in calls:
+            try:
+                fn(*args)
+            except Exception:
+                logger.exception("delayed call %r failed", fn)